@@ -0,0 +1,87 @@
+import re
+import time
+import zlib
+import asyncio
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import AIMessage, AIMessageChunk
+
+# =============================================================
+# DETERMINISTIC STAND-INS FOR THE OPENAI MODELS
+# =============================================================
+# Used by the benchmarks so runs need no network, no API key and cost
+# nothing. Latency is configurable to model the remote calls.
+
+_TOKEN = re.compile(r"\w+")
+
+
+class FakeEmbeddings(Embeddings):
+    """Hashed bag-of-words vectors: texts sharing words get similar vectors.
+
+    latency is slept once per call, per_text_latency once per embedded text.
+    """
+
+    def __init__(self, dim: int = 256, latency: float = 0.0, per_text_latency: float = 0.0, buckets: int = 4096, seed: int = 0):
+        self.dim = dim
+        self.latency = latency
+        self.per_text_latency = per_text_latency
+        self.buckets = buckets
+        self._table = np.random.RandomState(seed).standard_normal((buckets, dim)).astype(np.float32)
+        self.calls = 0
+        self.texts = 0
+
+    def _embed(self, text: str):
+        idx = [zlib.crc32(t.encode("utf-8")) % self.buckets for t in _TOKEN.findall(text.lower())]
+        vec = self._table[idx].sum(axis=0) if idx else self._table[0]
+        return (vec / (np.linalg.norm(vec) or 1.0)).tolist()
+
+    def _sleep(self, n: int):
+        self.calls += 1
+        self.texts += n
+        delay = self.latency + self.per_text_latency * n
+        if delay > 0:
+            time.sleep(delay)
+
+    def embed_documents(self, texts):
+        self._sleep(len(texts))
+        return [self._embed(t) for t in texts]
+
+    def embed_query(self, text):
+        self._sleep(1)
+        return self._embed(text)
+
+
+class FakeChatModel:
+    """Answers with a fixed text after `latency` seconds.
+
+    astream yields the answer word by word, `token_latency` apart, so time to
+    first token and total time can be told apart.
+    """
+
+    def __init__(self, answer: str = "This is a benchmark answer based on the provided context.",
+                 latency: float = 0.0, token_latency: float = 0.0):
+        self.answer = answer
+        self.latency = latency
+        self.token_latency = token_latency
+        self.calls = 0
+
+    def invoke(self, prompt, *args, **kwargs):
+        self.calls += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+        return AIMessage(content=self.answer)
+
+    async def ainvoke(self, prompt, *args, **kwargs):
+        self.calls += 1
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        return AIMessage(content=self.answer)
+
+    async def astream(self, prompt, *args, **kwargs):
+        self.calls += 1
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        for i, word in enumerate(self.answer.split(" ")):
+            if i and self.token_latency > 0:
+                await asyncio.sleep(self.token_latency)
+            yield AIMessageChunk(content=word if i == 0 else " " + word)
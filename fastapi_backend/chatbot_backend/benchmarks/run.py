@@ -0,0 +1,363 @@
+"""Offline performance benchmarks for the chatbot backend.
+
+The OpenAI models are replaced by the deterministic fakes in
+benchmarks/fakes.py (with configurable latency), and everything runs in a
+temporary working directory, so no network, API key or existing data is
+needed. Run from fastapi_backend/chatbot_backend:
+
+    python -m benchmarks.run --sizes 1000,10000,100000 --concurrency 1,8,32 --out report.json
+    python -m benchmarks.run --sizes 1000 --baseline report.json
+
+The report is JSON with stable keys; --baseline prints the relative change
+of every latency (_ms) and throughput (_per_s) figure against an older one.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Offline benchmarks with stand-in LLM and embeddings")
+    p.add_argument("--sizes", default="1000,10000", help="synthetic tenant sizes in chunks, comma separated")
+    p.add_argument("--concurrency", default="1,8", help="concurrency levels for /query and writes")
+    p.add_argument("--queries", type=int, default=200, help="/query requests per concurrency level")
+    p.add_argument("--retrievals", type=int, default=500, help="hybrid_retrieve calls per size")
+    p.add_argument("--write-docs", type=int, default=40, help="documents added and deleted per concurrency level")
+    p.add_argument("--chunks-per-doc", type=int, default=20)
+    p.add_argument("--dim", type=int, default=256, help="embedding dimension of the fake model")
+    p.add_argument("--embed-latency-ms", type=float, default=0.0, help="per embedding call")
+    p.add_argument("--embed-per-text-ms", type=float, default=0.0, help="per embedded text")
+    p.add_argument("--llm-latency-ms", type=float, default=0.0, help="per LLM call")
+    p.add_argument("--llm-token-ms", type=float, default=0.0, help="between streamed tokens")
+    p.add_argument("--chat-users", type=int, default=200)
+    p.add_argument("--chat-turns", type=int, default=50, help="turns appended per chat user")
+    p.add_argument("--seed", type=int, default=42)
+    p.add_argument("--workdir", default=None, help="where data/ and chat_data/ are created (default: a temp dir)")
+    p.add_argument("--out", default="benchmark_report.json")
+    p.add_argument("--baseline", default=None, help="earlier report to compare against")
+    return p.parse_args(argv)
+
+
+def percentiles(samples):
+    """Latency summary in milliseconds."""
+    if not samples:
+        return {"count": 0}
+    ms = np.asarray(samples) * 1000
+    return {
+        "count": len(ms),
+        "mean_ms": round(float(ms.mean()), 3),
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p90_ms": round(float(np.percentile(ms, 90)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+        "max_ms": round(float(ms.max()), 3),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True, timeout=10
+        ).stdout.strip() or None
+    except Exception:
+        return None
+
+# =============================================================
+# SETUP
+# =============================================================
+def install_fakes(args):
+    """Import the app with the fakes patched into every module that holds a model."""
+    os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+    sys.path.insert(0, BACKEND_DIR)
+
+    from benchmarks.fakes import FakeEmbeddings, FakeChatModel
+    from modules import rag, intent_classifier, query_rewriter
+
+    embeddings = FakeEmbeddings(
+        dim=args.dim, latency=args.embed_latency_ms / 1000, per_text_latency=args.embed_per_text_ms / 1000, seed=args.seed
+    )
+    llm = FakeChatModel(latency=args.llm_latency_ms / 1000, token_latency=args.llm_token_ms / 1000)
+    rag.embeddings = embeddings
+    rag.llm = intent_classifier.llm = query_rewriter.llm = llm
+    return embeddings, llm
+
+
+class Corpus:
+    """Synthetic text with a skewed word distribution, reproducible from a seed."""
+
+    def __init__(self, seed: int, vocabulary: int = 5000):
+        self.rng = random.Random(seed)
+        self.words = [f"term{i}" for i in range(vocabulary)]
+        weights = 1.0 / np.arange(1, vocabulary + 1)
+        self.cum = np.cumsum(weights / weights.sum())
+        self.np_rng = np.random.RandomState(seed)
+
+    def _words(self, n):
+        idx = np.searchsorted(self.cum, self.np_rng.random_sample(n))
+        return [self.words[min(i, len(self.words) - 1)] for i in idx]
+
+    def chunk_text(self, words: int = 50):
+        return " ".join(self._words(words))
+
+    def document(self, chunks: int):
+        # Paragraphs roughly the splitter's chunk size
+        return "\n\n".join(self.chunk_text(45) for _ in range(chunks))
+
+    def query(self):
+        return "what is " + " ".join(self._words(5)) + "?"
+
+# =============================================================
+# BENCHMARKS
+# =============================================================
+def build_tenant(rag, embeddings, corpus, tenant_id, size, batch=5000, chunks_per_source=50):
+    """Fill a tenant with `size` chunks, committed `batch` at a time."""
+    start = time.perf_counter()
+    for offset in range(0, size, batch):
+        full_chunks = []
+        for k in range(offset, min(size, offset + batch)):
+            source = f"synthetic-{k // chunks_per_source}"
+            full_chunks.append({
+                "text": corpus.chunk_text(),
+                "metadata": {"source_id": source, "type": "pdf", "file_name": f"{source}.pdf", "url": None,
+                             "tenant_id": tenant_id, "content_hash": None},
+            })
+        vecs = [embeddings._embed(c["text"]) for c in full_chunks]
+        rag.commit_chunks(tenant_id, full_chunks, vecs)
+    return time.perf_counter() - start
+
+
+def bench_retrieve(rag, embeddings, corpus, tenant_id, n):
+    # Query vectors are computed up front so only retrieval is timed
+    queries = [corpus.query() for _ in range(n)]
+    vectors = [embeddings._embed(q) for q in queries]
+    rag.hybrid_retrieve(tenant_id, queries[0], query_vector=vectors[0])   # load outside the timing
+
+    samples = []
+    for q, v in zip(queries, vectors):
+        t = time.perf_counter()
+        rag.hybrid_retrieve(tenant_id, q, query_vector=v)
+        samples.append(time.perf_counter() - t)
+    return percentiles(samples)
+
+
+async def _bench_query(app, corpus, tenant_id, concurrency, n, path):
+    import httpx
+
+    queries = [corpus.query() for _ in range(n)]
+    samples, errors = [], 0
+    sem = asyncio.Semaphore(concurrency)
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=300) as client:
+        async def one(i):
+            nonlocal errors
+            async with sem:
+                t = time.perf_counter()
+                resp = await client.post(path, data={"tenant_id": tenant_id, "query": queries[i], "user_id": f"bench-user-{i % 50}"})
+                await resp.aread()
+                samples.append(time.perf_counter() - t)
+                if resp.status_code != 200:
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(n)))
+        wall = time.perf_counter() - start
+
+    return {"concurrency": concurrency, "requests": n, "errors": errors,
+            "throughput_per_s": round(n / wall, 2), **percentiles(samples)}
+
+
+def bench_query(app, corpus, tenant_id, concurrency, n, path="/query"):
+    return asyncio.run(_bench_query(app, corpus, tenant_id, concurrency, n, path))
+
+
+def bench_writes(rag, corpus, tenant_id, concurrency, docs, chunks_per_doc):
+    texts = [corpus.document(chunks_per_doc) for _ in range(docs)]
+    ids = [f"bench-{uuid.uuid4()}" for _ in range(docs)]
+    commits_before = rag.write_coordinator.commits
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        start = time.perf_counter()
+        list(pool.map(lambda a: rag.add_document(tenant_id, a[0], a[1], file_name=f"{a[1]}.pdf"), zip(texts, ids)))
+        add_seconds = time.perf_counter() - start
+
+        chunks = sum(e["chunk_count"] for e in rag.list_sources(tenant_id) if e["id"] in set(ids))
+        add_commits = rag.write_coordinator.commits - commits_before
+
+        start = time.perf_counter()
+        list(pool.map(lambda source_id: rag.delete_document(tenant_id, source_id), ids))
+        delete_seconds = time.perf_counter() - start
+
+    return {
+        "concurrency": concurrency,
+        "documents": docs,
+        "chunks": chunks,
+        "add_docs_per_s": round(docs / add_seconds, 2),
+        "add_chunks_per_s": round(chunks / add_seconds, 2),
+        "add_commits": add_commits,
+        "delete_docs_per_s": round(docs / delete_seconds, 2),
+    }
+
+
+def bench_chat_storage(users, turns):
+    from modules import chat_storage
+
+    tenant_id = "bench-chat"
+    appends = []
+    for t in range(turns):
+        for u in range(users):
+            entry = chat_storage.new_entry(f"question {t}", f"answer {t} " * 20)
+            start = time.perf_counter()
+            chat_storage.append_entry(tenant_id, f"user-{u}", entry)
+            appends.append(time.perf_counter() - start)
+
+    warm = []
+    for u in range(users):
+        start = time.perf_counter()
+        chat_storage.load_last_n(tenant_id, f"user-{u}", 4)
+        warm.append(time.perf_counter() - start)
+
+    cold = []
+    for u in range(users):
+        with chat_storage._recent_guard:
+            chat_storage._recent.clear()
+        start = time.perf_counter()
+        chat_storage.load_last_n(tenant_id, f"user-{u}", 4)
+        cold.append(time.perf_counter() - start)
+
+    full = []
+    for u in range(min(users, 50)):
+        start = time.perf_counter()
+        chat_storage.load_history(tenant_id, f"user-{u}")
+        full.append(time.perf_counter() - start)
+
+    return {
+        "users": users,
+        "turns_per_user": turns,
+        "append": percentiles(appends),
+        "load_last_n_cached": percentiles(warm),
+        "load_last_n_cold": percentiles(cold),
+        "load_history": percentiles(full),
+    }
+
+
+def tenant_disk_bytes(tenant_id):
+    base = os.path.join("data", tenant_id)
+    return sum(os.path.getsize(os.path.join(base, f)) for f in os.listdir(base) if os.path.isfile(os.path.join(base, f)))
+
+# =============================================================
+# REPORT
+# =============================================================
+def compare(baseline, current, path=""):
+    """Yield (key path, old, new, relative change) for latency and throughput figures."""
+    for key, new in current.items():
+        if key in ("config", "caches"):
+            continue
+        old = baseline.get(key) if isinstance(baseline, dict) else None
+        where = f"{path}.{key}" if path else key
+        if isinstance(new, dict) and isinstance(old, dict):
+            yield from compare(old, new, where)
+        elif isinstance(new, list) and isinstance(old, list):
+            for i, (o, n) in enumerate(zip(old, new)):
+                if isinstance(o, dict) and isinstance(n, dict):
+                    yield from compare(o, n, f"{where}[{n.get('concurrency', i)}]")
+        elif (key.endswith("_ms") or key.endswith("_per_s")) and isinstance(new, (int, float)) and isinstance(old, (int, float)) and old:
+            yield where, old, new, (new - old) / old
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    out = os.path.abspath(args.out)
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+    workdir = args.workdir or tempfile.mkdtemp(prefix="chatbot-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+
+    embeddings, llm = install_fakes(args)
+    from modules import rag
+    from modules.tenant_cache import tenant_cache
+    import main as app_module
+
+    corpus = Corpus(args.seed)
+    sizes = [int(s) for s in args.sizes.split(",") if s]
+    levels = [int(c) for c in args.concurrency.split(",") if c]
+
+    report = {
+        "meta": {
+            "created_at": datetime.utcnow().isoformat(),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "config": {k: v for k, v in vars(args).items() if k not in ("out", "baseline", "workdir")},
+        "chat_storage": None,
+        "sizes": {},
+    }
+
+    print(f"Working directory: {workdir}")
+    print("chat_storage ...")
+    report["chat_storage"] = bench_chat_storage(args.chat_users, args.chat_turns)
+
+    for size in sizes:
+        tenant_id = f"bench-{size}"
+        result = {}
+        print(f"[{size} chunks] building tenant ...")
+        result["build_seconds"] = round(build_tenant(rag, embeddings, corpus, tenant_id, size), 3)
+        result["disk_bytes"] = tenant_disk_bytes(tenant_id)
+
+        # Cold load: what the first request after a restart pays
+        tenant_cache.invalidate(tenant_id)
+        start = time.perf_counter()
+        rag.load_tenant_data(tenant_id)
+        result["load_ms"] = round((time.perf_counter() - start) * 1000, 3)
+
+        print(f"[{size} chunks] hybrid_retrieve ...")
+        result["hybrid_retrieve"] = bench_retrieve(rag, embeddings, corpus, tenant_id, args.retrievals)
+
+        result["query"], result["query_stream"], result["writes"] = [], [], []
+        for c in levels:
+            print(f"[{size} chunks] /query and /query/stream at concurrency {c} ...")
+            result["query"].append(bench_query(app_module.app, corpus, tenant_id, c, args.queries))
+            result["query_stream"].append(bench_query(app_module.app, corpus, tenant_id, c, args.queries, "/query/stream"))
+            print(f"[{size} chunks] add/delete at concurrency {c} ...")
+            result["writes"].append(bench_writes(rag, corpus, tenant_id, c, args.write_docs, args.chunks_per_doc))
+
+        result["caches"] = rag.get_cache_stats()
+        report["sizes"][str(size)] = result
+
+    report["model_calls"] = {"embedding_calls": embeddings.calls, "embedded_texts": embeddings.texts, "llm_calls": llm.calls}
+
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {out}")
+
+    for size, result in report["sizes"].items():
+        print(f"\n== {size} chunks (build {result['build_seconds']}s, load {result['load_ms']} ms)")
+        print(f"  hybrid_retrieve p50 {result['hybrid_retrieve']['p50_ms']} ms, p99 {result['hybrid_retrieve']['p99_ms']} ms")
+        for q in result["query"]:
+            print(f"  /query c={q['concurrency']}: p50 {q['p50_ms']} ms, p99 {q['p99_ms']} ms, {q['throughput_per_s']} req/s")
+        for w in result["writes"]:
+            print(f"  writes c={w['concurrency']}: add {w['add_docs_per_s']} docs/s ({w['add_commits']} commits), delete {w['delete_docs_per_s']} docs/s")
+
+    if baseline:
+        with open(baseline, "r", encoding="utf-8") as f:
+            old = json.load(f)
+        print(f"\n== Change against {baseline}")
+        for where, before, after, change in compare(old, report):
+            print(f"  {where}: {before} -> {after} ({change:+.1%})")
+
+
+if __name__ == "__main__":
+    main()
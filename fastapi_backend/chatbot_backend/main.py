@@ -1,13 +1,22 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from modules.pdf_processor import process_pdf_auto
-from modules.web_loader import load_website
-from modules.rag import add_document, answer_query, delete_document, get_all_chunks
-from modules.intent_classifier import get_intent
-import uuid, os
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from fastapi.concurrency import run_in_threadpool
+from modules.rag import (
+    answer_query, hybrid_retrieve, astream_answer, describe_sources, get_cached_answer, cache_answer,
+    delete_document, list_sources, get_cache_stats, find_source_by_hash, get_embedding_status,
+    get_vector_index_status, set_search_params
+)
+from modules.ingestion import ingest_pdf, ingest_url as ingest_url_job, ingest_batch as ingest_batch_job, ingest_crawl, reindex_tenant
+from modules.web_crawler import CRAWL_MAX_PAGES, CRAWL_MAX_DEPTH
+from modules.jobs import job_queue
+from modules.intent_classifier import get_intent, get_intent_stats
+import uuid, os, hashlib, asyncio, json
+from typing import List
 from urllib.parse import unquote
 from modules.query_rewriter import rewrite_query
-from modules.chat_storage import save_chat, load_last_n
+from modules.chat_storage import new_entry, append_entry, load_last_n
+from modules.metrics import MetricsMiddleware, stage, render as render_metrics
 # from modules.ticket_classifier import get_ticket_category
 # from modules.team import TEAM_MEMBERS
 # from modules.ticket_utils import generate_ticket_number, save_ticket
@@ -19,40 +28,80 @@ app.add_middleware(
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing"],
 )
+# Request latency, plus a Server-Timing header with the stages of the request
+app.add_middleware(MetricsMiddleware)
 
 UPLOAD_DIR = "uploads"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+async def save_upload(file: UploadFile):
+    """Stream an upload to disk, hashing it on the way.
+
+    Files are stored content-addressed as uploads/<sha256><ext>, so the same
+    bytes are only kept once no matter how often or under which name they
+    are uploaded.
+    """
+    digest = hashlib.sha256()
+    tmp_path = os.path.join(UPLOAD_DIR, f".incoming-{uuid.uuid4()}")
+    try:
+        with open(tmp_path, "wb") as f:
+            while True:
+                block = await file.read(UPLOAD_CHUNK_SIZE)
+                if not block:
+                    break
+                digest.update(block)
+                f.write(block)
+
+        content_hash = digest.hexdigest()
+        ext = os.path.splitext(file.filename or "")[1].lower() or ".pdf"
+        file_path = os.path.join(UPLOAD_DIR, f"{content_hash}{ext}")
+        if os.path.exists(file_path):
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, file_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    return file_path, content_hash
+
 # ------------------ INGEST DOCUMENT ------------------
 @app.post("/ingest/document")
 async def ingest_document(
     tenant_id: str = Form(...),
-    file: UploadFile = File(...)
+    file: UploadFile = File(...),
+    source_id: str = Form(None)
 ):
     try:
-        file_id = str(uuid.uuid4())
-        # Save file temporarily or permanently? 
-        # For now, let's keep it in a tenant-specific upload folder if we want, or just global uploads
-        # To avoid collisions, we can prefix with tenant_id
-        
-        safe_filename = f"{tenant_id}_{file.filename}"
-        file_path = os.path.join(UPLOAD_DIR, safe_filename)
-
-        with open(file_path, "wb") as f:
-            f.write(await file.read())
-
-        text = process_pdf_auto(file_path)
-
-        add_document(
-            tenant_id=tenant_id,
-            text=text,
-            source_id=file_id,
-            file_name=file.filename,
-            doc_type="pdf"
+        file_path, content_hash = await save_upload(file)
+
+        # Same file being ingested or already ingested for this tenant
+        # (in-flight jobs first, so a job finishing in between is still caught)
+        pending = job_queue.find(tenant_id, content_hash=content_hash)
+        if pending and (source_id is None or pending.meta["id"] == source_id):
+            return {"status": "duplicate", "id": pending.meta["id"], "name": file.filename, "job_id": pending.id}
+
+        existing_id = await run_in_threadpool(find_source_by_hash, tenant_id, content_hash)
+        if existing_id and (source_id is None or existing_id == source_id):
+            return {"status": "duplicate", "id": existing_id, "name": file.filename}
+
+        # With a source_id the upload is a new version of that document:
+        # only its changed chunks are re-embedded
+        replace = source_id is not None
+        file_id = source_id or str(uuid.uuid4())
+
+        # Extraction, chunking and embedding run on the ingestion workers
+        job = job_queue.submit(
+            tenant_id, "document", ingest_pdf, tenant_id, file_path, file_id, file.filename, content_hash, replace,
+            meta={"id": file_id, "name": file.filename, "content_hash": content_hash}
         )
 
-        return {"status": "success", "id": file_id, "name": file.filename}
+        return {"status": "queued", "id": file_id, "name": file.filename, "job_id": job.id}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -61,52 +110,136 @@ async def ingest_document(
 @app.post("/ingest/url")
 async def ingest_url(
     tenant_id: str = Form(...),
-    url: str = Form(...)
+    url: str = Form(...),
+    crawl: bool = Form(False),
+    max_pages: int = Form(CRAWL_MAX_PAGES),
+    max_depth: int = Form(CRAWL_MAX_DEPTH),
+    source_id: str = Form(None)
+):
+    try:
+        if crawl:
+            # Crawl mode: follow same-site links (or a sitemap) and only
+            # re-ingest pages that changed since the last crawl
+            pending = job_queue.find(tenant_id, crawl=url)
+            if pending:
+                return {"status": "running", "url": url, "job_id": pending.id}
+
+            job = job_queue.submit(
+                tenant_id, "crawl", ingest_crawl, tenant_id, url, max_pages, max_depth,
+                meta={"crawl": url, "max_pages": max_pages, "max_depth": max_depth}
+            )
+            return {"status": "queued", "url": url, "job_id": job.id}
+
+        # With a source_id the page is re-ingested as a new version of that source
+        replace = source_id is not None
+        site_id = source_id or str(uuid.uuid4())
+
+        job = job_queue.submit(
+            tenant_id, "url", ingest_url_job, tenant_id, url, site_id, replace,
+            meta={"id": site_id, "url": url}
+        )
+
+        return {"status": "queued", "id": site_id, "url": url, "job_id": job.id}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# ------------------ INGEST BATCH ------------------
+@app.post("/ingest/batch")
+async def ingest_batch(
+    tenant_id: str = Form(...),
+    files: List[UploadFile] = File(None),
+    urls: List[str] = Form(None)
 ):
     try:
-        site_id = str(uuid.uuid4())
-        text = load_website(url)
-
-        add_document(
-            tenant_id=tenant_id,
-            text=text,
-            source_id=site_id,
-            url=url,
-            doc_type="website"
+        items, response_items, seen = [], [], set()
+
+        for file in files or []:
+            file_path, content_hash = await save_upload(file)
+
+            pending = job_queue.find(tenant_id, content_hash=content_hash)
+            existing_id = pending.meta["id"] if pending else await run_in_threadpool(find_source_by_hash, tenant_id, content_hash)
+            if existing_id or content_hash in seen:
+                response_items.append({"status": "duplicate", "id": existing_id, "name": file.filename})
+                continue
+            seen.add(content_hash)
+
+            file_id = str(uuid.uuid4())
+            items.append({"id": file_id, "type": "pdf", "name": file.filename, "file_path": file_path, "content_hash": content_hash})
+            response_items.append({"status": "queued", "id": file_id, "name": file.filename})
+
+        for url in urls or []:
+            url = url.strip()
+            if not url or url in seen:
+                continue
+            seen.add(url)
+
+            site_id = str(uuid.uuid4())
+            items.append({"id": site_id, "type": "website", "url": url})
+            response_items.append({"status": "queued", "id": site_id, "url": url})
+
+        if not items:
+            return {"status": "duplicate", "items": response_items}
+
+        # Extraction, embedding and a single commit run as one ingestion job
+        job = job_queue.submit(
+            tenant_id, "batch", ingest_batch_job, tenant_id, items,
+            meta={"items": len(items)}
         )
 
-        return {"status": "success", "id": site_id, "url": url}
+        return {"status": "queued", "job_id": job.id, "items": response_items}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# ------------------ INGESTION JOBS ------------------
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+
 # ------------------ QUERY / ASK ------------------
+async def staged(name: str, tenant_id: str, fn, *args):
+    # Timed including the wait for a threadpool worker
+    with stage(name, tenant_id):
+        return await run_in_threadpool(fn, *args)
+
 @app.post("/query")
 async def query_bot(
+    background_tasks: BackgroundTasks,
     tenant_id: str = Form(...),
     query: str = Form(...),
     user_id: str = Form(...)
 ):
     try:
-        intent = get_intent(query)
+        # Intent detection and history loading don't depend on each other
+        intent, last_msgs = await asyncio.gather(
+            staged("intent", tenant_id, get_intent, query),
+            staged("history", tenant_id, load_last_n, tenant_id, user_id, 4),
+        )
 
         if intent == "greeting":
             answer = "Hello! How can I assist you?"
         else:
-            last_msgs = load_last_n(tenant_id, user_id, 4)
-            rewritten_query = rewrite_query(query, last_msgs)
+            # Returns the query unchanged (no LLM call) when there is no history
+            # or the query is already standalone
+            rewritten_query = await staged("rewrite", tenant_id, rewrite_query, query, last_msgs)
             print(f"Tenant: {tenant_id} | Original: {query} | Rewritten: {rewritten_query}")
             
-            answer = answer_query(tenant_id, rewritten_query)
+            answer = await staged("answer", tenant_id, answer_query, tenant_id, rewritten_query)
             
             # Ticket logic disabled for now as it requires deep integration with NestJS DB
             # We can re-enable if we pass ticket creation back to NestJS or handle it here via API call
             
-        # Save to JSON
-        save_chat(tenant_id, user_id, query, answer)
+        # Saved after the response is sent
+        entry = new_entry(query, answer)
+        background_tasks.add_task(append_entry, tenant_id, user_id, entry)
 
         # Return last 4 messages
-        history = load_last_n(tenant_id, user_id, 4)
+        history = (last_msgs + [entry])[-4:]
 
         return {
             "answer": answer,
@@ -117,6 +250,64 @@ async def query_bot(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# ------------------ QUERY / ASK (STREAMING) ------------------
+def sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/query/stream")
+async def query_bot_stream(
+    tenant_id: str = Form(...),
+    query: str = Form(...),
+    user_id: str = Form(...)
+):
+    """Server-sent events: `sources`, then `token` pieces, then `done` with the history."""
+    intent, last_msgs = await asyncio.gather(
+        staged("intent", tenant_id, get_intent, query),
+        staged("history", tenant_id, load_last_n, tenant_id, user_id, 4),
+    )
+
+    async def events():
+        try:
+            parts = []
+            if intent == "greeting":
+                yield sse("sources", [])
+                parts.append("Hello! How can I assist you?")
+                yield sse("token", {"text": parts[0]})
+            else:
+                rewritten_query = await staged("rewrite", tenant_id, rewrite_query, query, last_msgs)
+                print(f"Tenant: {tenant_id} | Original: {query} | Rewritten: {rewritten_query} | stream")
+
+                hit, query_vector, kb_version = await run_in_threadpool(get_cached_answer, tenant_id, rewritten_query)
+                if hit is not None:
+                    yield sse("sources", hit["sources"])
+                    parts.append(hit["answer"])
+                    yield sse("token", {"text": hit["answer"]})
+                else:
+                    docs = await staged("retrieve", tenant_id, hybrid_retrieve, tenant_id, rewritten_query, query_vector)
+                    yield sse("sources", describe_sources(docs))
+
+                    async for piece in astream_answer(rewritten_query, docs, tenant_id):
+                        parts.append(piece)
+                        yield sse("token", {"text": piece})
+
+                    cache_answer(tenant_id, rewritten_query, "".join(parts).strip(), docs, query_vector, kb_version)
+
+            # Only a completed stream is persisted
+            entry = new_entry(query, "".join(parts).strip())
+            await run_in_threadpool(append_entry, tenant_id, user_id, entry)
+
+            yield sse("done", {"answer": entry["answer"], "history": (last_msgs + [entry])[-4:]})
+        except Exception as e:
+            print(f"Error in query stream: {e}")
+            yield sse("error", {"detail": str(e)})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 # ------------------ DELETE DOCUMENT ------------------
 @app.delete("/delete")
 async def delete_doc(
@@ -124,7 +315,8 @@ async def delete_doc(
     source_id: str = Form(...)
 ):
     try:
-        success = delete_document(tenant_id, source_id)
+        # Waits for the tenant's next group commit, so keep it off the event loop
+        success = await run_in_threadpool(delete_document, tenant_id, source_id)
         if not success:
             raise HTTPException(status_code=404, detail="Document not found")
         return {"status": "success", "message": "Document deleted"}
@@ -134,34 +326,102 @@ async def delete_doc(
 # ------------------ STATUS / LIST ------------------
 @app.get("/status/{tenant_id}")
 async def get_status(tenant_id: str):
-    # Return list of ingested files/urls for this tenant
+    # Return list of ingested files/urls for this tenant (manifest only)
     try:
-        all_chunks = get_all_chunks(tenant_id)
-        
-        # Use a dict to deduplicate by source_id
-        items = {}
-        
-        for chunk in all_chunks:
-            meta = chunk.get("metadata") or {}
-            source_id = meta.get("source_id")
-            if not source_id:
-                continue
-                
-            if source_id not in items:
-                items[source_id] = {
-                    "id": source_id,
-                    "type": meta.get("type", "unknown"),
-                    "name": meta.get("file_name") or meta.get("url") or "Unknown",
-                    "uploadedAt": meta.get("uploadedAt") # If we had it
-                }
-                
+        items = await run_in_threadpool(list_sources, tenant_id)
+        embedding = await run_in_threadpool(get_embedding_status, tenant_id)
+
         return {
-            "items": list(items.values())
+            "embeddingModel": embedding["model"],
+            "needsReindex": embedding["needs_reindex"],
+            "items": [
+                {
+                    "id": entry["id"],
+                    "type": entry["type"],
+                    "name": entry["name"],
+                    "uploadedAt": entry["ingested_at"],
+                    "chunkCount": entry["chunk_count"],
+                    "bytes": entry["bytes"],
+                    "contentHash": entry["content_hash"]
+                }
+                for entry in items
+            ]
         }
     except Exception as e:
         return {"items": [], "error": str(e)}
-from modules.ticket_classifier import analyze_ticket, TicketAnalysisRequest
+
+# ------------------ REINDEX ------------------
+@app.post("/reindex")
+async def reindex(tenant_id: str = Form(...)):
+    # Re-embed the tenant with the current embedding backend, in the background
+    try:
+        pending = job_queue.find(tenant_id, reindex=True)
+        if pending:
+            return {"status": "running", "job_id": pending.id}
+
+        embedding = await run_in_threadpool(get_embedding_status, tenant_id)
+        if embedding["model"] is None or not embedding["needs_reindex"]:
+            return {"status": "current", "model": embedding["model"] or embedding["current"]}
+
+        job = job_queue.submit(
+            tenant_id, "reindex", reindex_tenant, tenant_id,
+            meta={"reindex": True, "from": embedding["model"], "to": embedding["current"]}
+        )
+        return {"status": "queued", "job_id": job.id, "from": embedding["model"], "to": embedding["current"]}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# ------------------ VECTOR INDEX ------------------
+@app.get("/vector-index/{tenant_id}")
+async def vector_index_status(tenant_id: str):
+    # Index type (flat or approximate), search parameters and the last rebuild's recall report
+    try:
+        return await run_in_threadpool(get_vector_index_status, tenant_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/vector-index/search-params")
+async def vector_index_search_params(
+    tenant_id: str = Form(...),
+    nprobe: int = Form(None)
+):
+    # Without nprobe the value chosen at the last rebuild is restored
+    try:
+        index = await run_in_threadpool(set_search_params, tenant_id, nprobe)
+        return {"status": "success", "index": index}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# ------------------ CACHE STATS ------------------
+@app.get("/cache/stats")
+async def cache_stats():
+    return get_cache_stats()
+
+# ------------------ METRICS ------------------
+@app.get("/metrics")
+async def metrics():
+    # Prometheus text exposition format
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+# ------------------ INTENT STATS ------------------
+@app.get("/intent/stats")
+async def intent_stats():
+    return get_intent_stats()
+
+# ------------------ TICKET TRIGGERS ------------------
+from modules.ticket_classifier import (
+    analyze_ticket, analyze_tickets, get_ticket_stats, TicketAnalysisRequest, TicketBatchRequest,
+)
 
 @app.post("/analyze-ticket")
 async def analyze_ticket_endpoint(request: TicketAnalysisRequest):
-    return analyze_ticket(request.message, request.triggers)
+    return await run_in_threadpool(analyze_ticket, request.message, request.triggers)
+
+@app.post("/analyze-ticket/batch")
+async def analyze_ticket_batch_endpoint(request: TicketBatchRequest):
+    results = await run_in_threadpool(analyze_tickets, request.messages, request.triggers)
+    return {"results": results}
+
+@app.get("/analyze-ticket/stats")
+async def analyze_ticket_stats():
+    return get_ticket_stats()
@@ -0,0 +1,142 @@
+import os
+import json
+import time
+import math
+from datetime import datetime
+import faiss
+import numpy as np
+
+# =============================================================
+# APPROXIMATE INDEX FOR LARGE TENANTS
+# =============================================================
+# Tenants start on an exact flat index. Once one holds ANN_MIN_VECTORS
+# vectors it is rebuilt in the background as an IVF index (ANN_KIND=ivfpq
+# also compresses the codes), trained from the vectors already stored. The
+# index is rebuilt again when the tenant has grown enough to need twice the
+# inverted lists, or when ANN_KIND changes.
+#
+# Every rebuild measures recall@k against exact search and the per-query
+# latency for a range of nprobe values; the report is kept in
+# ann_reports.json and nprobe is set to the cheapest value reaching
+# ANN_TARGET_RECALL, unless the tenant has its own in search_params.json.
+
+ANN_MIN_VECTORS = int(os.getenv("ANN_MIN_VECTORS", "50000"))
+ANN_KIND = os.getenv("ANN_KIND", "ivf")   # ivf | ivfpq
+ANN_TARGET_RECALL = float(os.getenv("ANN_TARGET_RECALL", "0.95"))
+ANN_EVAL_QUERIES = int(os.getenv("ANN_EVAL_QUERIES", "200"))
+ANN_EVAL_K = 10
+REPORTS_KEPT = 20
+
+SEARCH_PARAMS_FILE = "search_params.json"
+REPORTS_FILE = "ann_reports.json"
+
+
+def plan(n: int, dim: int, kind: str = ANN_KIND):
+    """Index parameters for n vectors: about 4*sqrt(n) lists, at least 39 training points each."""
+    nlist = int(4 * math.sqrt(n))
+    nlist = max(1, min(nlist, n // 39, 65536))
+    pq_m = 0
+    if kind == "ivfpq":
+        # Bytes per vector: the largest divisor of dim giving sub-vectors of 8+ dims
+        pq_m = max(m for m in range(1, dim // 8 + 1) if dim % m == 0)
+    return {"kind": kind, "nlist": nlist, "pq_m": pq_m}
+
+
+def needs_rebuild(info):
+    """info is VectorIndex.describe() of the tenant's current index."""
+    if info is None or info["vectors"] < ANN_MIN_VECTORS:
+        return False
+    if info["kind"] == "flat" or info["kind"] != ANN_KIND:
+        return True
+    return plan(info["vectors"], info["dim"])["nlist"] >= 2 * info["nlist"]
+
+# =============================================================
+# RECALL / LATENCY REPORT
+# =============================================================
+def _latencies(search, queries):
+    samples = []
+    found = []
+    for q in queries:
+        start = time.perf_counter()
+        _, ids = search(q.reshape(1, -1))
+        samples.append(time.perf_counter() - start)
+        found.append(ids[0])
+    ms = np.asarray(samples) * 1000
+    return np.asarray(found), {"p50_ms": round(float(np.percentile(ms, 50)), 3),
+                               "p99_ms": round(float(np.percentile(ms, 99)), 3)}
+
+
+def recall_report(candidate, ids, vectors, k: int = ANN_EVAL_K, queries: int = ANN_EVAL_QUERIES, seed: int = 0):
+    """Recall@k and latency of candidate (a VectorIndex) per nprobe, against exact search.
+
+    Queries are midpoints of random pairs of stored vectors, so they are near
+    the data without being in it.
+    """
+    rng = np.random.RandomState(seed)
+    n = len(ids)
+    k = min(k, n)
+    pairs = rng.randint(0, n, size=(min(queries, n), 2))
+    q = ((vectors[pairs[:, 0]] + vectors[pairs[:, 1]]) / 2).astype(np.float32)
+
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(np.ascontiguousarray(vectors, dtype=np.float32))
+    truth_pos, flat = _latencies(lambda x: exact.search(x, k), q)
+    truth = np.asarray(ids)[truth_pos]
+
+    info = candidate.describe()
+    rows = []
+    nprobe = 1
+    while True:
+        candidate.set_search_params(nprobe=nprobe)
+        found, latency = _latencies(lambda x: candidate.index.search(x, k), q)
+        hits = sum(len(set(f.tolist()) & set(t.tolist())) for f, t in zip(found, truth))
+        rows.append({"nprobe": nprobe, f"recall_at_{k}": round(hits / (len(q) * k), 4), **latency})
+        if nprobe >= info["nlist"] or rows[-1][f"recall_at_{k}"] >= 0.999:
+            break
+        nprobe = min(nprobe * 2, info["nlist"])
+
+    reaching = [r for r in rows if r[f"recall_at_{k}"] >= ANN_TARGET_RECALL]
+    chosen = (reaching[0] if reaching else max(rows, key=lambda r: r[f"recall_at_{k}"]))["nprobe"]
+    return {
+        "created_at": datetime.utcnow().isoformat(),
+        "index": {key: info[key] for key in ("kind", "vectors", "dim", "nlist", "code_size")},
+        "queries": len(q),
+        "k": k,
+        "target_recall": ANN_TARGET_RECALL,
+        "flat": flat,
+        "nprobe": rows,
+        "chosen_nprobe": chosen,
+    }
+
+# =============================================================
+# PER-TENANT FILES
+# =============================================================
+def _read_json(path, default):
+    if not os.path.exists(path):
+        return default
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _write_json(path, value):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(value, f, indent=1)
+    os.replace(tmp, path)
+
+
+def load_search_params(base: str):
+    return _read_json(os.path.join(base, SEARCH_PARAMS_FILE), {})
+
+
+def save_search_params(base: str, params):
+    _write_json(os.path.join(base, SEARCH_PARAMS_FILE), params)
+
+
+def load_reports(base: str):
+    return _read_json(os.path.join(base, REPORTS_FILE), [])
+
+
+def append_report(base: str, report):
+    reports = load_reports(base)[-(REPORTS_KEPT - 1):] + [report]
+    _write_json(os.path.join(base, REPORTS_FILE), reports)
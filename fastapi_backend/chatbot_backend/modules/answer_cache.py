@@ -0,0 +1,134 @@
+import os
+import re
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# =============================================================
+# PER-TENANT SEMANTIC ANSWER CACHE
+# =============================================================
+# Answers are cached per tenant under the (rewritten) query. A lookup first
+# tries the normalized query text, then the most similar cached query by
+# cosine similarity of the query embeddings. Every entry carries the tenant's
+# knowledge-base version, so anything answered before the last add/delete is
+# treated as a miss and dropped.
+
+SIMILARITY_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "512"))
+
+
+def normalize_query(query: str):
+    text = re.sub(r"\s+", " ", query.lower()).strip()
+    return text.rstrip("?!. ")
+
+
+class _TenantEntries:
+    def __init__(self):
+        self.entries = OrderedDict()   # normalized query -> entry dict
+        self._matrix = None            # stacked unit vectors of entries, built lazily
+        self._keys = None
+
+    def drop(self, key):
+        self.entries.pop(key, None)
+        self._matrix = None
+
+    def matrix(self):
+        if self._matrix is None:
+            self._keys = [k for k, e in self.entries.items() if e["vector"] is not None]
+            self._matrix = np.stack([self.entries[k]["vector"] for k in self._keys]) if self._keys else None
+        return self._keys, self._matrix
+
+
+class AnswerCache:
+    def __init__(self, threshold=SIMILARITY_THRESHOLD, ttl=TTL_SECONDS, max_entries=MAX_ENTRIES):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._tenants = {}
+        self._lock = threading.Lock()
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def _valid(self, tenant, key, entry, kb_version):
+        if entry["kb_version"] != kb_version or time.time() - entry["created"] > self.ttl:
+            tenant.drop(key)
+            self.stale += 1
+            return False
+        return True
+
+    def get(self, tenant_id: str, query: str, kb_version, vector=None):
+        """Cached value for the query, or None. vector enables the similarity tier."""
+        key = normalize_query(query)
+        with self._lock:
+            tenant = self._tenants.get(tenant_id)
+            if tenant is None:
+                self.misses += 1
+                return None
+
+            entry = tenant.entries.get(key)
+            if entry is not None and self._valid(tenant, key, entry, kb_version):
+                tenant.entries.move_to_end(key)
+                self.exact_hits += 1
+                return entry["value"]
+
+            if vector is not None:
+                keys, matrix = tenant.matrix()
+                if matrix is not None:
+                    unit = np.asarray(vector, dtype=np.float32)
+                    unit = unit / (np.linalg.norm(unit) or 1.0)
+                    scores = matrix @ unit
+                    best = int(np.argmax(scores))
+                    if scores[best] >= self.threshold:
+                        best_key = keys[best]
+                        entry = tenant.entries[best_key]
+                        if self._valid(tenant, best_key, entry, kb_version):
+                            tenant.entries.move_to_end(best_key)
+                            self.semantic_hits += 1
+                            return entry["value"]
+
+            self.misses += 1
+            return None
+
+    def put(self, tenant_id: str, query: str, value, kb_version, vector=None):
+        key = normalize_query(query)
+        if vector is not None:
+            vector = np.asarray(vector, dtype=np.float32)
+            vector = vector / (np.linalg.norm(vector) or 1.0)
+
+        with self._lock:
+            tenant = self._tenants.setdefault(tenant_id, _TenantEntries())
+            tenant.drop(key)
+            tenant.entries[key] = {
+                "value": value,
+                "vector": vector,
+                "kb_version": kb_version,
+                "created": time.time(),
+            }
+            while len(tenant.entries) > self.max_entries:
+                tenant.drop(next(iter(tenant.entries)))
+
+    def invalidate(self, tenant_id: str):
+        with self._lock:
+            self._tenants.pop(tenant_id, None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.exact_hits + self.semantic_hits + self.misses
+            return {
+                "tenants": len(self._tenants),
+                "entries": sum(len(t.entries) for t in self._tenants.values()),
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "hit_rate": (self.exact_hits + self.semantic_hits) / lookups if lookups else 0.0,
+                "threshold": self.threshold,
+                "ttl": self.ttl,
+            }
+
+
+answer_cache = AnswerCache()
@@ -0,0 +1,366 @@
+import json
+import math
+import os
+import re
+import threading
+import numpy as np
+
+# =============================================================
+# INCREMENTAL BM25 INVERTED INDEX
+# =============================================================
+# Postings are kept per term as {slot: term frequency}. Every chunk gets a
+# slot; deleting a chunk frees its slot (length 0) and the index is compacted
+# once too many slots are dead. Query scoring only touches the postings of the
+# query terms and is vectorized with NumPy.
+#
+# On disk the index is a columnar base (bm25.base.<n>.npz: postings and the
+# terms of every chunk as flat arrays) plus an append-only log of the chunks
+# added and removed since (bm25.log.<n>.jsonl). A save only appends the
+# changes made since the previous one; the base is rewritten once the log
+# holds more than LOG_COMPACT_RATIO of the chunks. Each commit writes a small
+# bm25.<gen>.json naming the base and how many bytes of the log belong to it,
+# so older generations stay readable while the log grows.
+#
+# After a load the base postings stay NumPy arrays; a term's postings (and a
+# chunk's term list) are only turned into Python objects when they change.
+
+TOKEN_RE = re.compile(r"\w+")
+LOG_COMPACT_RATIO = 0.25
+LOG_COMPACT_MIN = 2000
+FORMAT = 2
+
+
+def tokenize(text: str):
+    return TOKEN_RE.findall(text.lower())
+
+
+class BM25Index:
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}    # term -> {slot: tf}
+        self.doc_ids = []     # slot -> chunk id (None once deleted)
+        self.doc_lens = []    # slot -> number of tokens (0 once deleted)
+        self.doc_terms = []   # slot -> distinct terms of the chunk, or its row in the base
+        self.slot_of = {}     # chunk id -> slot
+        self.total_len = 0
+        self._arrays = {}     # term -> (slots, tfs) as ndarrays, built lazily
+        self._lens = None
+        self._lock = threading.RLock()
+
+        # Persisted state: the base the log belongs to and what was saved of it
+        self._base = None            # {"terms", "postings", "doc_offsets", "doc_term_ids"}
+        self._base_postings = {}     # term -> (slots, tfs) of the base, until the term changes
+        self._base_gen = 0
+        self._log_size = 0
+        self._log_records = 0
+        self._pending = None         # log lines not saved yet; None until there is a base
+
+    def __len__(self):
+        return len(self.slot_of)
+
+    @property
+    def file_names(self):
+        """Base and log files the last save refers to."""
+        if self._base is None:
+            return set()
+        return {f"bm25.base.{self._base_gen}.npz", f"bm25.log.{self._base_gen}.jsonl"}
+
+    # ---------------------------------------------------------
+    # Mutations
+    # ---------------------------------------------------------
+    def add(self, chunk_id, text: str):
+        tokens = tokenize(text)
+        counts = {}
+        for tok in tokens:
+            counts[tok] = counts.get(tok, 0) + 1
+
+        with self._lock:
+            self._add_counts(chunk_id, len(tokens), counts)
+            if self._pending is not None:
+                self._pending.append(json.dumps([chunk_id, len(tokens), counts], separators=(",", ":")))
+
+    def _add_counts(self, chunk_id, length: int, counts):
+        if chunk_id in self.slot_of:
+            self.remove(chunk_id)
+
+        slot = len(self.doc_ids)
+        self.doc_ids.append(chunk_id)
+        self.doc_lens.append(length)
+        self.doc_terms.append(list(counts))
+        self.slot_of[chunk_id] = slot
+        self.total_len += length
+
+        for term, tf in counts.items():
+            self._plist(term, create=True)[slot] = tf
+            self._arrays.pop(term, None)
+        self._lens = None
+
+    def remove(self, chunk_id):
+        with self._lock:
+            slot = self.slot_of.pop(chunk_id, None)
+            if slot is None:
+                return False
+            if self._pending is not None:
+                self._pending.append(json.dumps([chunk_id]))
+
+            for term in self._terms_of(slot):
+                plist = self._plist(term)
+                if plist is None:
+                    continue
+                plist.pop(slot, None)
+                if not plist:
+                    del self.postings[term]
+                self._arrays.pop(term, None)
+
+            self.total_len -= self.doc_lens[slot]
+            self.doc_ids[slot] = None
+            self.doc_lens[slot] = 0
+            self.doc_terms[slot] = []
+            self._lens = None
+
+            if len(self.doc_ids) > 64 and len(self.slot_of) < len(self.doc_ids) // 2:
+                self._compact()
+            return True
+
+    def _plist(self, term, create: bool = False):
+        plist = self.postings.get(term)
+        if plist is None:
+            base = self._base_postings.pop(term, None)
+            if base is not None:
+                plist = self.postings[term] = dict(zip(base[0].tolist(), base[1].astype(np.int64).tolist()))
+            elif create:
+                plist = self.postings[term] = {}
+        return plist
+
+    def _terms_of(self, slot):
+        terms = self.doc_terms[slot]
+        if isinstance(terms, int):
+            # Row of the base: its term ids are a slice of the flat arrays
+            offsets = self._base["doc_offsets"]
+            ids = self._base["doc_term_ids"][offsets[terms]:offsets[terms + 1]]
+            terms = [self._base["terms"][i] for i in ids.tolist()]
+        return terms
+
+    def _compact(self):
+        for term in list(self._base_postings):
+            self._plist(term)
+
+        remap = {}
+        doc_ids, doc_lens, doc_terms = [], [], []
+        for old, chunk_id in enumerate(self.doc_ids):
+            if chunk_id is None:
+                continue
+            remap[old] = len(doc_ids)
+            doc_ids.append(chunk_id)
+            doc_lens.append(self.doc_lens[old])
+            doc_terms.append(self.doc_terms[old])   # base rows keep their row number
+
+        self.postings = {
+            term: {remap[s]: tf for s, tf in plist.items()}
+            for term, plist in self.postings.items()
+        }
+        self.doc_ids, self.doc_lens, self.doc_terms = doc_ids, doc_lens, doc_terms
+        self.slot_of = {chunk_id: i for i, chunk_id in enumerate(doc_ids)}
+        self._arrays = {}
+        self._lens = None
+
+    # ---------------------------------------------------------
+    # Scoring
+    # ---------------------------------------------------------
+    def _term_arrays(self, term):
+        arrays = self._arrays.get(term)
+        if arrays is None:
+            plist = self.postings.get(term)
+            if not plist:
+                return self._base_postings.get(term)
+            arrays = (
+                np.fromiter(plist.keys(), dtype=np.int64, count=len(plist)),
+                np.fromiter(plist.values(), dtype=np.float32, count=len(plist)),
+            )
+            self._arrays[term] = arrays
+        return arrays
+
+    def search(self, query: str, k: int = 6):
+        """Return up to k (chunk_id, score) pairs, best first."""
+        with self._lock:
+            n_docs = len(self.slot_of)
+            if n_docs == 0:
+                return []
+
+            if self._lens is None:
+                self._lens = np.asarray(self.doc_lens, dtype=np.float32)
+            avgdl = self.total_len / n_docs or 1.0
+            norm = self.k1 * (1 - self.b + self.b * self._lens / avgdl)
+
+            scores = np.zeros(len(self.doc_ids), dtype=np.float32)
+            for term in set(tokenize(query)):
+                arrays = self._term_arrays(term)
+                if arrays is None:
+                    continue
+                slots, tfs = arrays
+                df = len(slots)
+                idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+                scores[slots] += idf * tfs * (self.k1 + 1) / (tfs + norm[slots])
+
+            candidates = np.flatnonzero(scores)
+            if len(candidates) == 0:
+                return []
+            if len(candidates) > k:
+                top = np.argpartition(-scores[candidates], k - 1)[:k]
+                candidates = candidates[top]
+            order = candidates[np.argsort(-scores[candidates], kind="stable")]
+            return [(self.doc_ids[s], float(scores[s])) for s in order]
+
+    # ---------------------------------------------------------
+    # Persistence
+    # ---------------------------------------------------------
+    def save(self, path: str):
+        """Write the index as of now under path (bm25.<gen>.json) and the files it names."""
+        folder = os.path.dirname(path)
+        with self._lock:
+            pending = self._pending or []
+            if self._base is None or self._log_records + len(pending) > max(LOG_COMPACT_MIN, LOG_COMPACT_RATIO * len(self)):
+                self._write_base(folder)
+            elif pending:
+                self._append_log(folder, pending)
+            self._pending = []
+
+            meta = {
+                "format": FORMAT,
+                "k1": self.k1,
+                "b": self.b,
+                "base_gen": self._base_gen,
+                "log_size": self._log_size,
+                "log_records": self._log_records,
+            }
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp, path)
+
+    def _append_log(self, folder: str, lines):
+        data = ("\n".join(lines) + "\n").encode("utf-8")
+        with open(os.path.join(folder, f"bm25.log.{self._base_gen}.jsonl"), "r+b") as f:
+            f.truncate(self._log_size)   # drop bytes of a save that never committed
+            f.seek(self._log_size)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self._log_size += len(data)
+        self._log_records += len(lines)
+
+    def _write_base(self, folder: str):
+        self._compact()
+        terms = sorted(self.postings)
+        sizes = np.fromiter((len(self.postings[t]) for t in terms), dtype=np.int64, count=len(terms))
+        term_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=term_offsets[1:])
+        slots = np.empty(int(term_offsets[-1]), dtype=np.int32)
+        tfs = np.empty(int(term_offsets[-1]), dtype=np.int32)
+        for i, t in enumerate(terms):
+            plist = self.postings[t]
+            slots[term_offsets[i]:term_offsets[i + 1]] = np.fromiter(plist.keys(), dtype=np.int32, count=len(plist))
+            tfs[term_offsets[i]:term_offsets[i + 1]] = np.fromiter(plist.values(), dtype=np.int32, count=len(plist))
+
+        arrays = {
+            "doc_ids": np.asarray(self.doc_ids, dtype=np.int64),
+            "doc_lens": np.asarray(self.doc_lens, dtype=np.int32),
+            "terms": np.array("\n".join(terms)),
+            "term_offsets": term_offsets,
+            "slots": slots,
+            "tfs": tfs,
+        }
+        gen = self._base_gen + 1
+        base_path = os.path.join(folder, f"bm25.base.{gen}.npz")
+        tmp = os.path.join(folder, f"tmp.bm25.base.{gen}.npz")
+        np.savez(tmp, **arrays)
+        os.replace(tmp, base_path)
+        with open(os.path.join(folder, f"bm25.log.{gen}.jsonl"), "wb") as f:
+            f.flush()
+            os.fsync(f.fileno())
+
+        self._base_gen = gen
+        self._log_size = 0
+        self._log_records = 0
+        self._set_base(arrays)
+
+    def _set_base(self, arrays):
+        """Take the postings from base arrays (dense slots, as written by _write_base)."""
+        text = str(arrays["terms"])
+        terms = text.split("\n") if text else []
+        offsets = arrays["term_offsets"]
+        slots = arrays["slots"].astype(np.int64)
+        tfs = arrays["tfs"].astype(np.float32)
+
+        # Terms of each chunk: the postings regrouped by slot
+        n = len(arrays["doc_ids"])
+        term_of_posting = np.repeat(np.arange(len(terms), dtype=np.int32), np.diff(offsets))
+        by_slot = np.argsort(slots, kind="stable")
+        doc_offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(slots, minlength=n), out=doc_offsets[1:])
+
+        self._base = {"terms": terms, "doc_offsets": doc_offsets, "doc_term_ids": term_of_posting[by_slot]}
+        self._base_postings = {t: (slots[offsets[i]:offsets[i + 1]], tfs[offsets[i]:offsets[i + 1]]) for i, t in enumerate(terms)}
+        self.postings = {}
+        self._arrays = {}
+        self.doc_ids = arrays["doc_ids"].tolist()
+        self.doc_lens = arrays["doc_lens"].tolist()
+        self.doc_terms = list(range(n))
+        self.slot_of = {chunk_id: i for i, chunk_id in enumerate(self.doc_ids)}
+        self.total_len = sum(self.doc_lens)
+        self._lens = None
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if "postings" in meta:
+            return cls._from_json(meta)
+
+        folder = os.path.dirname(path)
+        index = cls(k1=meta["k1"], b=meta["b"])
+        with np.load(os.path.join(folder, f"bm25.base.{meta['base_gen']}.npz")) as npz:
+            index._set_base({name: npz[name] for name in npz.files})
+        index._base_gen = meta["base_gen"]
+
+        # Replay the changes saved since the base, as far as this generation goes
+        with open(os.path.join(folder, f"bm25.log.{meta['base_gen']}.jsonl"), "rb") as f:
+            log = f.read(meta["log_size"])
+        for line in log.decode("utf-8").splitlines():
+            record = json.loads(line)
+            if len(record) == 1:
+                index.remove(record[0])
+            else:
+                index._add_counts(*record)
+        index._log_size = meta["log_size"]
+        index._log_records = meta["log_records"]
+        index._pending = []
+        return index
+
+    @classmethod
+    def _from_json(cls, data):
+        # Single-file JSON index written before the base + log layout
+        index = cls(k1=data["k1"], b=data["b"])
+        index.doc_ids = data["doc_ids"]
+        index.doc_lens = data["doc_lens"]
+        index.doc_terms = [[] for _ in index.doc_ids]
+        index.slot_of = {chunk_id: i for i, chunk_id in enumerate(index.doc_ids)}
+        index.total_len = sum(index.doc_lens)
+        for term, plist in data["postings"].items():
+            index.postings[term] = {s: tf for s, tf in plist}
+            for s, _ in plist:
+                index.doc_terms[s].append(term)
+        return index
+
+    @classmethod
+    def from_chunks(cls, chunks):
+        index = cls()
+        for c in chunks:
+            index.add(c["id"], c["text"])
+        return index
+
+    def estimate_size(self):
+        n_postings = sum(len(p) for p in self.postings.values())
+        n_postings += sum(len(slots) for slots, _ in self._base_postings.values())
+        return 100 * n_postings + 100 * len(self.doc_ids)
@@ -1,39 +1,143 @@
 import os
 import json
+import threading
+from collections import OrderedDict, deque
 from datetime import datetime
 
 CHAT_DIR = "chat_data"
 os.makedirs(CHAT_DIR, exist_ok=True)
 
+# Chats are append-only JSONL (one turn per line). The last RECENT_TURNS turns
+# of recently active users are kept in memory; the file size recorded with
+# them tells us when another process has appended in the meantime.
+RECENT_TURNS = int(os.getenv("CHAT_RECENT_TURNS", "16"))
+MAX_CACHED_USERS = int(os.getenv("CHAT_CACHED_USERS", "10000"))
+
+_locks = {}
+_locks_guard = threading.Lock()
+_recent = OrderedDict()  # path -> (file size, deque of recent turns)
+_recent_guard = threading.Lock()
+
+def _user_lock(path: str):
+    with _locks_guard:
+        lock = _locks.get(path)
+        if lock is None:
+            lock = _locks[path] = threading.Lock()
+        return lock
+
 def _get_file(tenant_id: str, user_id: str):
     tenant_path = os.path.join(CHAT_DIR, tenant_id)
     os.makedirs(tenant_path, exist_ok=True)
-    
+
     safe_user = user_id.replace("/", "_").replace("\\", "_")
-    return os.path.join(tenant_path, f"{safe_user}.json")
+    path = os.path.join(tenant_path, f"{safe_user}.jsonl")
+    _migrate_legacy(path)
+    return path
+
+def _migrate_legacy(path: str):
+    # One-time conversion of chat_data/<tenant>/<user>.json to JSONL
+    legacy = path[:-1]
+    if os.path.exists(path) or not os.path.exists(legacy):
+        return
+    with _user_lock(path):
+        if os.path.exists(path) or not os.path.exists(legacy):
+            return
+        with open(legacy, "r", encoding="utf-8") as f:
+            history = json.load(f)
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for entry in history:
+                f.write(json.dumps(entry) + "\n")
+        os.replace(tmp, path)
+        os.replace(legacy, f"{legacy}.migrated")
+
+def _parse(lines):
+    entries = []
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            entries.append(json.loads(line))
+        except ValueError:
+            # Torn line from a crash mid-append
+            continue
+    return entries
+
+def _tail(path: str, n: int):
+    """Last n turns, reading backwards from the end of the file."""
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        buf = b""
+        # n + 1 newlines guarantee the last n lines are complete
+        while pos > 0 and buf.count(b"\n") <= n:
+            step = min(8192, pos)
+            pos -= step
+            f.seek(pos)
+            buf = f.read(step) + buf
+    return _parse(buf.decode("utf-8", errors="replace").splitlines()[-n:])
+
+def _remember(path: str, size: int, turns):
+    with _recent_guard:
+        _recent[path] = (size, deque(turns, maxlen=RECENT_TURNS))
+        _recent.move_to_end(path)
+        while len(_recent) > MAX_CACHED_USERS:
+            _recent.popitem(last=False)
 
 def load_history(tenant_id: str, user_id: str):
     path = _get_file(tenant_id, user_id)
     if not os.path.exists(path):
         return []
     with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
+        return _parse(f)
 
-def save_chat(tenant_id: str, user_id: str, query: str, answer: str):
-    path = _get_file(tenant_id, user_id)
-    history = load_history(tenant_id, user_id)
-
-    entry = {
+def new_entry(query: str, answer: str):
+    return {
         "query": query,
         "answer": answer,
         "timestamp": datetime.utcnow().isoformat()
     }
 
-    history.append(entry)
+def append_entry(tenant_id: str, user_id: str, entry):
+    path = _get_file(tenant_id, user_id)
+    line = (json.dumps(entry) + "\n").encode("utf-8")
+
+    with _user_lock(path):
+        # A single O_APPEND write, so concurrent appends never interleave
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+            size = os.fstat(fd).st_size
+        finally:
+            os.close(fd)
 
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(history, f, indent=4)
+        with _recent_guard:
+            cached = _recent.get(path)
+            if cached is not None and cached[0] == size - len(line):
+                cached[1].append(entry)
+                _recent[path] = (size, cached[1])
+            else:
+                _recent.pop(path, None)
+
+def save_chat(tenant_id: str, user_id: str, query: str, answer: str):
+    entry = new_entry(query, answer)
+    append_entry(tenant_id, user_id, entry)
+    return entry
 
 def load_last_n(tenant_id: str, user_id: str, n: int = 4):
-    history = load_history(tenant_id, user_id)
-    return history[-n:]
+    path = _get_file(tenant_id, user_id)
+    if n <= 0 or not os.path.exists(path):
+        return []
+    if n > RECENT_TURNS:
+        return _tail(path, n)
+
+    size = os.path.getsize(path)
+    with _recent_guard:
+        cached = _recent.get(path)
+        if cached is not None and cached[0] == size:
+            _recent.move_to_end(path)
+            return list(cached[1])[-n:]
+
+    turns = _tail(path, RECENT_TURNS)
+    _remember(path, size, turns)
+    return turns[-n:]
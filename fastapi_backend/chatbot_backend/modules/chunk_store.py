@@ -0,0 +1,317 @@
+import os
+import json
+import mmap
+import numpy as np
+
+# =============================================================
+# COLUMNAR CHUNK STORE
+# =============================================================
+# Replaces chunks.pkl. Chunk texts live back to back in one UTF-8 buffer
+# (chunks.<gen>.bin, opened with mmap) and each chunk is a fixed-size row
+# (id, offset, length, source, position, start) in chunks.idx.npz. Metadata
+# is stored once per source in the same npz and shared by all of its chunks,
+# so retrieval only decodes the texts it actually returns.
+#
+# position is the chunk's place within its source and start its character
+# offset in the source text (-1 when unknown). Ids only grow, so after an
+# incremental update they no longer follow the order of the text.
+#
+# The .bin file is append-only: new texts are appended on save and deleted
+# ones are left as garbage until they exceed half of the file, at which point
+# the live texts are rewritten into the next generation. The index file is
+# written atomically and is the only file that says which .bin to read, so a
+# reader never sees offsets into bytes that aren't there. Older .bin files
+# are left for the caller to remove once nothing references them.
+
+ROW_DTYPE = np.dtype([
+    ("id", "<i8"), ("offset", "<i8"), ("length", "<i4"), ("source", "<i4"), ("position", "<i4"), ("start", "<i8")
+])
+INDEX_FILE = "chunks.idx.npz"
+
+
+def _open_mmap(path, size):
+    if not size:
+        return None
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class _View:
+    """Immutable snapshot readers work from; writers swap in a new one."""
+
+    __slots__ = ("rows", "sources", "buf", "bin_size", "pending")
+
+    def __init__(self, rows, sources, buf, bin_size, pending):
+        self.rows = rows          # ROW_DTYPE array sorted by id
+        self.sources = sources    # source index -> metadata dict (None once deleted)
+        self.buf = buf            # mmap of the .bin (first bin_size bytes are valid)
+        self.bin_size = bin_size
+        self.pending = pending    # texts appended since the last save
+
+    def text(self, offset, length):
+        if offset >= self.bin_size:
+            start = offset - self.bin_size
+            return self.pending[start:start + length].decode("utf-8")
+        return self.buf[offset:offset + length].decode("utf-8")
+
+    def chunk(self, row):
+        return {
+            "id": int(row["id"]),
+            "text": self.text(int(row["offset"]), int(row["length"])),
+            "metadata": self.sources[int(row["source"])],
+            "position": int(row["position"]),
+            "start": int(row["start"])
+        }
+
+
+def _upgrade_rows(old):
+    # Stores written before positions were kept: chunks of a source were
+    # added in text order, so their ids give the order; offsets are unknown
+    rows = np.empty(len(old), ROW_DTYPE)
+    for name in old.dtype.names:
+        rows[name] = old[name]
+    order = np.lexsort((rows["id"], rows["source"]))
+    sources = rows["source"][order]
+    firsts = np.r_[0, np.flatnonzero(np.diff(sources)) + 1]
+    group_start = np.repeat(firsts, np.diff(np.r_[firsts, len(order)]))
+    rows["position"][order] = np.arange(len(order)) - group_start
+    rows["start"] = -1
+    return rows
+
+
+class ChunkStore:
+    def __init__(self, rows=None, sources=None, bin_path=None, bin_size=0, generation=0, garbage=0):
+        rows = rows if rows is not None else np.empty(0, ROW_DTYPE)
+        sources = list(sources or [])
+        self._view = _View(rows, sources, _open_mmap(bin_path, bin_size), bin_size, b"")
+        self.source_index = {m["source_id"]: i for i, m in enumerate(sources) if m is not None}
+        self.generation = generation
+        self._bin_path = bin_path
+        self._garbage = garbage           # bytes of deleted texts in the .bin
+
+    def __len__(self):
+        return len(self._view.rows)
+
+    @property
+    def rows(self):
+        return self._view.rows
+
+    @property
+    def bin_name(self):
+        return os.path.basename(self._bin_path) if self._bin_path else None
+
+    # ---------------------------------------------------------
+    # Reads
+    # ---------------------------------------------------------
+    def get(self, chunk_id):
+        view = self._view
+        pos = int(np.searchsorted(view.rows["id"], chunk_id))
+        if pos >= len(view.rows) or view.rows["id"][pos] != chunk_id:
+            return None
+        return view.chunk(view.rows[pos])
+
+    def iter_chunks(self):
+        view = self._view
+        for row in view.rows:
+            yield view.chunk(row)
+
+    def next_id(self):
+        rows = self._view.rows
+        return int(rows["id"][-1]) + 1 if len(rows) else 0
+
+    def has_source(self, source_id):
+        return source_id in self.source_index
+
+    def ids_for_source(self, source_id):
+        idx = self.source_index.get(source_id)
+        if idx is None:
+            return []
+        rows = self._view.rows
+        return rows["id"][rows["source"] == idx].tolist()
+
+    def chunks_for_source(self, source_id):
+        idx = self.source_index.get(source_id)
+        if idx is None:
+            return []
+        view = self._view
+        return [view.chunk(row) for row in view.rows[view.rows["source"] == idx]]
+
+    # ---------------------------------------------------------
+    # Mutations (single writer; readers keep whatever view they started with)
+    # ---------------------------------------------------------
+    def _next_position(self, idx):
+        rows = self._view.rows
+        positions = rows["position"][rows["source"] == idx]
+        return int(positions.max()) + 1 if len(positions) else 0
+
+    def add(self, full_chunks):
+        """Append chunks; their "position" (and "start") count from the end of
+        what is stored for the source, in list order when not given."""
+        if not full_chunks:
+            return
+        view = self._view
+        sources = list(view.sources)
+        new_rows = np.empty(len(full_chunks), ROW_DTYPE)
+        pieces = []
+        offset = view.bin_size + len(view.pending)
+        base = {}    # source index -> [first free position, chunks placed]
+        for i, c in enumerate(full_chunks):
+            meta = c["metadata"]
+            idx = self.source_index.get(meta["source_id"])
+            if idx is None:
+                idx = self.source_index[meta["source_id"]] = len(sources)
+                sources.append(dict(meta))
+            if idx not in base:
+                base[idx] = [self._next_position(idx) if idx < len(view.sources) else 0, 0]
+            first, placed = base[idx]
+            position = first + c.get("position", placed)
+            # Offsets into another version of the text don't line up with the stored ones
+            start = c.get("start", -1) if first == 0 else -1
+            base[idx][1] += 1
+            data = c["text"].encode("utf-8")
+            new_rows[i] = (c["id"], offset, len(data), idx, position, start)
+            pieces.append(data)
+            offset += len(data)
+
+        rows = np.concatenate([view.rows, new_rows])
+        if len(view.rows) and new_rows["id"].min() <= view.rows["id"][-1]:
+            rows.sort(order="id")
+        self._view = _View(rows, sources, view.buf, view.bin_size, view.pending + b"".join(pieces))
+
+    def remove_source(self, source_id):
+        idx = self.source_index.pop(source_id, None)
+        if idx is None:
+            return []
+        view = self._view
+        mask = view.rows["source"] == idx
+        removed = view.rows[mask]
+        sources = list(view.sources)
+        sources[idx] = None
+        self._garbage += int(removed["length"].sum())
+        self._view = _View(view.rows[~mask], sources, view.buf, view.bin_size, view.pending)
+        return removed["id"].tolist()
+
+    def remove_ids(self, ids):
+        if not len(ids):
+            return
+        view = self._view
+        mask = np.isin(view.rows["id"], np.asarray(ids, dtype=np.int64))
+        self._garbage += int(view.rows["length"][mask].sum())
+        self._view = _View(view.rows[~mask], view.sources, view.buf, view.bin_size, view.pending)
+
+    def set_layout(self, layout):
+        """layout: chunk id -> (position, start), e.g. after the source was re-split."""
+        if not layout:
+            return
+        view = self._view
+        rows = view.rows.copy()
+        pos = np.searchsorted(rows["id"], np.fromiter(layout.keys(), dtype=np.int64))
+        values = np.array(list(layout.values()), dtype=np.int64).reshape(-1, 2)
+        rows["position"][pos] = values[:, 0]
+        rows["start"][pos] = values[:, 1]
+        self._view = _View(rows, view.sources, view.buf, view.bin_size, view.pending)
+
+    def set_source_metadata(self, source_id, meta):
+        idx = self.source_index.get(source_id)
+        if idx is None:
+            return
+        view = self._view
+        sources = list(view.sources)
+        sources[idx] = dict(meta)
+        self._view = _View(view.rows, sources, view.buf, view.bin_size, view.pending)
+
+    # ---------------------------------------------------------
+    # Persistence
+    # ---------------------------------------------------------
+    def save(self, base: str, index_file: str = INDEX_FILE):
+        view = self._view
+        total = view.bin_size + len(view.pending)
+        if self._bin_path is None or (total and self._garbage * 2 > total):
+            self._rewrite(base)
+        elif view.pending:
+            with open(self._bin_path, "r+b") as f:
+                f.truncate(view.bin_size)   # drop bytes of a save that never committed
+                f.seek(view.bin_size)
+                f.write(view.pending)
+                f.flush()
+                os.fsync(f.fileno())
+            self._view = _View(view.rows, view.sources, _open_mmap(self._bin_path, total), total, b"")
+
+        self._write_index(base, index_file)
+
+    def _rewrite(self, base: str):
+        # Compact live texts (and sources) into the next .bin generation
+        view = self._view
+        remap = {}
+        sources = []
+        rows = view.rows.copy()
+        bin_path = os.path.join(base, f"chunks.{self.generation + 1}.bin")
+        offset = 0
+        with open(bin_path, "wb") as f:
+            for i, row in enumerate(view.rows):
+                start, length = int(row["offset"]), int(row["length"])
+                if start >= view.bin_size:
+                    data = view.pending[start - view.bin_size:start - view.bin_size + length]
+                else:
+                    data = view.buf[start:start + length]
+                f.write(data)
+                src = int(row["source"])
+                if src not in remap:
+                    remap[src] = len(sources)
+                    sources.append(view.sources[src])
+                rows["offset"][i] = offset
+                rows["source"][i] = remap[src]
+                offset += length
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.generation += 1
+        self._bin_path = bin_path
+        self._garbage = 0
+        self.source_index = {m["source_id"]: i for i, m in enumerate(sources)}
+        self._view = _View(rows, sources, _open_mmap(bin_path, offset), offset, b"")
+
+    def _write_index(self, base: str, index_file: str):
+        view = self._view
+        meta = {
+            "generation": self.generation,
+            "bin": os.path.basename(self._bin_path),
+            "bin_size": view.bin_size,
+            "garbage": self._garbage,
+            "sources": view.sources
+        }
+        path = os.path.join(base, index_file)
+        tmp = os.path.join(base, f"tmp.{index_file}")
+        np.savez(tmp, rows=view.rows, meta=np.array(json.dumps(meta)))
+        os.replace(tmp, path)
+
+    @classmethod
+    def exists(cls, base: str, index_file: str = INDEX_FILE):
+        return os.path.exists(os.path.join(base, index_file))
+
+    @classmethod
+    def load(cls, base: str, index_file: str = INDEX_FILE):
+        with np.load(os.path.join(base, index_file)) as npz:
+            rows = npz["rows"]
+            meta = json.loads(str(npz["meta"]))
+        if rows.dtype != ROW_DTYPE:
+            rows = _upgrade_rows(rows)
+        return cls(
+            rows=rows,
+            sources=meta["sources"],
+            bin_path=os.path.join(base, meta["bin"]),
+            bin_size=meta["bin_size"],
+            generation=meta["generation"],
+            garbage=meta["garbage"]
+        )
+
+    @classmethod
+    def from_chunks(cls, all_chunks):
+        store = cls()
+        store.add(sorted(all_chunks, key=lambda c: c["id"]))
+        return store
+
+    def estimate_size(self):
+        # Texts stay in the page cache via mmap; rows, sources and unsaved texts are resident
+        view = self._view
+        return view.rows.nbytes + len(view.pending) + 300 * len(view.sources)
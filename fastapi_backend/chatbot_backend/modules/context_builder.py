@@ -0,0 +1,128 @@
+import os
+from modules.embedding_cache import text_hash
+from modules.tokenizer import token_lengths, truncate_tokens
+
+# =============================================================
+# CONTEXT ASSEMBLY
+# =============================================================
+# The ranked lists of the retrievers are combined with reciprocal-rank
+# fusion, chunks with the same text (re-uploads, boilerplate shared by
+# documents) are kept once, and the best chunks are packed into
+# CONTEXT_TOKEN_BUDGET tokens. Neighbouring chunks of the same document (by
+# their position in it, not their id) are merged into one passage without
+# the splitter's overlap, so the overlap isn't paid for twice. The overlap is
+# cut at the chunks' offsets in the source text where those are known. The
+# last chunk that doesn't fit is cut to the remaining budget.
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "600"))
+RRF_K = int(os.getenv("RRF_K", "60"))
+MIN_TRUNCATED_TOKENS = 32
+MAX_OVERLAP_CHARS = 120          # a bit more than the splitter's 80 chars
+MIN_OVERLAP_CHARS = 16           # shorter matches are as likely to be coincidence
+SEPARATOR = "\n\n"
+
+
+def rrf_fuse(rankings, k: int = RRF_K):
+    """Chunk ids ordered by reciprocal-rank fusion of several best-first id lists."""
+    scores = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=lambda chunk_id: -scores[chunk_id])
+
+
+def dedupe_chunks(chunks):
+    """Drop chunks whose text (ignoring whitespace) was already seen; keeps the first."""
+    seen = set()
+    unique = []
+    for c in chunks:
+        digest = text_hash(" ".join(c["text"].split()))
+        if digest not in seen:
+            seen.add(digest)
+            unique.append(c)
+    return unique
+
+
+def _join(a: str, b: str):
+    # b continues a: drop the longest suffix of a that b starts with, if it
+    # is long enough and covers whole words (the splitter overlaps by words)
+    for size in range(min(len(a), len(b), MAX_OVERLAP_CHARS), MIN_OVERLAP_CHARS - 1, -1):
+        if (a.endswith(b[:size]) and (size == len(a) or a[-size - 1].isspace())
+                and (size == len(b) or b[size].isspace())):
+            return a + b[size:]
+    return a + "\n" + b
+
+
+def _end(c):
+    return c["start"] + len(c["text"]) if c.get("start", -1) >= 0 else None
+
+
+def merge_adjacent(chunks):
+    """Group chunks into passages: consecutive positions of one source are joined.
+
+    Passages are returned in the order of their best-ranked chunk.
+    """
+    rank = {c["id"]: i for i, c in enumerate(chunks)}
+    passages = []
+    current = None
+    for c in sorted(chunks, key=lambda c: (c["metadata"].get("source_id") or "", c.get("position", c["id"]))):
+        if (current is not None and c.get("position", c["id"]) == current["position"] + 1
+                and c["metadata"].get("source_id") == current["metadata"].get("source_id")):
+            start = c.get("start", -1)
+            if current["end"] is not None and 0 <= start <= current["end"]:
+                current["text"] += c["text"][current["end"] - start:]
+            elif current["end"] is not None and start > current["end"]:
+                current["text"] += "\n" + c["text"]
+            else:
+                current["text"] = _join(current["text"], c["text"])
+            current["chunk_ids"].append(c["id"])
+            current["position"] = c.get("position", c["id"])
+            current["end"] = max(current["end"], _end(c)) if current["end"] is not None and start >= 0 else None
+            current["rank"] = min(current["rank"], rank[c["id"]])
+        else:
+            current = {"text": c["text"], "metadata": c["metadata"], "chunk_ids": [c["id"]], "rank": rank[c["id"]],
+                       "position": c.get("position", c["id"]), "end": _end(c)}
+            passages.append(current)
+    passages.sort(key=lambda p: p["rank"])
+    return passages
+
+
+class _TokenCounter:
+    # Passages are re-measured as chunks are added; texts repeat a lot
+    def __init__(self):
+        self._memo = {}
+        self.separator = token_lengths([SEPARATOR])[0]
+
+    def __call__(self, passages):
+        missing = [p["text"] for p in passages if p["text"] not in self._memo]
+        if missing:
+            self._memo.update(zip(missing, token_lengths(missing)))
+        tokens = sum(self._memo[p["text"]] for p in passages)
+        return tokens + self.separator * max(0, len(passages) - 1)
+
+
+def build_context(chunks, budget: int = CONTEXT_TOKEN_BUDGET):
+    """Pack ranked chunks ({"id", "text", "metadata"}, best first) into budget tokens.
+
+    Returns the passages, most relevant first, each with its text, the
+    metadata of its first chunk, its chunk ids and its token count.
+    """
+    count = _TokenCounter()
+    selected = []
+    truncated = None
+    for c in dedupe_chunks(chunks):
+        if count(merge_adjacent(selected + [c])) <= budget:
+            selected.append(c)
+            continue
+        remaining = budget - count(merge_adjacent(selected)) - (count.separator if selected else 0)
+        if remaining >= MIN_TRUNCATED_TOKENS:
+            truncated = dict(c, text=truncate_tokens(c["text"], remaining))
+            break
+
+    passages = merge_adjacent(selected)
+    if truncated is not None:
+        passages.append({"text": truncated["text"], "metadata": truncated["metadata"],
+                         "chunk_ids": [truncated["id"]], "rank": len(passages)})
+    for p in passages:
+        p["tokens"] = count([p])
+    return passages
@@ -0,0 +1,169 @@
+import os
+import time
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+# =============================================================
+# EMBEDDING BACKENDS
+# =============================================================
+# EMBEDDING_BACKEND picks the model every tenant index is built with:
+#   openai  OpenAI API (OPENAI_EMBEDDING_MODEL), one network call per request
+#   local   sentence-transformers model on CPU (LOCAL_EMBEDDING_MODEL), with
+#           LOCAL_EMBEDDING_RUNTIME=onnx for the ONNX export of the model
+#
+# The model id returned by create_embeddings() is recorded in each tenant's
+# manifest; vectors of different models are never mixed in one index.
+
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "openai")
+OPENAI_EMBEDDING_MODEL = os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-3-small")
+LOCAL_EMBEDDING_MODEL = os.getenv("LOCAL_EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+LOCAL_EMBEDDING_RUNTIME = os.getenv("LOCAL_EMBEDDING_RUNTIME", "torch")   # torch | onnx
+LOCAL_EMBED_THREADS = int(os.getenv("LOCAL_EMBED_THREADS", "2"))
+LOCAL_EMBED_BATCH = int(os.getenv("LOCAL_EMBED_BATCH", "64"))
+
+# Concurrent query embeddings are collected for up to QUERY_BATCH_WAIT_MS
+# (0 disables) and encoded together, at most QUERY_BATCH_MAX at a time
+QUERY_BATCH_WAIT_MS = float(os.getenv("QUERY_BATCH_WAIT_MS", "2"))
+QUERY_BATCH_MAX = int(os.getenv("QUERY_BATCH_MAX", "32"))
+
+# Tenants indexed before the model was recorded used this one
+LEGACY_EMBEDDING_MODEL = "text-embedding-3-small"
+
+
+class LocalEmbeddings(Embeddings):
+    """sentence-transformers model on CPU.
+
+    Large inputs are split into LOCAL_EMBED_BATCH sized batches that are
+    encoded on a thread pool (inference releases the GIL). The model is
+    loaded on first use.
+    """
+
+    def __init__(self, model_name: str = LOCAL_EMBEDDING_MODEL, runtime: str = LOCAL_EMBEDDING_RUNTIME,
+                 threads: int = LOCAL_EMBED_THREADS, batch_size: int = LOCAL_EMBED_BATCH):
+        self.model_name = model_name
+        self.runtime = runtime
+        self.batch_size = batch_size
+        self._model = None
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max(1, threads), thread_name_prefix="embed")
+
+    def _load(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    try:
+                        from sentence_transformers import SentenceTransformer
+                    except ImportError as e:
+                        raise RuntimeError(
+                            "EMBEDDING_BACKEND=local needs sentence-transformers (pip install sentence-transformers)"
+                        ) from e
+                    kwargs = {"backend": "onnx"} if self.runtime == "onnx" else {}
+                    self._model = SentenceTransformer(self.model_name, device="cpu", **kwargs)
+                    print(f"✅ Loaded local embedding model {self.model_name} ({self.runtime})")
+        return self._model
+
+    def _encode(self, texts):
+        vectors = self._load().encode(
+            list(texts), batch_size=self.batch_size, normalize_embeddings=True,
+            convert_to_numpy=True, show_progress_bar=False,
+        )
+        return np.asarray(vectors, dtype=np.float32).tolist()
+
+    def embed_documents(self, texts):
+        texts = list(texts)
+        if len(texts) <= self.batch_size:
+            return self._encode(texts)
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        vectors = []
+        for part in self._pool.map(self._encode, batches):
+            vectors.extend(part)
+        return vectors
+
+    def embed_query(self, text):
+        return self._encode([text])[0]
+
+
+class QueryBatcher(Embeddings):
+    """Coalesces concurrent embed_query calls into one embed_documents call.
+
+    A single worker takes the first waiting query, collects whatever else
+    arrives within max_wait (up to max_batch) and encodes them together.
+    While a batch is being encoded the next one fills up.
+    """
+
+    def __init__(self, underlying: Embeddings, max_wait: float = QUERY_BATCH_WAIT_MS / 1000, max_batch: int = QUERY_BATCH_MAX):
+        self.underlying = underlying
+        self.max_wait = max_wait
+        self.max_batch = max(1, max_batch)
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.queries = 0
+
+    def embed_documents(self, texts):
+        return self.underlying.embed_documents(texts)
+
+    def embed_query(self, text):
+        if self.max_wait <= 0:
+            return self.underlying.embed_query(text)
+        if self._worker is None:
+            with self._lock:
+                if self._worker is None:
+                    self._worker = threading.Thread(target=self._run, name="query-batcher", daemon=True)
+                    self._worker.start()
+        future = Future()
+        self._queue.put((text, future))
+        return future.result()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            texts = [text for text, _ in batch]
+            try:
+                if len(texts) == 1:
+                    vectors = [self.underlying.embed_query(texts[0])]
+                else:
+                    vectors = self.underlying.embed_documents(texts)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.queries += len(batch)
+            for (_, future), vector in zip(batch, vectors):
+                future.set_result(vector)
+
+    def stats(self):
+        return {
+            "wait_ms": self.max_wait * 1000,
+            "max_batch": self.max_batch,
+            "batches": self.batches,
+            "queries": self.queries,
+            "queries_per_batch": self.queries / self.batches if self.batches else 0.0,
+        }
+
+
+def create_embeddings(backend: str = EMBEDDING_BACKEND):
+    """The configured backend and the model id recorded in tenant indexes."""
+    if backend == "openai":
+        from langchain_openai import OpenAIEmbeddings
+        return OpenAIEmbeddings(model=OPENAI_EMBEDDING_MODEL), OPENAI_EMBEDDING_MODEL
+    if backend == "local":
+        # The ONNX export produces the same vectors, so the runtime isn't part of the id
+        return QueryBatcher(LocalEmbeddings()), f"local:{LOCAL_EMBEDDING_MODEL}"
+    raise ValueError(f"Unknown EMBEDDING_BACKEND {backend!r} (expected openai or local)")
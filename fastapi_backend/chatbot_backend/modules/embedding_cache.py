@@ -0,0 +1,185 @@
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from modules.rate_limiter import count_tokens
+from modules.metrics import METRICS_ENABLED, model_call
+
+# =============================================================
+# CONTENT-ADDRESSED EMBEDDING CACHE
+# =============================================================
+# Vectors are stored in SQLite keyed by (model, sha256(text)) and shared by
+# every tenant, so re-uploads, re-crawls and boilerplate repeated across
+# tenants are only embedded once. The least recently used entries are evicted
+# once the stored vectors exceed EMBEDDING_CACHE_MAX_BYTES.
+
+CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "data/embedding_cache.sqlite3")
+MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+
+
+def text_hash(text: str):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, path: str = CACHE_PATH, max_bytes: int = MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = None
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS embeddings (
+                    model TEXT NOT NULL,
+                    hash TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (model, hash)
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+            self._bytes = conn.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()[0]
+            self._conn = conn
+        return self._conn
+
+    def get_many(self, model: str, hashes):
+        """Return {hash: vector} for the hashes that are cached."""
+        found = {}
+        unique = list(dict.fromkeys(hashes))
+        with self._lock:
+            conn = self._connect()
+            for start in range(0, len(unique), 500):
+                batch = unique[start:start + 500]
+                marks = ",".join("?" * len(batch))
+                rows = conn.execute(
+                    f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({marks})",
+                    [model, *batch],
+                ).fetchall()
+                for h, blob in rows:
+                    found[h] = np.frombuffer(blob, dtype=np.float32)
+
+            if found:
+                now = time.time()
+                conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND hash = ?",
+                    [(now, model, h) for h in found],
+                )
+                conn.commit()
+
+            self.hits += sum(1 for h in hashes if h in found)
+            self.misses += sum(1 for h in hashes if h not in found)
+        return found
+
+    def put_many(self, model: str, items):
+        """Store an iterable of (hash, vector) pairs."""
+        now = time.time()
+        rows = [(model, h, np.asarray(v, dtype=np.float32).tobytes(), now) for h, v in items]
+        if not rows:
+            return
+        with self._lock:
+            conn = self._connect()
+            for row in rows:
+                cur = conn.execute(
+                    "INSERT OR IGNORE INTO embeddings (model, hash, vector, last_used) VALUES (?, ?, ?, ?)",
+                    row,
+                )
+                if cur.rowcount == 1:
+                    self._bytes += len(row[2])
+            if self._bytes > self.max_bytes:
+                self._evict(conn)
+            conn.commit()
+
+    def _evict(self, conn):
+        # Drop least recently used entries down to 90% of the budget
+        target = int(self.max_bytes * 0.9)
+        while self._bytes > target:
+            rows = conn.execute(
+                "SELECT model, hash, LENGTH(vector) FROM embeddings ORDER BY last_used LIMIT 256"
+            ).fetchall()
+            if not rows:
+                break
+            for model, h, size in rows:
+                if self._bytes <= target:
+                    break
+                conn.execute("DELETE FROM embeddings WHERE model = ? AND hash = ?", (model, h))
+                self._bytes -= size
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            conn = self._connect()
+            entries = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "entries": entries,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+embedding_cache = EmbeddingCache()
+
+
+class CachedEmbeddings(Embeddings):
+    """Wraps an Embeddings model and serves document vectors from the cache."""
+
+    def __init__(self, underlying: Embeddings, model_name: str, cache: EmbeddingCache = embedding_cache, limiter=None):
+        self.underlying = underlying
+        self.model_name = model_name
+        self.cache = cache
+        self.limiter = limiter   # TokenRateLimiter for calls that reach the model
+
+    def embed_documents(self, texts):
+        hashes = [text_hash(t) for t in texts]
+        found = self.cache.get_many(self.model_name, hashes)
+
+        # Embed each missing text once, even if it repeats within the batch
+        missing = {}
+        for h, t in zip(hashes, texts):
+            if h not in found and h not in missing:
+                missing[h] = t
+
+        if missing:
+            vectors = self._embed_many(list(missing.values()), "documents")
+            new = dict(zip(missing.keys(), vectors))
+            self.cache.put_many(self.model_name, new.items())
+            found.update({h: np.asarray(v, dtype=np.float32) for h, v in new.items()})
+
+        return [found[h].tolist() for h in hashes]
+
+    def _embed_many(self, texts, purpose: str):
+        tokens = count_tokens(texts) if self.limiter is not None or METRICS_ENABLED else 0
+        with model_call("embedding", self.model_name, purpose) as call:
+            call.add_tokens(tokens)
+            if self.limiter is not None:
+                with self.limiter.acquire(tokens):
+                    return self.underlying.embed_documents(texts)
+            return self.underlying.embed_documents(texts)
+
+    def embed_queries(self, texts):
+        """Several one-off texts in one call; like queries they bypass the cache."""
+        return self._embed_many(list(texts), "queries")
+
+    def embed_query(self, text):
+        # Queries are mostly unique, so they go straight to the model
+        with model_call("embedding", self.model_name, "query") as call:
+            if METRICS_ENABLED:
+                call.add_tokens(count_tokens([text]))
+            return self.underlying.embed_query(text)
@@ -0,0 +1,349 @@
+import os
+import uuid
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from modules.pdf_processor import process_pdf_auto
+from modules.web_loader import load_website
+from modules.web_crawler import crawl, load_crawl_state, update_crawl_state, state_entry, CRAWL_MAX_PAGES, CRAWL_MAX_DEPTH
+from modules.rag import (
+    split_document, embed_chunks, commit_chunks, delete_document, get_tenant_dir, plan_update, commit_updates,
+    embed_texts, embedding_model_id, get_embedding_status, reindex_snapshot, commit_reindex,
+    vector_index_info, vector_snapshot, commit_vector_index, get_search_params
+)
+from modules.ann_index import plan, needs_rebuild, recall_report, append_report
+from modules.jobs import job_queue
+from modules.vector_index import VectorIndex
+from modules.embedding_cache import text_hash
+from modules.rate_limiter import token_lengths, EMBED_CONCURRENCY
+
+BATCH_EXTRACT_WORKERS = int(os.getenv("BATCH_EXTRACT_WORKERS", "4"))
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "1000"))
+EMBED_BATCH_TOKENS = int(os.getenv("EMBED_BATCH_TOKENS", "250000"))
+
+# =============================================================
+# INGESTION PIPELINES (run as background jobs)
+# =============================================================
+# Each function takes the Job first so every stage is timed and reported on
+# /jobs/{id}; the return value becomes the job result.
+
+def index_text(job, tenant_id: str, text: str, source_id: str, file_name=None, url=None, doc_type="pdf", content_hash=None, replace=False):
+    """Index one document; with replace, update source_id and embed only changed chunks."""
+    with job.stage("chunk") as info:
+        full_chunks = split_document(
+            tenant_id, text, source_id, file_name=file_name, url=url, doc_type=doc_type, content_hash=content_hash
+        )
+        info["total"] = info["done"] = len(full_chunks)
+
+    if replace and not full_chunks:
+        with job.stage("commit"):
+            delete_document(tenant_id, source_id)
+        return {"id": source_id, "chunks": 0}
+
+    with job.stage("embed") as info:
+        to_embed = plan_update(tenant_id, source_id, full_chunks) if replace else full_chunks
+        vecs = embed_chunks(to_embed) if to_embed else []
+        info["total"] = info["done"] = len(vecs)
+
+    with job.stage("commit"):
+        if replace:
+            new_vectors = {text_hash(c["text"]): v for c, v in zip(to_embed, vecs)}
+            change = commit_updates(tenant_id, [(source_id, full_chunks)], new_vectors)[0]
+        else:
+            commit_chunks(tenant_id, full_chunks, vecs)
+    maybe_rebuild_vector_index(tenant_id)
+
+    result = {"id": source_id, "chunks": len(full_chunks)}
+    if replace:
+        result.update(change)
+    return result
+
+
+def ingest_pdf(job, tenant_id: str, file_path: str, source_id: str, file_name: str, content_hash=None, replace=False):
+    with job.stage("extract"):
+        text = process_pdf_auto(file_path, progress=job.progress, content_hash=content_hash)
+
+    result = index_text(job, tenant_id, text, source_id, file_name=file_name, doc_type="pdf", content_hash=content_hash, replace=replace)
+    result["name"] = file_name
+    return result
+
+
+def ingest_url(job, tenant_id: str, url: str, source_id: str, replace=False):
+    with job.stage("extract"):
+        text = load_website(url)
+
+    result = index_text(job, tenant_id, text, source_id, url=url, doc_type="website", replace=replace)
+    result["url"] = url
+    return result
+
+
+# =============================================================
+# BATCH INGESTION
+# =============================================================
+# One job for many files and URLs: extraction runs in parallel, the chunks
+# of all documents are packed into large embedding requests (rate limited
+# by the embedding limiter) and the tenant index is committed once.
+
+def _extract(item):
+    if item["type"] == "website":
+        return load_website(item["url"])
+    return process_pdf_auto(item["file_path"], content_hash=item.get("content_hash"))
+
+
+def pack_batches(lengths, max_texts: int = EMBED_BATCH_SIZE, max_tokens: int = EMBED_BATCH_TOKENS):
+    """Split consecutive texts into (start, end) ranges within both limits."""
+    batches = []
+    start, tokens = 0, 0
+    for i, n in enumerate(lengths):
+        if i > start and (i - start >= max_texts or tokens + n > max_tokens):
+            batches.append((start, i))
+            start, tokens = i, 0
+        tokens += n
+    if start < len(lengths):
+        batches.append((start, len(lengths)))
+    return batches
+
+
+def _fail(result, error):
+    result["status"] = "failed"
+    result["error"] = str(error)
+
+
+def _new_results(items):
+    return [
+        {"id": item["id"], "type": item["type"], "name": item.get("name") or item.get("url"), "status": "pending", "chunks": 0, "error": None}
+        for item in items
+    ]
+
+
+def ingest_batch(job, tenant_id: str, items):
+    """items: dicts with id, type ("pdf" or "website"), name, and file_path/content_hash or url."""
+    results = _new_results(items)
+    texts = [None] * len(items)
+
+    with job.stage("extract") as info:
+        info["total"] = len(items)
+        with ThreadPoolExecutor(max_workers=max(1, min(BATCH_EXTRACT_WORKERS, len(items)))) as pool:
+            futures = {pool.submit(_extract, item): i for i, item in enumerate(items)}
+            for done, future in enumerate(as_completed(futures), 1):
+                i = futures[future]
+                try:
+                    texts[i] = future.result()
+                except Exception as e:
+                    _fail(results[i], e)
+                info["done"] = done
+
+    return index_batch(job, tenant_id, items, texts, results)
+
+
+def index_batch(job, tenant_id: str, items, texts, results=None, replace=False):
+    """Chunk, embed and commit already extracted texts (one per item) in one go.
+
+    With replace, each item updates the source with its id and only chunks
+    that aren't stored for it yet are embedded.
+    """
+    results = results or _new_results(items)
+    item_chunks = {}                   # item index -> all chunks of the item
+
+    with job.stage("chunk") as info:
+        all_chunks, owners = [], []   # chunks to embed; owners[k]: index of the item chunk k came from
+        for i, item in enumerate(items):
+            if results[i]["status"] == "failed":
+                continue
+            full_chunks = split_document(
+                tenant_id, texts[i] or "", item["id"], file_name=item.get("name"), url=item.get("url"),
+                doc_type=item["type"], content_hash=item.get("content_hash")
+            )
+            if not full_chunks:
+                _fail(results[i], "No text extracted")
+                continue
+            item_chunks[i] = full_chunks
+            results[i]["chunks"] = len(full_chunks)
+            to_embed = plan_update(tenant_id, item["id"], full_chunks) if replace else full_chunks
+            all_chunks.extend(to_embed)
+            owners.extend([i] * len(to_embed))
+        info["total"] = info["done"] = len(all_chunks)
+
+    with job.stage("embed") as info:
+        lengths = token_lengths([c["text"] for c in all_chunks])
+        batches = pack_batches(lengths)
+        vecs = [None] * len(all_chunks)
+        info["total"] = len(all_chunks)
+
+        with ThreadPoolExecutor(max_workers=max(1, min(EMBED_CONCURRENCY, len(batches)))) as pool:
+            futures = {pool.submit(embed_chunks, all_chunks[a:b]): (a, b) for a, b in batches}
+            for future in as_completed(futures):
+                a, b = futures[future]
+                try:
+                    vecs[a:b] = future.result()
+                except Exception as e:
+                    for i in set(owners[a:b]):
+                        _fail(results[i], e)
+                info["done"] += b - a
+
+    with job.stage("commit"):
+        ok = [i for i in item_chunks if results[i]["status"] != "failed"]
+        keep = [k for k in range(len(all_chunks)) if results[owners[k]]["status"] != "failed"]
+        if replace:
+            new_vectors = {text_hash(all_chunks[k]["text"]): vecs[k] for k in keep}
+            changes = commit_updates(tenant_id, [(items[i]["id"], item_chunks[i]) for i in ok], new_vectors)
+            for i, change in zip(ok, changes):
+                results[i].update(change)
+        else:
+            commit_chunks(tenant_id, [all_chunks[k] for k in keep], [vecs[k] for k in keep])
+        for r in results:
+            if r["status"] != "failed":
+                r["status"] = "indexed"
+            else:
+                r["chunks"] = 0
+    maybe_rebuild_vector_index(tenant_id)
+
+    run_seconds = sum(s["seconds"] or 0 for s in job.stages.values())
+    embed_seconds = job.stages["embed"]["seconds"] or 0
+    embed_tokens = sum(lengths[k] for k in keep)
+    chunks = sum(len(item_chunks[i]) for i in ok)
+    return {
+        "items": results,
+        "stats": {
+            "items": len(items),
+            "indexed": len(ok),
+            "failed": sum(1 for r in results if r["status"] == "failed"),
+            "chunks": chunks,
+            "embedded_chunks": len(keep),
+            "embed_batches": len(batches),
+            "embed_tokens": embed_tokens,
+            "seconds": round(run_seconds, 3),
+            "chunks_per_second": round(chunks / run_seconds, 2) if run_seconds else None,
+            "embed_tokens_per_second": round(embed_tokens / embed_seconds, 2) if embed_seconds else None,
+        },
+    }
+
+
+# =============================================================
+# SITE CRAWL
+# =============================================================
+# New and changed pages go through index_batch as updates of the page's
+# source, so an edited page only re-embeds the chunks that changed. Pages
+# that are gone are deleted. Pages that fail to index lose their stored hash
+# so the next crawl retries them.
+
+def ingest_crawl(job, tenant_id: str, seed: str, max_pages: int = CRAWL_MAX_PAGES, max_depth: int = CRAWL_MAX_DEPTH, sitemap=None):
+    state_path = os.path.join(get_tenant_dir(tenant_id), "crawl_state.json")
+    previous = load_crawl_state(state_path)
+
+    with job.stage("crawl"):
+        pages = asyncio.run(crawl(seed, previous, max_pages=max_pages, max_depth=max_depth, sitemap=sitemap, progress=job.progress))
+
+    updates, removed = {}, []
+    for page in pages:
+        old = previous.get(page["url"]) or {}
+        if page["status"] == "unchanged":
+            updates[page["url"]] = state_entry(page, old.get("source_id"))
+        elif page["status"] == "gone":
+            if old.get("source_id"):
+                delete_document(tenant_id, old["source_id"])
+            removed.append(page["url"])
+
+    # A page keeps its source id across versions
+    fresh = [p for p in pages if p["status"] in ("new", "changed")]
+    items = [
+        {"id": (previous.get(p["url"]) or {}).get("source_id") or str(uuid.uuid4()), "type": "website", "url": p["url"]}
+        for p in fresh
+    ]
+    indexed = index_batch(job, tenant_id, items, [p["text"] for p in fresh], replace=True) if items else {"items": [], "stats": {}}
+    for page, item, result in zip(fresh, items, indexed["items"]):
+        entry = state_entry(page, item["id"])
+        if result["status"] != "indexed":
+            # Not indexed: fetch it in full on the next crawl
+            entry["hash"] = entry["etag"] = entry["last_modified"] = None
+        updates[page["url"]] = entry
+
+    update_crawl_state(state_path, updates, removed)
+
+    counts = {}
+    for page in pages:
+        counts[page["status"]] = counts.get(page["status"], 0) + 1
+    return {
+        "seed": seed,
+        "pages": counts,
+        "failed": [{"url": p["url"], "error": p["error"]} for p in pages if p["status"] == "failed"],
+        "items": indexed["items"],
+        "stats": indexed["stats"],
+    }
+
+
+# =============================================================
+# RE-INDEX
+# =============================================================
+# Re-embeds every chunk of a tenant with the current embedding model, packed
+# into batches like a bulk ingest, and swaps the vector index in one commit.
+
+def reindex_tenant(job, tenant_id: str):
+    previous = get_embedding_status(tenant_id)["model"]
+    model = embedding_model_id()
+
+    with job.stage("read") as info:
+        ids, texts = reindex_snapshot(tenant_id)
+        info["total"] = info["done"] = len(ids)
+
+    with job.stage("embed") as info:
+        lengths = token_lengths(texts)
+        batches = pack_batches(lengths)
+        vecs = [None] * len(texts)
+        info["total"] = len(texts)
+
+        with ThreadPoolExecutor(max_workers=max(1, min(EMBED_CONCURRENCY, len(batches)))) as pool:
+            futures = {pool.submit(embed_texts, texts[a:b]): (a, b) for a, b in batches}
+            for future in as_completed(futures):
+                a, b = futures[future]
+                vecs[a:b] = future.result()
+                info["done"] += b - a
+
+    with job.stage("commit"):
+        count = commit_reindex(tenant_id, model, ids, vecs)
+    maybe_rebuild_vector_index(tenant_id)
+
+    embed_seconds = job.stages["embed"]["seconds"] or 0
+    return {
+        "previous_model": previous,
+        "model": model,
+        "chunks": count,
+        "embed_batches": len(batches),
+        "embed_tokens": sum(lengths),
+        "chunks_per_second": round(len(texts) / embed_seconds, 2) if embed_seconds else None,
+    }
+
+
+# =============================================================
+# APPROXIMATE VECTOR INDEX
+# =============================================================
+def maybe_rebuild_vector_index(tenant_id: str):
+    """Queue rebuild_vector_index when the tenant outgrew its vector index."""
+    if job_queue.find(tenant_id, ann_rebuild=True) or not needs_rebuild(vector_index_info(tenant_id)):
+        return None
+    return job_queue.submit(tenant_id, "ann_rebuild", rebuild_vector_index, tenant_id, meta={"ann_rebuild": True})
+
+
+def rebuild_vector_index(job, tenant_id: str):
+    """Train an approximate index from the stored vectors (nothing is re-embedded) and swap it in."""
+    with job.stage("read") as info:
+        snapshot = vector_snapshot(tenant_id)
+        if snapshot is None or not needs_rebuild(snapshot[2]):
+            return {"status": "skipped", "index": snapshot[2] if snapshot else None}
+        ids, vectors, before, model = snapshot
+        info["total"] = info["done"] = len(ids)
+
+    params = plan(len(ids), vectors.shape[1])
+    with job.stage("train"):
+        index = VectorIndex.train_ivf(ids, vectors, params["nlist"], params["pq_m"])
+
+    with job.stage("evaluate"):
+        report = recall_report(index, ids, vectors)
+        report["previous_index"] = before
+        nprobe = get_search_params(tenant_id).get("nprobe") or report["chosen_nprobe"]
+        index.set_search_params(nprobe=nprobe)
+
+    with job.stage("commit"):
+        caught_up = commit_vector_index(tenant_id, index, ids, model)
+        append_report(get_tenant_dir(tenant_id), report)
+
+    return {"status": "rebuilt", "index": index.describe(), "caught_up": caught_up, "report": report}
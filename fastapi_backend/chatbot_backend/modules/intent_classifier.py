@@ -1,5 +1,8 @@
+import re
+import threading
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
+from modules.metrics import model_call
 
 llm = ChatOpenAI(model="gpt-4o-mini")
 
@@ -19,6 +22,100 @@ Query: {query}
 Return ONLY ONE LABEL.
 """)
 
+# =============================================================
+# LOCAL FAST PATH
+# =============================================================
+# Most messages are either a bare greeting or an obvious question. Those are
+# decided locally; only short, ambiguous messages go to the LLM.
+#
+# Greeting, thanks and small-talk phrases are taken out first. A message that
+# is nothing but those (and words like "there" or "team") is a greeting; a
+# greeting followed by something else ("hi, my order is late") is left to the
+# LLM, the rules below only judge messages without one.
+
+GREETING_PHRASES = {
+    "assalam o alaikum", "assalamu alaikum", "assalam alaikum", "asalam o alaikum",
+    "salam alaikum", "as salam o alaikum", "good morning", "good afternoon",
+    "good evening", "good day", "whats up", "what's up", "how are you",
+    "how are you doing", "how r u", "hope you are well", "hope you're well",
+    "hope you are doing well", "hope you're doing well", "nice to meet you",
+    "thank you", "thank you so much", "thank you very much", "thanks a lot",
+    "thanks so much", "many thanks", "much appreciated",
+}
+
+GREETING_WORDS = {
+    "hi", "hii", "hello", "helo", "hey", "heya", "hiya", "yo", "howdy",
+    "greetings", "salam", "salaam", "aoa", "slm", "assalam", "assalamualaikum",
+    "thanks", "thx", "ty",
+}
+
+# Only part of a greeting when they come with one ("hi there", "morning team")
+ADDRESS_WORDS = {
+    "there", "sir", "madam", "maam", "dear", "team", "bot", "all", "everyone",
+    "morning", "afternoon", "evening", "good",
+}
+
+QUESTION_WORDS = {
+    "what", "when", "where", "which", "who", "whom", "whose", "why", "how",
+    "can", "could", "does", "do", "is", "are", "will", "should", "may",
+    "tell", "explain", "list", "give", "show", "i", "my", "need", "want",
+}
+
+_PHRASE_PATTERN = re.compile(
+    r"\b(?:" + "|".join(re.escape(p) for p in sorted(GREETING_PHRASES, key=len, reverse=True)) + r")\b"
+)
+
+_stats = {"lexicon": 0, "rules": 0, "llm": 0}
+_stats_lock = threading.Lock()
+
+def normalize(query: str):
+    text = query.lower().strip()
+    text = re.sub(r"(.)\1{2,}", r"\1", text)   # "hiii" -> "hi", "heyyy" -> "hey"
+    text = re.sub(r"[^\w\s'?]", " ", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+def classify_local(query: str):
+    """Return (intent, tier) when the message is unambiguous, else (None, None)."""
+    text = normalize(query)
+    if not text:
+        return "greeting", "lexicon"
+
+    rest, phrases = _PHRASE_PATTERN.subn(" ", text)
+    words = rest.replace("?", " ").split()
+    greeted = phrases > 0 or any(w in GREETING_WORDS for w in words)
+    content_words = [w for w in words if w not in GREETING_WORDS and w not in ADDRESS_WORDS]
+
+    if not content_words:
+        return "greeting", "lexicon"
+    if greeted:
+        return None, None
+
+    if "?" in text or content_words[0] in QUESTION_WORDS or len(content_words) >= 2:
+        return "rag_query", "rules"
+
+    return None, None
+
+def _record(tier: str):
+    with _stats_lock:
+        _stats[tier] += 1
+
 def get_intent(query):
-    result = llm.invoke(intent_prompt.format(query=query))
-    return result.content.strip()
+    intent, tier = classify_local(query)
+    if intent is not None:
+        _record(tier)
+        return intent
+
+    _record("llm")
+    with model_call("llm", llm, "intent") as call:
+        result = llm.invoke(intent_prompt.format(query=query))
+        call.record(result)
+    label = result.content.strip().lower()
+    return "greeting" if "greeting" in label else "rag_query"
+
+def get_intent_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    total = sum(stats.values())
+    stats["total"] = total
+    stats["llm_share"] = stats["llm"] / total if total else 0.0
+    return stats
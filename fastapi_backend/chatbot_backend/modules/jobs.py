@@ -0,0 +1,165 @@
+import os
+import time
+import uuid
+import threading
+import traceback
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from modules.metrics import record_stage
+
+# =============================================================
+# BACKGROUND JOB QUEUE
+# =============================================================
+# Ingestion runs on a bounded worker pool instead of inside the request
+# handler. Each tenant may only occupy PER_TENANT_LIMIT workers at a time;
+# its remaining jobs wait in a per-tenant queue so a bulk upload from one
+# tenant can't take every worker away from the others. Jobs of the same tenant
+# may overlap: their commits are serialized (and batched) by rag's
+# write coordinator.
+
+MAX_WORKERS = int(os.getenv("INGEST_WORKERS", "4"))
+PER_TENANT_LIMIT = int(os.getenv("INGEST_PER_TENANT", "2"))
+MAX_FINISHED_JOBS = int(os.getenv("INGEST_JOB_HISTORY", "1000"))
+
+
+class Job:
+    def __init__(self, tenant_id: str, kind: str, meta=None):
+        self.id = str(uuid.uuid4())
+        self.tenant_id = tenant_id
+        self.kind = kind
+        self.meta = meta or {}
+        self.state = "queued"
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.stages = OrderedDict()
+        self.current_stage = None
+        self.result = None
+        self.error = None
+
+    @contextmanager
+    def stage(self, name: str):
+        info = {"state": "running", "started_at": time.time(), "seconds": None, "done": 0, "total": None}
+        self.stages[name] = info
+        self.current_stage = name
+        start = time.perf_counter()
+        try:
+            yield info
+            info["state"] = "done"
+        except Exception:
+            info["state"] = "failed"
+            raise
+        finally:
+            info["seconds"] = round(time.perf_counter() - start, 4)
+            record_stage(f"ingest_{name}", info["seconds"], self.tenant_id)
+            self.current_stage = None
+
+    def progress(self, done: int, total: int = None):
+        info = self.stages.get(self.current_stage)
+        if info is not None:
+            info["done"] = done
+            info["total"] = total
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "tenant_id": self.tenant_id,
+            "kind": self.kind,
+            "state": self.state,
+            "meta": self.meta,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "queued_seconds": round((self.started_at or time.time()) - self.created_at, 4),
+            "run_seconds": round(self.finished_at - self.started_at, 4) if self.finished_at and self.started_at else None,
+            "stages": dict(self.stages),
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class JobQueue:
+    def __init__(self, max_workers: int = MAX_WORKERS, per_tenant: int = PER_TENANT_LIMIT):
+        self.per_tenant = per_tenant
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ingest")
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()     # job id -> Job
+        self._running = {}             # tenant_id -> number of running jobs
+        self._pending = {}             # tenant_id -> deque of (job, fn, args)
+
+    def submit(self, tenant_id: str, kind: str, fn, *args, meta=None):
+        """Queue fn(job, *args); its return value becomes job.result."""
+        job = Job(tenant_id, kind, meta)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._trim()
+            if self._running.get(tenant_id, 0) < self.per_tenant:
+                self._start(job, fn, args)
+            else:
+                self._pending.setdefault(tenant_id, deque()).append((job, fn, args))
+        return job
+
+    def get(self, job_id: str):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def find(self, tenant_id: str, **meta):
+        """Return the newest unfinished job of a tenant whose meta matches."""
+        with self._lock:
+            for job in reversed(self._jobs.values()):
+                if job.tenant_id != tenant_id or job.state not in ("queued", "running"):
+                    continue
+                if all(job.meta.get(k) == v for k, v in meta.items()):
+                    return job
+        return None
+
+    def _start(self, job, fn, args):
+        # Called with the lock held
+        self._running[job.tenant_id] = self._running.get(job.tenant_id, 0) + 1
+        self._executor.submit(self._run, job, fn, args)
+
+    def _run(self, job, fn, args):
+        job.state = "running"
+        job.started_at = time.time()
+        try:
+            job.result = fn(job, *args)
+            job.state = "succeeded"
+        except Exception as e:
+            traceback.print_exc()
+            job.error = str(e)
+            job.state = "failed"
+        finally:
+            job.finished_at = time.time()
+            self._release(job.tenant_id)
+
+    def _release(self, tenant_id):
+        with self._lock:
+            self._running[tenant_id] -= 1
+            pending = self._pending.get(tenant_id)
+            if pending:
+                self._start(*pending.popleft())
+            if not pending:
+                self._pending.pop(tenant_id, None)
+            if not self._running[tenant_id]:
+                del self._running[tenant_id]
+
+    def _trim(self):
+        # Forget the oldest finished jobs once the history is full
+        finished = [j.id for j in self._jobs.values() if j.state in ("succeeded", "failed")]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job_id]
+
+    def stats(self):
+        with self._lock:
+            states = {}
+            for job in self._jobs.values():
+                states[job.state] = states.get(job.state, 0) + 1
+            return {
+                "jobs": states,
+                "running_by_tenant": dict(self._running),
+                "pending_by_tenant": {t: len(q) for t, q in self._pending.items()},
+            }
+
+
+job_queue = JobQueue()
@@ -0,0 +1,256 @@
+import os
+import time
+import threading
+from contextvars import ContextVar
+
+# =============================================================
+# STAGE TIMINGS AND PROMETHEUS METRICS
+# =============================================================
+# stage(name, tenant_id) times one step of the query or ingestion path into
+# the chatbot_stage_seconds histogram. While an HTTP request is being served
+# the same timings are collected for its Server-Timing response header.
+# model_call() records latency and token counts of LLM and embedding calls.
+# Everything is exported in the Prometheus text format by render().
+#
+# With METRICS_ENABLED=0 stage() and model_call() return a shared no-op
+# object and the middleware passes requests straight through.
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+# Per-tenant labels; turn off when there are too many tenants to scrape
+METRICS_PER_TENANT = os.getenv("METRICS_PER_TENANT", "1") == "1"
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_request_timings = ContextVar("request_timings", default=None)
+
+
+class _Registry:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._help = {}
+        self._histograms = {}   # name -> {labels: [count per bucket..., +Inf count, sum]}
+        self._counters = {}     # name -> {labels: value}
+
+    def describe(self, name: str, kind: str, text: str):
+        self._help[name] = (kind, text)
+
+    def observe(self, name: str, value: float, labels):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            row = series.get(labels)
+            if row is None:
+                row = series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            row[i] += 1
+            row[-1] += value
+
+    def inc(self, name: str, value: float, labels):
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[labels] = series.get(labels, 0) + value
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def render(self):
+        with self._lock:
+            histograms = {name: {k: list(v) for k, v in s.items()} for name, s in self._histograms.items()}
+            counters = {name: dict(s) for name, s in self._counters.items()}
+
+        lines = []
+        for name in sorted(set(self._help) | set(histograms) | set(counters)):
+            kind, text = self._help.get(name, ("untyped", ""))
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, row in sorted(histograms.get(name, {}).items(), key=str):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), row[:-1]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels(labels, le=bound)} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {row[-1]:.6f}")
+                lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+            for labels, value in sorted(counters.get(name, {}).items(), key=str):
+                lines.append(f"{name}{_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels, le=None):
+    # labels is a tuple of (key, value); empty values are left out
+    pairs = [f'{k}="{_escape(v)}"' for k, v in labels if v not in (None, "")]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+registry = _Registry()
+registry.describe("chatbot_stage_seconds", "histogram", "Time spent per stage of the query and ingestion paths.")
+registry.describe("chatbot_http_request_seconds", "histogram", "HTTP request latency up to the end of the response.")
+registry.describe("chatbot_model_call_seconds", "histogram", "Latency of LLM and embedding API calls.")
+registry.describe("chatbot_model_tokens_total", "counter", "Tokens sent to and received from the models.")
+
+# =============================================================
+# STAGES
+# =============================================================
+class _Noop:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def record(self, message):
+        pass
+
+    def add_tokens(self, input_tokens: int = 0, output_tokens: int = 0):
+        pass
+
+
+_NOOP = _Noop()
+
+
+def _tenant(tenant_id):
+    return tenant_id if METRICS_PER_TENANT else None
+
+
+def record_stage(name: str, seconds: float, tenant_id: str = None):
+    """Record an already measured stage."""
+    if not METRICS_ENABLED:
+        return
+    registry.observe("chatbot_stage_seconds", seconds, (("stage", name), ("tenant", _tenant(tenant_id))))
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.append((name, seconds))
+
+
+class _Stage:
+    __slots__ = ("name", "tenant_id", "start")
+
+    def __init__(self, name, tenant_id):
+        self.name = name
+        self.tenant_id = tenant_id
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record_stage(self.name, time.perf_counter() - self.start, self.tenant_id)
+        return False
+
+
+def stage(name: str, tenant_id: str = None):
+    """Context manager timing one stage."""
+    if not METRICS_ENABLED:
+        return _NOOP
+    return _Stage(name, tenant_id)
+
+# =============================================================
+# MODEL CALLS
+# =============================================================
+class _ModelCall:
+    __slots__ = ("kind", "model", "purpose", "start", "input_tokens", "output_tokens")
+
+    def __init__(self, kind, model, purpose):
+        self.kind = kind
+        self.model = model
+        self.purpose = purpose
+        self.input_tokens = 0
+        self.output_tokens = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def add_tokens(self, input_tokens: int = 0, output_tokens: int = 0):
+        self.input_tokens += input_tokens or 0
+        self.output_tokens += output_tokens or 0
+
+    def record(self, message):
+        """Take the token usage reported on an LLM response (or stream chunk)."""
+        usage = getattr(message, "usage_metadata", None) or {}
+        self.add_tokens(usage.get("input_tokens", 0), usage.get("output_tokens", 0))
+
+    def __exit__(self, exc_type, *exc):
+        labels = (("kind", self.kind), ("model", self.model), ("purpose", self.purpose))
+        registry.observe("chatbot_model_call_seconds", time.perf_counter() - self.start,
+                         labels + (("status", "error" if exc_type else "ok"),))
+        if self.input_tokens:
+            registry.inc("chatbot_model_tokens_total", self.input_tokens, labels + (("direction", "input"),))
+        if self.output_tokens:
+            registry.inc("chatbot_model_tokens_total", self.output_tokens, labels + (("direction", "output"),))
+        return False
+
+
+def model_call(kind: str, model, purpose: str):
+    """Context manager around one LLM ("llm") or embedding ("embedding") call.
+
+    model may be a model name or a LangChain model object.
+    """
+    if not METRICS_ENABLED:
+        return _NOOP
+    if not isinstance(model, str):
+        model = getattr(model, "model_name", None) or getattr(model, "model", None) or type(model).__name__
+    return _ModelCall(kind, model, purpose)
+
+# =============================================================
+# HTTP
+# =============================================================
+def _server_timing(timings, total: float):
+    # Repeated stages are summed into one entry
+    merged = {}
+    for name, seconds in timings:
+        merged[name] = merged.get(name, 0.0) + seconds
+    parts = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in merged.items()]
+    parts.append(f"total;dur={total * 1000:.2f}")
+    return ", ".join(parts)
+
+
+class MetricsMiddleware:
+    """Times every request and adds the stages measured before the response
+    starts as a Server-Timing header (for streams: the stages before the
+    first byte)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        timings = []
+        token = _request_timings.set(timings)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                header = _server_timing(timings, time.perf_counter() - start)
+                message["headers"] = list(message.get("headers", [])) + [(b"server-timing", header.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _request_timings.reset(token)
+            route = scope.get("route")
+            path = getattr(route, "path", None) or "unmatched"
+            registry.observe("chatbot_http_request_seconds", time.perf_counter() - start,
+                             (("method", scope["method"]), ("route", path), ("status", str(status))))
+
+
+def render():
+    return registry.render()
@@ -0,0 +1,59 @@
+import os
+import json
+import uuid
+import hashlib
+
+# =============================================================
+# PER-PAGE EXTRACTION CACHE
+# =============================================================
+# Extracted page text is stored under (file hash, page number, method), so
+# re-ingesting a file or retrying a partially failed OCR run never redoes a
+# page that already completed.
+
+PAGE_CACHE_DIR = os.getenv("PAGE_CACHE_DIR", "page_cache")
+
+
+def file_hash(path: str):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _page_path(content_hash: str, page_number: int, method: str):
+    return os.path.join(PAGE_CACHE_DIR, content_hash, f"{page_number}.{method}.txt")
+
+
+def _write_atomic(path: str, content: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+def get_page(content_hash: str, page_number: int, method: str):
+    path = _page_path(content_hash, page_number, method)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def put_page(content_hash: str, page_number: int, method: str, text: str):
+    _write_atomic(_page_path(content_hash, page_number, method), text)
+
+
+def get_text_pages(content_hash: str):
+    """Cached text-layer extraction of the whole file, or None."""
+    path = os.path.join(PAGE_CACHE_DIR, content_hash, "text_pages.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def put_text_pages(content_hash: str, pages):
+    path = os.path.join(PAGE_CACHE_DIR, content_hash, "text_pages.json")
+    _write_atomic(path, json.dumps(pages))
@@ -1,9 +1,12 @@
+import io
 import base64
 import os
-from pdf2image import convert_from_path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pdf2image import convert_from_path, pdfinfo_from_path
 from openai import OpenAI
 from langchain_community.document_loaders import PyPDFLoader
 from dotenv import load_dotenv
+from modules import page_cache
 
 load_dotenv()
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
@@ -20,62 +23,136 @@ def extract_text_langchain(pdf_path):
     except:
         return ""
 
+def extract_pages_langchain(pdf_path):
+    """Text layer of every page (1 entry per page), or None if unreadable."""
+    try:
+        loader = PyPDFLoader(pdf_path)
+        return [p.page_content for p in loader.load()]
+    except:
+        return None
+
 
 # ---------------------------
 # Vision OCR (your previous code)
 # ---------------------------
-def extract_text_ocr(pdf_path):
-    pages = convert_from_path(pdf_path, dpi=300)
-    full_text = ""
-
-    for i, page in enumerate(pages):
-        temp_img = f"temp_{i}.png"
-        page.save(temp_img)
-
-        with open(temp_img, "rb") as f:
-            b64 = base64.b64encode(f.read()).decode()
-
-        response = client.responses.create(
-            model="gpt-4o-mini",
-            input=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "input_text",
-                         "text": "Extract all readable text from this scanned page."},
-                        {"type": "input_image",
-                         "image_url": f"data:image/png;base64,{b64}"}
-                    ]
-                }
-            ]
-        )
-
-        page_text = ""
-        for out in response.output:
-            if out.type == "message":
-                for c in out.content:
-                    if hasattr(c, "text"):
-                        page_text += c.text
-
-        full_text += f"\n\n### PAGE {i+1}\n{page_text}"
-        os.remove(temp_img)
-
-    return full_text
+# Pages are rendered one at a time (first_page/last_page), encoded in memory
+# and sent to the vision model from a small thread pool, so a long scan takes
+# roughly as long as its slowest pages and only OCR_CONCURRENCY rendered pages
+# are held in memory at once. No temp files, so concurrent ingestions are safe.
+OCR_DPI = 300
+OCR_CONCURRENCY = int(os.getenv("OCR_CONCURRENCY", "8"))
+
+def render_page_png(pdf_path, page_number, dpi=OCR_DPI):
+    images = convert_from_path(pdf_path, dpi=dpi, first_page=page_number, last_page=page_number)
+    buf = io.BytesIO()
+    images[0].save(buf, format="PNG")
+    return buf.getvalue()
+
+def ocr_image(png_bytes):
+    b64 = base64.b64encode(png_bytes).decode()
+
+    response = client.responses.create(
+        model="gpt-4o-mini",
+        input=[
+            {
+                "role": "user",
+                "content": [
+                    {"type": "input_text",
+                     "text": "Extract all readable text from this scanned page."},
+                    {"type": "input_image",
+                     "image_url": f"data:image/png;base64,{b64}"}
+                ]
+            }
+        ]
+    )
+
+    page_text = ""
+    for out in response.output:
+        if out.type == "message":
+            for c in out.content:
+                if hasattr(c, "text"):
+                    page_text += c.text
+    return page_text
+
+def ocr_page(pdf_path, page_number):
+    return ocr_image(render_page_png(pdf_path, page_number))
+
+def ocr_pages(pdf_path, page_numbers, progress=None, content_hash=None):
+    """OCR the given pages, returning {page_number: text}.
+
+    With a content_hash, pages already OCRed for this file are served from the
+    page cache and every page is cached as soon as it completes.
+    """
+    results = {}
+    todo = []
+    for n in page_numbers:
+        cached = page_cache.get_page(content_hash, n, "ocr") if content_hash else None
+        if cached is not None:
+            results[n] = cached
+        else:
+            todo.append(n)
+
+    total = len(page_numbers)
+    if progress:
+        progress(len(results), total)
+
+    pool = ThreadPoolExecutor(max_workers=OCR_CONCURRENCY, thread_name_prefix="ocr")
+    try:
+        futures = {pool.submit(ocr_page, pdf_path, n): n for n in todo}
+        for future in as_completed(futures):
+            n = futures[future]
+            results[n] = future.result()
+            if content_hash:
+                page_cache.put_page(content_hash, n, "ocr", results[n])
+            if progress:
+                progress(len(results), total)
+    finally:
+        # On failure don't keep rendering/OCR-ing the remaining pages
+        pool.shutdown(wait=True, cancel_futures=True)
+
+    return results
+
+def extract_text_ocr(pdf_path, progress=None, content_hash=None):
+    page_count = pdfinfo_from_path(pdf_path)["Pages"]
+    page_numbers = list(range(1, page_count + 1))
+    results = ocr_pages(pdf_path, page_numbers, progress=progress, content_hash=content_hash)
+
+    # Reassemble in page order
+    return "".join(f"\n\n### PAGE {n}\n{results[n]}" for n in page_numbers)
 
 
 # ---------------------------
-# AUTO-DETECT READABLE vs NON-READABLE PDF
+# PER-PAGE TEXT vs OCR ROUTING
 # ---------------------------
-def process_pdf_auto(pdf_path):
-    # 1) Try using LangChain normal extraction
-    text = extract_text_langchain(pdf_path)
+# Each page keeps its text layer unless it has fewer than OCR_MIN_PAGE_CHARS
+# characters, in which case only that page goes to vision OCR. Mixed PDFs
+# (text with a few scanned pages) keep everything without OCR-ing the rest.
+OCR_MIN_PAGE_CHARS = int(os.getenv("OCR_MIN_PAGE_CHARS", "100"))
+
+def process_pdf_auto(pdf_path, progress=None, content_hash=None):
+    content_hash = content_hash or page_cache.file_hash(pdf_path)
+
+    # 1) Text layer per page (cached per file)
+    text_pages = page_cache.get_text_pages(content_hash)
+    if text_pages is None:
+        text_pages = extract_pages_langchain(pdf_path)
+        if text_pages is not None:
+            page_cache.put_text_pages(content_hash, text_pages)
 
-    if len(text) > 500:  # readable PDF
-        print("[INFO] PDF is readable — using normal extraction.")
-        return text
+    if text_pages is None:
+        # Unreadable text layer: every page is OCRed
+        print("[INFO] PDF text layer unreadable — using GPT-Vision OCR for all pages.")
+        return extract_text_ocr(pdf_path, progress=progress, content_hash=content_hash)
 
-    # 2) If too short → assume scanned
-    print("[INFO] PDF seems non-readable — using GPT-Vision OCR.")
-    ocr_text = extract_text_ocr(pdf_path)
-    return ocr_text
+    # 2) OCR only the pages with too little text
+    sparse = [i + 1 for i, t in enumerate(text_pages) if len(t.strip()) < OCR_MIN_PAGE_CHARS]
+    print(f"[INFO] PDF has {len(text_pages)} pages — {len(sparse)} sent to GPT-Vision OCR.")
+    ocr_results = ocr_pages(pdf_path, sparse, progress=progress, content_hash=content_hash) if sparse else {}
 
+    parts = []
+    for n, page_text in enumerate(text_pages, start=1):
+        if n in ocr_results:
+            parts.append(f"### PAGE {n}\n{ocr_results[n]}")
+        else:
+            parts.append(page_text)
+    return "\n".join(parts).strip()
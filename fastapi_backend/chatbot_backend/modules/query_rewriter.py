@@ -1,5 +1,7 @@
+import re
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
+from modules.metrics import model_call
 
 
 llm = ChatOpenAI(model="gpt-4o-mini")
@@ -31,16 +33,40 @@ Your GOAL:
 ### Rewritten Standalone Query:
 """)
 
+# Words that only make sense with earlier turns ("what about its fees?")
+FOLLOW_UP_WORDS = {
+    "it", "its", "it's", "they", "them", "their", "theirs", "this", "that",
+    "these", "those", "he", "she", "his", "her", "there", "same", "above",
+    "previous", "also", "else", "more", "one", "ones", "former", "latter",
+}
+FOLLOW_UP_PREFIXES = ("what about", "how about", "and ", "or ", "but ", "then ", "so ")
+
+def needs_rewrite(query, last_messages):
+    """False when there is no history or the query already stands on its own."""
+    if not last_messages:
+        return False
+    text = query.lower().strip()
+    words = re.findall(r"[\w']+", text)
+    if len(words) <= 3 or text.startswith(FOLLOW_UP_PREFIXES):
+        return True
+    return any(w in FOLLOW_UP_WORDS for w in words)
+
 def rewrite_query(query, last_messages):
+    # Skip the LLM round trip when there is nothing to resolve
+    if not needs_rewrite(query, last_messages):
+        return query
+
     # formatted_history = ""
     # for m in last_messages:
     #     formatted_history += f"{m['role'].upper()}: {m['message']}\n"
 
-    result = llm.invoke(
-        rewrite_prompt.format(
-            query=query,
-            history=last_messages,
+    with model_call("llm", llm, "rewrite") as call:
+        result = llm.invoke(
+            rewrite_prompt.format(
+                query=query,
+                history=last_messages,
+            )
         )
-    )
+        call.record(result)
 
     return result.content.strip()
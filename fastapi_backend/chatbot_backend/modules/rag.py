@@ -1,155 +1,814 @@
 import os
+import re
+import json
 import uuid
 import pickle
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
+import threading
+import numpy as np
+from datetime import datetime
+from langchain_openai import ChatOpenAI
 from langchain_community.vectorstores import FAISS
-from langchain_community.retrievers import BM25Retriever
+from langchain_core.documents import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter
+from modules.tenant_cache import tenant_cache
+from modules.bm25_index import BM25Index
+from modules.vector_index import VectorIndex
+from modules.chunk_store import ChunkStore, INDEX_FILE
+from modules.write_coordinator import WriteCoordinator
+from modules.embedding_cache import CachedEmbeddings, embedding_cache, text_hash
+from modules.rate_limiter import embedding_limiter
+from modules.answer_cache import answer_cache
+from modules.metrics import stage, model_call
+from modules.embedding_backends import create_embeddings, EMBEDDING_BACKEND, LEGACY_EMBEDDING_MODEL
+from modules.ann_index import load_search_params, save_search_params, load_reports
+from modules.context_builder import rrf_fuse, build_context
 
 # =============================================================
 # MODELS
 # =============================================================
-embeddings = OpenAIEmbeddings(model="text-embedding-3-small")
+# The API's rate limit doesn't apply to a local model
+embedding_backend, EMBEDDING_MODEL = create_embeddings()
+embeddings = CachedEmbeddings(
+    embedding_backend, EMBEDDING_MODEL, limiter=embedding_limiter if EMBEDDING_BACKEND == "openai" else None
+)
 llm = ChatOpenAI(model="gpt-4o-mini")
 
 # =============================================================
 # HELPERS
 # =============================================================
-def get_tenant_dir(tenant_id: str):
+def get_tenant_dir(tenant_id: str, create: bool = True):
     path = f"data/{tenant_id}"
-    os.makedirs(path, exist_ok=True)
+    if create:
+        os.makedirs(path, exist_ok=True)
     return path
 
-def get_paths(tenant_id: str):
-    base = get_tenant_dir(tenant_id)
+def get_paths(tenant_id: str, create: bool = True):
+    base = get_tenant_dir(tenant_id, create=create)
     return {
-        "vectorstore": f"{base}/vectorstore.faiss",
-        "chunks": f"{base}/chunks.pkl"
+        "base": base,
+        "legacy_vectorstore": f"{base}/vectorstore.faiss",
+        "legacy_chunks": f"{base}/chunks.pkl",
+        "manifest": f"{base}/manifest.json"
     }
 
-def load_tenant_data(tenant_id: str):
-    paths = get_paths(tenant_id)
-    
-    # Load Chunks
-    if os.path.exists(paths["chunks"]):
-        with open(paths["chunks"], "rb") as f:
-            all_chunks = pickle.load(f)
-    else:
-        all_chunks = []
+# =============================================================
+# SOURCE MANIFEST
+# =============================================================
+# One small JSON entry per ingested source, kept in step with the chunks by
+# add/delete. /status and duplicate-upload checks read only this file.
+#
+# The manifest is also the commit record: every commit writes its chunk,
+# vector and BM25 files under new generation-numbered names and then
+# atomically replaces the manifest, which names the files of that generation.
+# A reader (or a restart after a crash mid-commit) always loads a complete set.
+# It also records the embedding model the tenant's vectors were made with.
+#
+# Only one server process may use a data directory. Loaded tenants, the write
+# coordinator and the job queue are per process and never re-read the
+# manifest, so a second worker would serve stale indexes and its commits
+# would overwrite the other's generations.
+
+# File names used before commits were generation-numbered
+LEGACY_FILES = {"chunks": INDEX_FILE, "vectors": "vectors.faiss", "bm25": "bm25.json"}
+INDEX_FILE_PATTERN = re.compile(r"^(chunks\.(idx\.)?\d+\.(bin|npz)|chunks\.idx\.npz|vectors(\.\d+)?\.faiss|bm25(\.\d+)?\.json|bm25\.base\.\d+\.npz|bm25\.log\.\d+\.jsonl)$")
+
+def generation_files(generation: int):
+    return {
+        "chunks": f"chunks.idx.{generation}.npz",
+        "vectors": f"vectors.{generation}.faiss",
+        "bm25": f"bm25.{generation}.json"
+    }
+
+def _source_entry(meta, ingested_at=None):
+    return {
+        "id": meta["source_id"],
+        "type": meta.get("type", "unknown"),
+        "name": meta.get("file_name") or meta.get("url") or "Unknown",
+        "chunk_count": 0,
+        "bytes": 0,
+        "ingested_at": ingested_at,
+        "content_hash": meta.get("content_hash")
+    }
+
+def build_manifest(all_chunks, ingested_at=None):
+    manifest = {}
+    for c in all_chunks:
+        meta = c["metadata"]
+        entry = manifest.get(meta["source_id"])
+        if entry is None:
+            entry = manifest[meta["source_id"]] = _source_entry(meta, ingested_at)
+        entry["chunk_count"] += 1
+        entry["bytes"] += len(c["text"].encode("utf-8"))
+    return manifest
+
+def _read_commit(path: str):
+    with open(path, "r", encoding="utf-8") as f:
+        commit = json.load(f)
+    commit.setdefault("generation", 0)
+    commit.setdefault("embedding_model", None)
+    commit["files"] = commit.get("files") or dict(LEGACY_FILES)
+    return commit
+
+def _read_manifest(path: str):
+    return _read_commit(path)["sources"]
+
+def _write_manifest(path: str, manifest, generation: int = 0, files=None, embedding_model=None):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"generation": generation, "files": files, "embedding_model": embedding_model, "sources": manifest}, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def _remove_stale_files(base: str, keep):
+    # Files of older generations; readers that still map them keep their copy
+    for name in os.listdir(base):
+        if name not in keep and INDEX_FILE_PATTERN.match(name):
+            try:
+                os.remove(os.path.join(base, name))
+            except FileNotFoundError:
+                pass
+
+class TenantData:
+    """Everything loaded for one tenant: chunk store, vector index and BM25 index."""
+
+    def __init__(self, store, vectors, bm25, manifest=None, generation=0, files=None, embedding_model=None):
+        self.store = store       # ChunkStore, texts memory-mapped
+        self.vectors = vectors   # VectorIndex, None until the first document is embedded
+        self.bm25 = bm25
+        self.manifest = manifest if manifest is not None else build_manifest(store.iter_chunks())
+        self.generation = generation                 # last committed generation
+        self.files = files or dict(LEGACY_FILES)     # files of that generation
+        self.embedding_model = embedding_model       # model the vectors were made with
+
+    @property
+    def all_chunks(self):
+        return list(self.store.iter_chunks())
+
+    @property
+    def next_id(self):
+        return self.store.next_id()
+
+    def get_chunk(self, chunk_id):
+        return self.store.get(chunk_id)
+
+    def add_chunks(self, full_chunks):
+        now = datetime.utcnow().isoformat()
+        self.store.add(full_chunks)
+        for c in full_chunks:
+            self.bm25.add(c["id"], c["text"])
+
+            entry = self.manifest.get(c["metadata"]["source_id"])
+            if entry is None:
+                entry = self.manifest[c["metadata"]["source_id"]] = _source_entry(c["metadata"], now)
+            entry["chunk_count"] += 1
+            entry["bytes"] += len(c["text"].encode("utf-8"))
+
+    def remove_source(self, source_id):
+        ids = self.store.remove_source(source_id)
+        self.manifest.pop(source_id, None)
+        for chunk_id in ids:
+            self.bm25.remove(chunk_id)
+        if self.vectors is not None:
+            self.vectors.remove(ids)
+        return ids
+
+    def replace_source(self, source_id, full_chunks, removed_ids, added, added_vecs):
+        """Swap a source's chunks for full_chunks; chunks not in `added` are already stored."""
+        self.store.remove_ids(removed_ids)
+        for chunk_id in removed_ids:
+            self.bm25.remove(chunk_id)
+        if self.vectors is not None:
+            self.vectors.remove(removed_ids)
+
+        if added:
+            if self.vectors is None:
+                self.vectors = VectorIndex.create(len(added_vecs[0]))
+            self.vectors.add([c["id"] for c in added], added_vecs)
+            self.store.add(added)
+            for c in added:
+                self.bm25.add(c["id"], c["text"])
+        self.store.set_source_metadata(source_id, full_chunks[0]["metadata"])
+        # Kept chunks move to their place in the new text
+        self.store.set_layout({c["id"]: (c.get("position", i), c.get("start", -1)) for i, c in enumerate(full_chunks)})
+
+        entry = self.manifest[source_id] = _source_entry(full_chunks[0]["metadata"], datetime.utcnow().isoformat())
+        entry["chunk_count"] = len(full_chunks)
+        entry["bytes"] = sum(len(c["text"].encode("utf-8")) for c in full_chunks)
+
+    def use_embedding_model(self, model: str):
+        """Called before vectors of `model` are added; refuses to mix models."""
+        if self.vectors is not None and self.vectors.ntotal == 0:
+            self.vectors = None   # empty index: free to start over with any model
+        if self.vectors is None:
+            self.embedding_model = model
+        elif self.embedding_model != model:
+            raise RuntimeError(
+                f"Tenant index was built with {self.embedding_model}, the embedding backend is {model}; "
+                "re-index the tenant (POST /reindex) before adding documents"
+            )
+
+    def estimate_size(self):
+        # Rough heap footprint: chunk rows and source table, the vectors that
+        # aren't memory-mapped and the BM25 postings.
+        vector_bytes = self.vectors.estimate_size() if self.vectors is not None else 0
+        return self.store.estimate_size() + vector_bytes + self.bm25.estimate_size()
+
+def _backfill_chunk_ids(all_chunks):
+    # Chunks saved before chunk ids existed get ids by position
+    next_id = max((c["id"] for c in all_chunks if "id" in c), default=-1) + 1
+    for c in all_chunks:
+        if "id" not in c:
+            c["id"] = next_id
+            next_id += 1
+
+def _migrate_legacy_vectorstore(path, all_chunks):
+    """Build an id-mapped index from an old LangChain FAISS store.
+
+    Vectors are reused by matching the docstore entries to our chunks on
+    (text, source_id); only chunks that cannot be matched are re-embedded.
+    """
+    store = FAISS.load_local(path, embeddings, allow_dangerous_deserialization=True)
+    raw = store.index.reconstruct_n(0, store.index.ntotal)
+
+    by_content = {}
+    for pos, doc_id in store.index_to_docstore_id.items():
+        doc = store.docstore.search(doc_id)
+        key = (doc.page_content, (doc.metadata or {}).get("source_id"))
+        by_content.setdefault(key, []).append(raw[pos])
+
+    vectors = VectorIndex.create(store.index.d)
+    ids, rows, missing = [], [], []
+    for c in all_chunks:
+        found = by_content.get((c["text"], c["metadata"]["source_id"]))
+        if found:
+            ids.append(c["id"])
+            rows.append(found.pop())
+        else:
+            missing.append(c)
+
+    if rows:
+        vectors.add(ids, rows)
+    if missing:
+        vectors.add([c["id"] for c in missing], embeddings.embed_documents([c["text"] for c in missing]))
+    return vectors
+
+def _migrate_legacy_chunks(paths):
+    """One-time conversion of chunks.pkl to the chunk store."""
+    with open(paths["legacy_chunks"], "rb") as f:
+        all_chunks = pickle.load(f)
+    _backfill_chunk_ids(all_chunks)
 
-    # Load FAISS
-    if os.path.exists(paths["vectorstore"]) and os.path.exists(os.path.join(paths["vectorstore"], "index.faiss")):
-        faiss_store = FAISS.load_local(paths["vectorstore"], embeddings, allow_dangerous_deserialization=True)
+    # Vectors and BM25 of the old layout are keyed by these ids, so build
+    # anything that is missing before the pickle is retired.
+    vectors_path = os.path.join(paths["base"], LEGACY_FILES["vectors"])
+    if not os.path.exists(vectors_path) and os.path.exists(os.path.join(paths["legacy_vectorstore"], "index.faiss")):
+        _migrate_legacy_vectorstore(paths["legacy_vectorstore"], all_chunks).save(vectors_path)
+
+    store = ChunkStore.from_chunks(all_chunks)
+    store.save(paths["base"], LEGACY_FILES["chunks"])
+    os.replace(paths["legacy_chunks"], f"{paths['legacy_chunks']}.migrated")
+    return store
+
+def _load_from_disk(paths):
+    base = paths["base"]
+    commit = _read_commit(paths["manifest"]) if os.path.exists(paths["manifest"]) else None
+    files = commit["files"] if commit else dict(LEGACY_FILES)
+
+    # Files named by a committed generation must exist; legacy ones may not
+    strict = commit is not None and commit["generation"] > 0
+
+    def present(name):
+        return bool(name) and (strict or os.path.exists(os.path.join(base, name)))
+
+    # Load chunks (one-time migration for tenants still on chunks.pkl)
+    if present(files["chunks"]):
+        store = ChunkStore.load(base, files["chunks"])
+    elif commit is None and os.path.exists(paths["legacy_chunks"]):
+        store = _migrate_legacy_chunks(paths)
     else:
-        # Initialize empty store if not exists
-        faiss_store = FAISS.from_texts(["FAST University"], embedding=embeddings)
-        # We don't save immediately here, only on write
-        
-    return all_chunks, faiss_store
-
-def save_tenant_data(tenant_id: str, all_chunks, faiss_store):
-    paths = get_paths(tenant_id)
-    
-    # Save Chunks
-    with open(paths["chunks"], "wb") as f:
-        pickle.dump(all_chunks, f)
-        
-    # Save FAISS
-    faiss_store.save_local(paths["vectorstore"])
+        store = ChunkStore()
+
+    # Load vectors, memory-mapped
+    vectors = None
+    if present(files["vectors"]):
+        vectors = VectorIndex.load(os.path.join(base, files["vectors"]))
+        vectors.set_search_params(**load_search_params(base))
+
+    # Load BM25 (built from the chunks once for tenants that predate it)
+    bm25 = None
+    if present(files["bm25"]):
+        bm25 = BM25Index.load(os.path.join(base, files["bm25"]))
+    if bm25 is None or len(bm25) != len(store):
+        with stage("bm25_build", os.path.basename(base)):
+            bm25 = BM25Index.from_chunks(store.iter_chunks())
+
+    # Vectors from before the model was recorded are from the legacy model
+    embedding_model = commit["embedding_model"] if commit else None
+    if vectors is not None and embedding_model is None:
+        embedding_model = LEGACY_EMBEDDING_MODEL
+
+    # Load the manifest (built from the chunks once for tenants that predate it)
+    manifest = None
+    if commit is not None:
+        manifest = commit["sources"]
+    elif len(store):
+        manifest = build_manifest(store.iter_chunks())
+        _write_manifest(paths["manifest"], manifest, embedding_model=embedding_model)
+
+    return TenantData(store, vectors, bm25, manifest, commit["generation"] if commit else 0, files, embedding_model)
+
+_load_locks = {}
+_load_locks_guard = threading.Lock()
+
+def _load_lock(tenant_id: str):
+    with _load_locks_guard:
+        lock = _load_locks.get(tenant_id)
+        if lock is None:
+            lock = _load_locks[tenant_id] = threading.Lock()
+        return lock
+
+def load_tenant_data(tenant_id: str):
+    cached = tenant_cache.get(tenant_id)
+    if cached is not None:
+        return cached
+
+    # One load per tenant at a time: loading a tenant from before the manifest
+    # migrates and writes its files, and concurrent first requests would race
+    # on them. Whoever waited finds the tenant loaded (or the manifest the
+    # migration wrote) once it gets the lock. Commits swap the manifest and
+    # remove the previous generation's files under the same lock, so a load
+    # always reads one complete generation.
+    with _load_lock(tenant_id):
+        cached = tenant_cache.peek(tenant_id)
+        if cached is not None:
+            return cached
+
+        with stage("index_load", tenant_id):
+            data = _load_from_disk(get_paths(tenant_id))
+        tenant_cache.put(tenant_id, data, data.estimate_size())
+    return data
+
+def save_tenant_data(tenant_id: str, data: TenantData):
+    base = get_paths(tenant_id)["base"]
+    generation = data.generation + 1
+    files = generation_files(generation)
+    if data.vectors is None:
+        files["vectors"] = None
+
+    try:
+        # Write the new generation next to the current one
+        data.store.save(base, files["chunks"])
+        if data.vectors is not None:
+            data.vectors.save(os.path.join(base, files["vectors"]))
+        data.bm25.save(os.path.join(base, files["bm25"]))
+
+        # Replacing the manifest commits it. Loads of the tenant wait for the
+        # swap and the cache update, so a load that read the previous
+        # generation can't put it back into the cache over this one.
+        with _load_lock(tenant_id):
+            _write_manifest(os.path.join(base, "manifest.json"), data.manifest, generation, files, data.embedding_model)
+            data.generation, data.files = generation, files
+            _remove_stale_files(base, set(files.values()) | {data.store.bin_name} | data.bm25.file_names)
+            tenant_cache.put(tenant_id, data, data.estimate_size())
+    except Exception:
+        # The cached objects may already be mutated; force a reload from disk
+        tenant_cache.invalidate(tenant_id)
+        raise
+
+    answer_cache.invalidate(tenant_id)
+
+def get_kb_version(tenant_id: str):
+    # Changes on every commit of this process (see the note on the manifest)
+    try:
+        return os.stat(get_paths(tenant_id, create=False)["manifest"]).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+def list_sources(tenant_id: str):
+    """Manifest entries of a tenant, without loading chunks or vectors."""
+    cached = tenant_cache.peek(tenant_id)
+    if cached is not None:
+        with write_coordinator.reading(tenant_id):
+            return list(cached.manifest.values())
+
+    paths = get_paths(tenant_id, create=False)
+    if os.path.exists(paths["manifest"]):
+        return list(_read_manifest(paths["manifest"]).values())
+    if ChunkStore.exists(paths["base"], LEGACY_FILES["chunks"]) or os.path.exists(paths["legacy_chunks"]):
+        # Tenant from before the manifest: loading it writes one
+        return list(load_tenant_data(tenant_id).manifest.values())
+    return []
 
 # =============================================================
 # TEXT SPLITTER
 # =============================================================
 text_splitter = RecursiveCharacterTextSplitter(
     chunk_size=350,
-    chunk_overlap=80
+    chunk_overlap=80,
+    add_start_index=True
 )
 
 # =============================================================
 # ADD DOCUMENTS (PDF or website)
 # =============================================================
-def add_document(tenant_id: str, text: str, source_id: str, file_name=None, url=None, doc_type="pdf"):
-    all_chunks, faiss_store = load_tenant_data(tenant_id)
-
-    chunks = text_splitter.split_text(text)
-
+def split_document(tenant_id: str, text: str, source_id: str, file_name=None, url=None, doc_type="pdf", content_hash=None):
     full_chunks = []
-    for ch in chunks:
+    for position, doc in enumerate(text_splitter.create_documents([text])):
         metadata = {
             "source_id": source_id,
             "type": doc_type,
             "file_name": file_name,
             "url": url,
-            "tenant_id": tenant_id
+            "tenant_id": tenant_id,
+            "content_hash": content_hash
         }
-        full_chunks.append({"text": ch, "metadata": metadata})
+        # position and start place the chunk in the text (see chunk_store)
+        full_chunks.append({
+            "text": doc.page_content, "metadata": metadata,
+            "position": position, "start": doc.metadata["start_index"]
+        })
+    return full_chunks
+
+def embed_texts(texts):
+    return embeddings.embed_documents(texts)
+
+def embed_chunks(full_chunks):
+    return embed_texts([c["text"] for c in full_chunks])
+
+def commit_chunks(tenant_id: str, full_chunks, vecs):
+    if not full_chunks:
+        return
+    write_coordinator.submit(tenant_id, ("add", full_chunks, vecs))
+
+def add_document(tenant_id: str, text: str, source_id: str, file_name=None, url=None, doc_type="pdf", content_hash=None):
+    full_chunks = split_document(
+        tenant_id, text, source_id, file_name=file_name, url=url, doc_type=doc_type, content_hash=content_hash
+    )
+    if not full_chunks:
+        return
+
+    # Embed before touching any shared state
+    vecs = embed_chunks(full_chunks)
+    commit_chunks(tenant_id, full_chunks, vecs)
+
+# =============================================================
+# UPDATE DOCUMENT (re-embeds only changed chunks)
+# =============================================================
+# The new text is split as usual and each chunk is matched by text hash
+# against the chunks stored for the source. Matches keep their id and
+# vector, stored chunks without a match are dropped, and only the remaining
+# new chunks are embedded, so the cost follows the size of the edit.
+
+def plan_update(tenant_id: str, source_id: str, full_chunks):
+    """The chunks of full_chunks that aren't stored for source_id yet."""
+    stored = {text_hash(c["text"]) for c in load_tenant_data(tenant_id).store.chunks_for_source(source_id)}
+    return [c for c in full_chunks if text_hash(c["text"]) not in stored]
+
+UPDATE_ATTEMPTS = 3
 
-    # 1. Update BM25 chunks
-    all_chunks.extend(full_chunks)
+def commit_updates(tenant_id: str, updates, new_vectors):
+    """updates: [(source_id, full_chunks)]; new_vectors: text hash -> vector of the planned chunks.
 
-    # 2. Update FAISS with texts only but metadata preserved
-    faiss_store.add_texts(
-        texts=[c["text"] for c in full_chunks],
-        metadatas=[c["metadata"] for c in full_chunks]
+    Returns {"kept", "added", "removed"} per update.
+    """
+    updates = [(source_id, full_chunks) for source_id, full_chunks in updates if full_chunks]
+    results = [None] * len(updates)
+    pending = list(range(len(updates)))
+    for attempt in range(UPDATE_ATTEMPTS):
+        if not pending:
+            break
+        if attempt:
+            # The source changed since the plan: embed what it didn't cover
+            # out here, not while the commit holds the tenant's writer lock
+            new_vectors = dict(new_vectors)
+            for i in pending:
+                source_id, full_chunks = updates[i]
+                missing = [c for c in plan_update(tenant_id, source_id, full_chunks) if text_hash(c["text"]) not in new_vectors]
+                new_vectors.update({text_hash(c["text"]): v for c, v in zip(missing, embed_chunks(missing))})
+
+        done = write_coordinator.submit(tenant_id, ("replace", [updates[i] for i in pending], new_vectors))
+        for i, result in zip(pending, done):
+            results[i] = result
+        pending = [i for i in pending if results[i] is None]
+
+    if pending:
+        raise RuntimeError(f"Sources kept changing during the update: {[updates[i][0] for i in pending]}")
+    return results
+
+def update_document(tenant_id: str, text: str, source_id: str, file_name=None, url=None, doc_type="pdf", content_hash=None):
+    full_chunks = split_document(
+        tenant_id, text, source_id, file_name=file_name, url=url, doc_type=doc_type, content_hash=content_hash
     )
-    
-    save_tenant_data(tenant_id, all_chunks, faiss_store)
+    if not full_chunks:
+        removed = len(load_tenant_data(tenant_id).store.ids_for_source(source_id))
+        delete_document(tenant_id, source_id)
+        return {"kept": 0, "added": 0, "removed": removed}
+
+    new = plan_update(tenant_id, source_id, full_chunks)
+    vecs = embed_chunks(new) if new else []
+    new_vectors = {text_hash(c["text"]): v for c, v in zip(new, vecs)}
+    return commit_updates(tenant_id, [(source_id, full_chunks)], new_vectors)[0]
 
 # =============================================================
 # DELETE DOCUMENT BY SOURCE ID
 # =============================================================
 def delete_document(tenant_id: str, source_id: str):
-    all_chunks, _ = load_tenant_data(tenant_id)
-
-    # 1. Remove chunks locally
-    new_chunks = [c for c in all_chunks if c["metadata"]["source_id"] != source_id]
-    
-    if len(new_chunks) == len(all_chunks):
-        return False # Nothing deleted
-
-    # 2. Rebuild FAISS (required because FAISS delete is tricky without IDs)
-    if new_chunks:
-        texts = [c["text"] for c in new_chunks]
-        metas = [c["metadata"] for c in new_chunks]
-        new_faiss_store = FAISS.from_texts(texts, embedding=embeddings, metadatas=metas)
+    # Vectors are removed by chunk id, no re-embedding of the remaining corpus.
+    # False when there was nothing to delete.
+    return write_coordinator.submit(tenant_id, ("delete", source_id))
+
+# =============================================================
+# RE-INDEX (embedding model changed)
+# =============================================================
+# A tenant's vectors stay tied to the model they were made with. After the
+# embedding backend is switched, queries use keyword search only and new
+# documents are refused until the tenant is re-indexed: every stored chunk is
+# embedded with the current model and the vector index is swapped in one
+# commit.
+
+def get_embedding_status(tenant_id: str):
+    paths = get_paths(tenant_id, create=False)
+    model = None
+    if os.path.exists(paths["manifest"]):
+        commit = _read_commit(paths["manifest"])
+        model = commit["embedding_model"]
+        vectors = commit["files"].get("vectors")
+        if model is None and vectors and os.path.exists(os.path.join(paths["base"], vectors)):
+            model = LEGACY_EMBEDDING_MODEL
+    elif ChunkStore.exists(paths["base"], LEGACY_FILES["chunks"]) or os.path.exists(paths["legacy_chunks"]):
+        # Tenant from before the manifest: loading it writes one
+        model = load_tenant_data(tenant_id).embedding_model
+    current = embedding_model_id()
+    return {"model": model, "current": current, "needs_reindex": model is not None and model != current}
+
+def reindex_snapshot(tenant_id: str):
+    """Ids and texts of every stored chunk."""
+    data = load_tenant_data(tenant_id)
+    with write_coordinator.reading(tenant_id):
+        rows = data.store.rows
+        return rows["id"].tolist(), [data.get_chunk(chunk_id)["text"] for chunk_id in rows["id"].tolist()]
+
+def commit_reindex(tenant_id: str, model: str, ids, vecs):
+    """Replace the tenant's vector index with vecs (made with model); returns the number kept."""
+    return write_coordinator.submit(tenant_id, ("reindex", model, ids, vecs))
+
+# =============================================================
+# VECTOR INDEX TYPE AND SEARCH PARAMETERS
+# =============================================================
+# Large tenants are moved from the flat index to an approximate one by a
+# background job (see ann_index and ingestion.rebuild_vector_index) that
+# trains the new index from a snapshot of the stored vectors and commits it
+# like any other write.
+
+def vector_index_info(tenant_id: str):
+    data = load_tenant_data(tenant_id)
+    with write_coordinator.reading(tenant_id):
+        return data.vectors.describe() if data.vectors is not None else None
+
+def vector_snapshot(tenant_id: str):
+    """(ids, vectors, describe(), embedding model) of the tenant's vector index, or None."""
+    data = load_tenant_data(tenant_id)
+    with write_coordinator.reading(tenant_id):
+        if data.vectors is None:
+            return None
+        ids, vectors = data.vectors.stored_vectors()
+        return ids, vectors, data.vectors.describe(), data.embedding_model
+
+def commit_vector_index(tenant_id: str, index, snapshot_ids, model):
+    """Swap in index (built from snapshot_ids of model); returns the writes caught up on."""
+    return write_coordinator.submit(tenant_id, ("vectors", index, snapshot_ids, model))
+
+def get_search_params(tenant_id: str):
+    return load_search_params(get_paths(tenant_id)["base"])
+
+def set_search_params(tenant_id: str, nprobe: int = None):
+    """Per-tenant search parameters; None restores the value chosen at the last rebuild."""
+    base = get_paths(tenant_id)["base"]
+    params = load_search_params(base)
+    if nprobe is None:
+        params.pop("nprobe", None)
+        reports = load_reports(base)
+        nprobe = reports[-1]["chosen_nprobe"] if reports else None
     else:
-        new_faiss_store = FAISS.from_texts(["FAST University"], embedding=embeddings)
+        params["nprobe"] = nprobe
+    save_search_params(base, params)
 
-    save_tenant_data(tenant_id, new_chunks, new_faiss_store)
-    return True
+    data = load_tenant_data(tenant_id)
+    with write_coordinator.writing(tenant_id):
+        if data.vectors is not None:
+            data.vectors.set_search_params(nprobe=nprobe)
+            return data.vectors.describe()
+    return None
+
+def get_vector_index_status(tenant_id: str):
+    base = get_paths(tenant_id)["base"]
+    reports = load_reports(base)
+    return {
+        "index": vector_index_info(tenant_id),
+        "search_params": load_search_params(base),
+        "last_report": reports[-1] if reports else None
+    }
+
+# =============================================================
+# COMMITS (serialized per tenant, group-committed)
+# =============================================================
+# commit_chunks and delete_document only queue their write; the coordinator
+# hands everything queued for a tenant to _commit_writes in one go, which
+# applies the writes in order and saves once.
+
+def _apply_write(data: TenantData, write):
+    kind = write[0]
+    if kind == "add":
+        _, full_chunks, vecs = write
+        next_id = data.next_id
+        for i, c in enumerate(full_chunks):
+            c["id"] = next_id + i
+        data.use_embedding_model(embedding_model_id())
+        if data.vectors is None:
+            data.vectors = VectorIndex.create(len(vecs[0]))
+        data.vectors.add([c["id"] for c in full_chunks], vecs)
+        data.add_chunks(full_chunks)
+        return len(full_chunks)
+
+    if kind == "delete":
+        if not data.store.has_source(write[1]):
+            return False
+        data.remove_source(write[1])
+        return True
+
+    if kind == "replace":
+        _, updates, new_vectors = write
+        return [_apply_replace(data, source_id, full_chunks, new_vectors) for source_id, full_chunks in updates]
+
+    if kind == "reindex":
+        _, model, ids, vecs = write
+        return _apply_reindex(data, model, ids, vecs)
+
+    if kind == "vectors":
+        _, index, snapshot_ids, model = write
+        return _apply_vectors(data, index, snapshot_ids, model)
+
+    raise ValueError(f"Unknown write: {kind}")
+
+def _apply_replace(data: TenantData, source_id, full_chunks, new_vectors):
+    # The diff is taken again here, against what is stored now
+    stored = {}
+    for chunk in data.store.chunks_for_source(source_id):
+        stored.setdefault(text_hash(chunk["text"]), []).append(chunk["id"])
+
+    added = []
+    for c in full_chunks:
+        ids = stored.get(text_hash(c["text"]))
+        if ids:
+            c["id"] = ids.pop(0)
+        else:
+            added.append(c)
+    removed = [chunk_id for ids in stored.values() for chunk_id in ids]
+
+    # Chunks the plan didn't see (the source changed in the meantime): left
+    # untouched, commit_updates embeds them outside the lock and retries
+    if any(text_hash(c["text"]) not in new_vectors for c in added):
+        return None
+
+    if added:
+        data.use_embedding_model(embedding_model_id())
+    next_id = data.next_id
+    for i, c in enumerate(added):
+        c["id"] = next_id + i
+    data.replace_source(source_id, full_chunks, removed, added, [new_vectors[text_hash(c["text"])] for c in added])
+    return {"kept": len(full_chunks) - len(added), "added": len(added), "removed": len(removed)}
+
+def _apply_reindex(data: TenantData, model, ids, vecs):
+    # Chunks deleted since the snapshot are dropped; any chunk added since
+    # would have no vector of the new model, so the re-index has to run again
+    stored = set(data.store.rows["id"].tolist())
+    keep = [k for k, chunk_id in enumerate(ids) if chunk_id in stored]
+    if len(keep) != len(stored):
+        raise RuntimeError("Chunks were added during the re-index; run it again")
+
+    vectors = None
+    if keep:
+        vectors = VectorIndex.create(len(vecs[keep[0]]))
+        vectors.add([ids[k] for k in keep], [vecs[k] for k in keep])
+    data.vectors = vectors
+    data.embedding_model = model if vectors is not None else None
+    return len(keep)
+
+def _apply_vectors(data: TenantData, index, snapshot_ids, model):
+    # Bring the rebuilt index up to date with what was written since the
+    # snapshot it was built from, reusing the stored vectors
+    if data.vectors is None or data.embedding_model != model or data.vectors.dim != index.dim:
+        raise RuntimeError("The vector index changed during the rebuild; run it again")
+    current = data.vectors.ids()
+    added = np.setdiff1d(current, snapshot_ids)
+    removed = np.setdiff1d(snapshot_ids, current)
+    index.add(added, data.vectors.reconstruct_many(added))
+    index.remove(removed)
+    data.vectors = index
+    return {"added": len(added), "removed": len(removed)}
+
+def _commit_writes(tenant_id: str, writes):
+    data = load_tenant_data(tenant_id)
+
+    # Everything below touches the cached instances, so readers are held off
+    # while the writes are applied (but not while the files are written)
+    try:
+        with stage("commit_apply", tenant_id), write_coordinator.writing(tenant_id):
+            results = [_apply_write(data, w) for w in writes]
+    except Exception:
+        tenant_cache.invalidate(tenant_id)
+        raise
+
+    if any(results):
+        with stage("commit_save", tenant_id):
+            save_tenant_data(tenant_id, data)
+    return results
+
+write_coordinator = WriteCoordinator(_commit_writes)
 
 # =============================================================
 # HYBRID RETRIEVAL
 # =============================================================
-def hybrid_retrieve(tenant_id: str, query: str):
-    all_chunks, faiss_store = load_tenant_data(tenant_id)
-    
-    if not all_chunks:
+# Each retriever returns RETRIEVE_K candidates; the fused best
+# CONTEXT_CANDIDATES are read and packed into the context (context_builder).
+
+RETRIEVE_K = int(os.getenv("RETRIEVE_K", "10"))
+CONTEXT_CANDIDATES = int(os.getenv("CONTEXT_CANDIDATES", "12"))
+
+def _to_document(passage):
+    return Document(page_content=passage["text"], metadata=dict(passage["metadata"], chunk_ids=passage["chunk_ids"]))
+
+_mismatch_warned = set()
+
+def embedding_model_id():
+    # The model of the embeddings in use (benchmarks swap them out)
+    return getattr(embeddings, "model_name", None) or EMBEDDING_MODEL
+
+def embed_queries(texts):
+    """Embeddings of one-off texts (e.g. customer messages), kept out of the content cache."""
+    embed = getattr(embeddings, "embed_queries", None) or embeddings.embed_documents
+    return embed(texts)
+
+def searchable_vectors(tenant_id: str, data: TenantData):
+    """The tenant's vector index, or None when it is empty or was built with
+    another embedding model (search then falls back to BM25 alone)."""
+    if data.vectors is None:
+        return None
+    if data.embedding_model != embedding_model_id():
+        if tenant_id not in _mismatch_warned:
+            _mismatch_warned.add(tenant_id)
+            print(f"⚠️ Tenant {tenant_id} is indexed with {data.embedding_model}, not {embedding_model_id()}; "
+                  "using keyword search until it is re-indexed")
+        return None
+    return data.vectors
+
+def embed_query_for(tenant_id: str, query: str):
+    """Query embedding, or None when the tenant has nothing to search."""
+    if searchable_vectors(tenant_id, load_tenant_data(tenant_id)) is None:
+        return None
+    with stage("embed_query", tenant_id):
+        return embeddings.embed_query(query)
+
+def hybrid_retrieve(tenant_id: str, query: str, query_vector=None):
+    data = load_tenant_data(tenant_id)
+
+    if not len(data.store):
         return []
 
-    semantic_docs = faiss_store.as_retriever(search_kwargs={"k": 6}).invoke(query)
+    if searchable_vectors(tenant_id, data) is not None and query_vector is None:
+        with stage("embed_query", tenant_id):
+            query_vector = embeddings.embed_query(query)
+
+    with write_coordinator.reading(tenant_id):
+        semantic_ids = []
+        vectors = searchable_vectors(tenant_id, data)
+        if vectors is not None and query_vector is not None:
+            with stage("vector_search", tenant_id):
+                semantic_ids = [chunk_id for chunk_id, _ in vectors.search(query_vector, k=RETRIEVE_K)]
+        with stage("bm25_search", tenant_id):
+            bm25_ids = [chunk_id for chunk_id, _ in data.bm25.search(query, k=RETRIEVE_K)]
 
-    bm25 = BM25Retriever.from_texts([c["text"] for c in all_chunks])
-    bm25.k = 6
-    bm25_docs = bm25.invoke(query)
+        # Only the texts that are used are read out of the mapped store
+        with stage("fetch_chunks", tenant_id):
+            fused = rrf_fuse([semantic_ids, bm25_ids])[:CONTEXT_CANDIDATES]
+            chunks = [data.get_chunk(chunk_id) for chunk_id in fused]
 
-    final = {id(d): d for d in semantic_docs + bm25_docs}
-    return list(final.values())[:5]
+    with stage("build_context", tenant_id):
+        return [_to_document(p) for p in build_context([c for c in chunks if c is not None])]
 
 # =============================================================
 # ANSWER QUERY
 # =============================================================
-def answer_query(tenant_id: str, query: str) -> str:
-    docs = hybrid_retrieve(tenant_id, query)
-
-    if not docs:
-        return "Sorry, no matching information found."
+NO_MATCH_ANSWER = "Sorry, no matching information found."
 
+def build_answer_prompt(query: str, docs) -> str:
+    # docs are already packed to the context token budget
     context = "\n\n".join(
-        [d.page_content[:1500] for d in docs if hasattr(d, "page_content")]
+        [d.page_content for d in docs if hasattr(d, "page_content")]
     )
 
-    prompt = f"""
+    return f"""
 You are the official AI assistant.
 Use the provided database context to answer.
 
@@ -162,8 +821,94 @@ If not found say:
 "Sorry, exact information not found in the database."
 """
 
-    return llm.invoke(prompt).content.strip()
+def get_cached_answer(tenant_id: str, query: str):
+    """Look the query up in the answer cache.
+
+    Returns (cached {"answer", "sources"} or None, query vector, kb version);
+    the vector and version are meant to be reused for retrieval and for
+    cache_answer on a miss.
+    """
+    kb_version = get_kb_version(tenant_id)
+    with stage("answer_cache", tenant_id):
+        hit = answer_cache.get(tenant_id, query, kb_version)
+    if hit is not None:
+        return hit, None, kb_version
+
+    query_vector = embed_query_for(tenant_id, query)
+    if query_vector is not None:
+        with stage("answer_cache", tenant_id):
+            hit = answer_cache.get(tenant_id, query, kb_version, vector=query_vector)
+    return hit, query_vector, kb_version
+
+def cache_answer(tenant_id: str, query: str, answer: str, docs, query_vector, kb_version):
+    value = {"answer": answer, "sources": describe_sources(docs)}
+    answer_cache.put(tenant_id, query, value, kb_version, vector=query_vector)
+
+def answer_query(tenant_id: str, query: str) -> str:
+    hit, query_vector, kb_version = get_cached_answer(tenant_id, query)
+    if hit is not None:
+        return hit["answer"]
+
+    with stage("retrieve", tenant_id):
+        docs = hybrid_retrieve(tenant_id, query, query_vector=query_vector)
+
+    if not docs:
+        answer = NO_MATCH_ANSWER
+    else:
+        with stage("generate", tenant_id), model_call("llm", llm, "answer") as call:
+            result = llm.invoke(build_answer_prompt(query, docs))
+            call.record(result)
+        answer = result.content.strip()
+
+    cache_answer(tenant_id, query, answer, docs, query_vector, kb_version)
+    return answer
+
+async def astream_answer(query: str, docs, tenant_id: str = None):
+    """Yield answer text pieces as the LLM generates them."""
+    if not docs:
+        yield NO_MATCH_ANSWER
+        return
+
+    with stage("generate", tenant_id), model_call("llm", llm, "answer_stream") as call:
+        async for chunk in llm.astream(build_answer_prompt(query, docs)):
+            call.record(chunk)
+            if chunk.content:
+                yield chunk.content
+
+def describe_sources(docs):
+    """Distinct sources behind the retrieved chunks, in retrieval order."""
+    sources = {}
+    for d in docs:
+        meta = d.metadata or {}
+        source_id = meta.get("source_id")
+        if source_id and source_id not in sources:
+            sources[source_id] = {
+                "id": source_id,
+                "type": meta.get("type", "unknown"),
+                "name": meta.get("file_name") or meta.get("url") or "Unknown"
+            }
+    return list(sources.values())
+
+def find_source_by_hash(tenant_id: str, content_hash: str):
+    """Source id of an already ingested file with this content hash, if any."""
+    for entry in list_sources(tenant_id):
+        if entry.get("content_hash") == content_hash:
+            return entry["id"]
+    return None
 
 def get_all_chunks(tenant_id: str):
-    all_chunks, _ = load_tenant_data(tenant_id)
-    return all_chunks
+    return load_tenant_data(tenant_id).all_chunks
+
+def get_cache_stats():
+    return {
+        "tenant_index": tenant_cache.stats(),
+        "embeddings": embedding_cache.stats(),
+        "answers": answer_cache.stats(),
+        "embedding_rate": embedding_limiter.stats(),
+        "writes": write_coordinator.stats(),
+        "embedding_backend": {
+            "backend": EMBEDDING_BACKEND,
+            "model": embedding_model_id(),
+            "query_batching": embedding_backend.stats() if hasattr(embedding_backend, "stats") else None
+        }
+    }
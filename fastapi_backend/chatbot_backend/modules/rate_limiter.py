@@ -0,0 +1,77 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+from modules import tokenizer
+from modules.tokenizer import get_encoder
+
+# =============================================================
+# EMBEDDING RATE LIMITER
+# =============================================================
+# The embedding API limits tokens per minute per account, so every call that
+# actually reaches it (cache misses only) reserves its tokens here first. The
+# bucket may go into debt: a caller waits until its share has refilled, which
+# keeps callers in arrival order. A semaphore caps concurrent requests.
+
+EMBED_TPM = int(os.getenv("EMBED_TPM", "1000000"))
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+TOKEN_ENCODING = os.getenv("TOKEN_ENCODING", "cl100k_base")
+
+
+def token_lengths(texts):
+    """Token counts of texts for the embedding API (not the chat model; see tokenizer)."""
+    return tokenizer.token_lengths(texts, get_encoder(encoding=TOKEN_ENCODING))
+
+
+def count_tokens(texts):
+    return sum(token_lengths(texts))
+
+
+class TokenRateLimiter:
+    def __init__(self, tokens_per_minute: int = EMBED_TPM, max_concurrent: int = EMBED_CONCURRENCY):
+        self.capacity = tokens_per_minute
+        self.rate = tokens_per_minute / 60.0
+        self._available = float(tokens_per_minute)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max(1, max_concurrent))
+        self.max_concurrent = max(1, max_concurrent)
+        self.tokens = 0
+        self.requests = 0
+        self.throttled = 0
+        self.wait_seconds = 0.0
+
+    def _reserve(self, tokens: int):
+        """Take tokens from the bucket; returns how long the caller must wait."""
+        with self._lock:
+            now = time.monotonic()
+            self._available = min(self.capacity, self._available + (now - self._updated) * self.rate)
+            self._updated = now
+            self._available -= tokens
+            self.tokens += tokens
+            self.requests += 1
+            return -self._available / self.rate if self._available < 0 else 0.0
+
+    @contextmanager
+    def acquire(self, tokens: int):
+        if self.rate > 0:
+            wait = self._reserve(tokens)
+            if wait > 0:
+                self.throttled += 1
+                self.wait_seconds += wait
+                time.sleep(wait)
+        with self._slots:
+            yield
+
+    def stats(self):
+        return {
+            "tokens_per_minute": self.capacity,
+            "max_concurrent": self.max_concurrent,
+            "tokens": self.tokens,
+            "requests": self.requests,
+            "throttled": self.throttled,
+            "wait_seconds": round(self.wait_seconds, 3),
+        }
+
+
+embedding_limiter = TokenRateLimiter()
@@ -0,0 +1,87 @@
+import os
+import threading
+from collections import OrderedDict
+
+# =============================================================
+# PROCESS-WIDE LRU CACHE OF LOADED TENANT INDEXES
+# =============================================================
+# Keeps the deserialized (chunks, vector store) of recently used tenants in
+# memory so /query and /status don't hit the disk on every request.
+# Bounded both by number of tenants and by an estimate of their size.
+
+MAX_TENANTS = int(os.getenv("TENANT_CACHE_MAX_TENANTS", "32"))
+MAX_BYTES = int(os.getenv("TENANT_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+
+class TenantCache:
+    def __init__(self, max_tenants: int = MAX_TENANTS, max_bytes: int = MAX_BYTES):
+        self.max_tenants = max_tenants
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # tenant_id -> (value, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, tenant_id: str):
+        with self._lock:
+            entry = self._entries.get(tenant_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(tenant_id)
+            self.hits += 1
+            return entry[0]
+
+    def peek(self, tenant_id: str):
+        """Cached value without counting a lookup or touching the LRU order."""
+        with self._lock:
+            entry = self._entries.get(tenant_id)
+            return entry[0] if entry is not None else None
+
+    def put(self, tenant_id: str, value, size: int):
+        with self._lock:
+            old = self._entries.pop(tenant_id, None)
+            if old is not None:
+                self._bytes -= old[1]
+
+            # A single tenant bigger than the whole budget is never cached
+            if size > self.max_bytes or self.max_tenants <= 0:
+                return
+
+            self._entries[tenant_id] = (value, size)
+            self._bytes += size
+
+            while len(self._entries) > self.max_tenants or self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, tenant_id: str):
+        with self._lock:
+            old = self._entries.pop(tenant_id, None)
+            if old is not None:
+                self._bytes -= old[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "tenants": len(self._entries),
+                "bytes": self._bytes,
+                "max_tenants": self.max_tenants,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+tenant_cache = TenantCache()
@@ -1,7 +1,18 @@
+import os
+import re
+import json
+import math
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import List
+from modules.metrics import model_call
+from modules import rag
 
 llm = ChatOpenAI(model="gpt-4o-mini")
 
@@ -14,6 +25,10 @@ class TicketAnalysisRequest(BaseModel):
     message: str
     triggers: List[Trigger]
 
+class TicketBatchRequest(BaseModel):
+    messages: List[str]
+    triggers: List[Trigger]
+
 ticket_prompt = ChatPromptTemplate.from_template("""
 You are an AI ticket analyzer. Your job is to check if the user's message matches any of the provided triggers.
 
@@ -31,16 +46,202 @@ User Message: {message}
 Return ONLY the Trigger ID or "None".
 """)
 
+# =============================================================
+# LOCAL SIMILARITY SCORING
+# =============================================================
+# Triggers are embedded once per trigger set (keyed by a hash of the set and
+# the embedding model) and messages are scored by cosine similarity, plus a
+# bonus when the trigger's keyword appears in the message as a whole word. A
+# clear winner above the model's match threshold, or nothing above its reject
+# threshold, is decided locally. Everything in between goes to the LLM with
+# only the TICKET_LLM_CANDIDATES best triggers.
+#
+# Similarity ranges differ between embedding models, so the thresholds are
+# kept per model. With a model that has none, the similarity only picks the
+# candidates and every message goes to the LLM. More models can be
+# calibrated with TICKET_THRESHOLDS, e.g.
+#   {"local:sentence-transformers/all-MiniLM-L6-v2": {"match": 0.6, "reject": 0.35}}
+#
+# confidence is the similarity mapped to a probability (about 0.95 at the
+# match threshold, 0.05 at the reject threshold) times the winner's share of
+# a softmax over the candidates, so a close runner-up lowers it.
+
+THRESHOLDS = {
+    "text-embedding-3-small": {"match": 0.55, "reject": 0.30},
+}
+THRESHOLDS.update(json.loads(os.getenv("TICKET_THRESHOLDS", "{}")))
+MIN_MARGIN = float(os.getenv("TICKET_MIN_MARGIN", "0.05"))
+LLM_CANDIDATES = int(os.getenv("TICKET_LLM_CANDIDATES", "3"))
+LLM_CONCURRENCY = int(os.getenv("TICKET_LLM_CONCURRENCY", "4"))
+KEYWORD_BONUS = 0.1
+SOFTMAX_TEMPERATURE = 0.05
+MAX_TRIGGER_SETS = 128
+
+_trigger_sets = OrderedDict()   # set hash -> (triggers, unit vectors)
+_sets_lock = threading.Lock()
+
+_stats = {"match": 0, "reject": 0, "llm": 0, "uncalibrated": 0}
+_stats_lock = threading.Lock()
+
+
+def _record(tier: str, n: int = 1):
+    with _stats_lock:
+        _stats[tier] += n
+
+
+def _unit(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def trigger_set_key(triggers: List[Trigger]):
+    items = sorted((t.id, t.keyword, t.intent) for t in triggers)
+    raw = json.dumps([rag.embedding_model_id(), items])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def get_trigger_set(triggers: List[Trigger]):
+    """(triggers, unit vectors), embedded on first use of this trigger set."""
+    key = trigger_set_key(triggers)
+    with _sets_lock:
+        cached = _trigger_sets.get(key)
+        if cached is not None:
+            _trigger_sets.move_to_end(key)
+            return cached
+
+    ordered = sorted(triggers, key=lambda t: t.id)
+    vectors = _unit(rag.embeddings.embed_documents([f"{t.keyword}: {t.intent}" for t in ordered]))
+    with _sets_lock:
+        _trigger_sets[key] = (ordered, vectors)
+        while len(_trigger_sets) > MAX_TRIGGER_SETS:
+            _trigger_sets.popitem(last=False)
+    return ordered, vectors
+
+
+def get_thresholds():
+    """{"match", "reject"} for the embedding model in use, or None when it isn't calibrated."""
+    return THRESHOLDS.get(rag.embedding_model_id())
+
+
+def _probability(score: float, thresholds):
+    mid = (thresholds["match"] + thresholds["reject"]) / 2
+    scale = (thresholds["match"] - thresholds["reject"]) / 6 or 1.0
+    return 1 / (1 + math.exp(-(score - mid) / scale))
+
+
+def _has_keyword(text: str, keyword: str):
+    # Whole words only: "fee" shouldn't match "feedback" or "coffee"
+    return bool(keyword) and re.search(rf"(?<!\w){re.escape(keyword.lower())}(?!\w)", text) is not None
+
+
+def score_message(message: str, message_vector, triggers, vectors):
+    """Triggers ranked for the message: [(trigger, score, share)], best first."""
+    scores = vectors @ message_vector
+    text = message.lower()
+    scores = scores + np.asarray([KEYWORD_BONUS if _has_keyword(text, t.keyword) else 0.0 for t in triggers])
+    order = np.argsort(-scores)
+    weights = np.exp((scores[order] - scores[order[0]]) / SOFTMAX_TEMPERATURE)
+    shares = weights / weights.sum()
+    return [(triggers[i], float(scores[i]), float(s)) for i, s in zip(order, shares)]
+
+
+def _decide_locally(ranked, thresholds):
+    """A result dict, or None when the message is ambiguous."""
+    best, score, share = ranked[0]
+    margin = score - ranked[1][1] if len(ranked) > 1 else score
+    if score < thresholds["reject"]:
+        _record("reject")
+        return {"match": False, "confidence": round(1 - _probability(score, thresholds), 3),
+                "score": round(score, 4), "method": "similarity"}
+    if score >= thresholds["match"] and margin >= MIN_MARGIN:
+        _record("match")
+        return {"match": True, "triggerId": best.id, "confidence": round(_probability(score, thresholds) * share, 3),
+                "score": round(score, 4), "method": "similarity"}
+    return None
+
+
+def _llm_confidence(ranked, chosen, thresholds):
+    # Uncalibrated: only the ranking among the candidates means anything
+    if thresholds is None:
+        if chosen is None:
+            return 0.5
+        return 0.5 + 0.5 * next(share for t, _, share in ranked if t is chosen)
+    if chosen is None:
+        return 0.5 + 0.5 * (1 - _probability(ranked[0][1], thresholds))
+    return 0.5 + 0.5 * _probability(next(score for t, score, _ in ranked if t is chosen), thresholds)
+
+
+def _ask_llm(message: str, ranked, thresholds):
+    # Only the best few triggers go into the prompt
+    _record("llm" if thresholds is not None else "uncalibrated")
+    candidates = ranked[:LLM_CANDIDATES]
+    triggers_text = "\n".join(f"ID: {t.id} | Keyword: {t.keyword} | Intent: {t.intent}" for t, _, _ in candidates)
+
+    with model_call("llm", llm, "ticket") as call:
+        result = llm.invoke(ticket_prompt.format(triggers_text=triggers_text, message=message))
+        call.record(result)
+    content = result.content.strip()
+
+    # "None" (or an id that wasn't offered): the best candidate is out
+    chosen = next((t for t, _, _ in candidates if t.id == content), None)
+    confidence = round(_llm_confidence(ranked, chosen, thresholds), 3)
+    if chosen is None:
+        return {"match": False, "confidence": confidence, "score": round(ranked[0][1], 4), "method": "llm"}
+    score = next(score for t, score, _ in candidates if t is chosen)
+    return {"match": True, "triggerId": chosen.id, "confidence": confidence, "score": round(score, 4), "method": "llm"}
+
+# =============================================================
+# API
+# =============================================================
 def analyze_ticket(message: str, triggers: List[Trigger]):
     if not triggers:
         return {"match": False}
+    return analyze_tickets([message], triggers)[0]
 
-    triggers_text = "\n".join([f"ID: {t.id} | Keyword: {t.keyword} | Intent: {t.intent}" for t in triggers])
-    
-    result = llm.invoke(ticket_prompt.format(triggers_text=triggers_text, message=message))
-    content = result.content.strip()
 
-    if content == "None":
-        return {"match": False}
-    
-    return {"match": True, "triggerId": content, "confidence": 0.9} # Mock confidence for now
+def analyze_tickets(messages: List[str], triggers: List[Trigger]):
+    """analyze_ticket for many messages: one embedding call, LLM calls in parallel."""
+    if not triggers:
+        return [{"match": False} for _ in messages]
+    if not messages:
+        return []
+
+    thresholds = get_thresholds()
+    ordered, vectors = get_trigger_set(triggers)
+    # Messages are one-off, so they stay out of the shared embedding cache
+    if len(messages) == 1:
+        message_vectors = _unit([rag.embeddings.embed_query(messages[0])])
+    else:
+        message_vectors = _unit(rag.embed_queries(messages))
+
+    results = [None] * len(messages)
+    ambiguous = []
+    for i, (message, vector) in enumerate(zip(messages, message_vectors)):
+        ranked = score_message(message, vector, ordered, vectors)
+        results[i] = _decide_locally(ranked, thresholds) if thresholds is not None else None
+        if results[i] is None:
+            ambiguous.append((i, message, ranked))
+
+    if len(ambiguous) == 1:
+        i, message, ranked = ambiguous[0]
+        results[i] = _ask_llm(message, ranked, thresholds)
+    elif ambiguous:
+        with ThreadPoolExecutor(max_workers=max(1, min(LLM_CONCURRENCY, len(ambiguous)))) as pool:
+            answers = pool.map(lambda item: _ask_llm(item[1], item[2], thresholds), ambiguous)
+            for (i, _, _), answer in zip(ambiguous, answers):
+                results[i] = answer
+    return results
+
+
+def get_ticket_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    total = sum(stats.values())
+    stats["total"] = total
+    stats["llm_share"] = (stats["llm"] + stats["uncalibrated"]) / total if total else 0.0
+    stats["model"] = rag.embedding_model_id()
+    stats["calibrated"] = get_thresholds() is not None
+    with _sets_lock:
+        stats["cached_trigger_sets"] = len(_trigger_sets)
+    return stats
@@ -0,0 +1,51 @@
+import os
+import threading
+
+# =============================================================
+# TOKEN COUNTING
+# =============================================================
+# Token counts depend on the model's encoding: the chat model (gpt-4o-mini,
+# o200k_base) and the embedding models (cl100k_base) split text differently.
+# Callers pick the encoder for the model the text is sent to; the default is
+# the generation model, whose context window the prompt budget is about.
+# Encoders are loaded once each. Without tiktoken (or its encoding files,
+# which may have to be downloaded) counts are estimated at 4 chars per token.
+
+GENERATION_MODEL = os.getenv("GENERATION_MODEL", "gpt-4o-mini")
+
+_encoders = {}
+_encoders_lock = threading.Lock()
+
+
+def get_encoder(model: str = GENERATION_MODEL, encoding: str = None):
+    """The tiktoken encoding of model (or the named encoding), False when unavailable."""
+    key = encoding or model
+    encoder = _encoders.get(key)
+    if encoder is None:
+        with _encoders_lock:
+            encoder = _encoders.get(key)
+            if encoder is None:
+                try:
+                    import tiktoken
+                    encoder = tiktoken.get_encoding(encoding) if encoding else tiktoken.encoding_for_model(model)
+                except Exception as e:
+                    print(f"⚠️ Token encoder for {key} unavailable ({e}); estimating 4 chars per token")
+                    encoder = False
+                _encoders[key] = encoder
+    return encoder
+
+
+def token_lengths(texts, encoder=None):
+    encoder = get_encoder() if encoder is None else encoder
+    if not encoder:
+        return [len(t) // 4 + 1 for t in texts]
+    return [len(ids) for ids in encoder.encode_ordinary_batch(list(texts))]
+
+
+def truncate_tokens(text: str, max_tokens: int, encoder=None):
+    """The longest prefix of text within max_tokens tokens."""
+    encoder = get_encoder() if encoder is None else encoder
+    if not encoder:
+        return text[:max(0, max_tokens - 1) * 4]
+    ids = encoder.encode_ordinary(text)
+    return text if len(ids) <= max_tokens else encoder.decode(ids[:max_tokens])
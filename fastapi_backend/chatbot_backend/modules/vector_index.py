@@ -0,0 +1,154 @@
+import os
+import faiss
+import numpy as np
+
+# =============================================================
+# ID-MAPPED FAISS INDEX
+# =============================================================
+# Vectors are stored under the integer id of their chunk, so a document can be
+# removed by id without touching (or re-embedding) any other chunk.
+#
+# Saved indexes are opened memory-mapped, so the float32 codes are paged in by
+# the OS instead of being read into the heap. FAISS can't grow or shrink a
+# mapped index, so the first add/remove takes an owned copy.
+#
+# A tenant starts with an exact flat index. Large tenants get an IVF index
+# (optionally with PQ-compressed codes), trained from the vectors already
+# stored; IVF keeps chunk ids itself and finds them again through a hash
+# table, so removal by id and reconstruction still work.
+
+MMAP_FLAG = getattr(faiss, "IO_FLAG_MMAP_IFC", getattr(faiss, "IO_FLAG_MMAP", 0))
+
+
+class VectorIndex:
+    def __init__(self, index, mapped: bool = False):
+        self.index = index
+        self.mapped = mapped
+
+    @classmethod
+    def create(cls, dim: int):
+        return cls(faiss.IndexIDMap2(faiss.IndexFlatL2(dim)))
+
+    @classmethod
+    def train_ivf(cls, ids, vectors, nlist: int, pq_m: int = 0):
+        """IVF index over vectors, with pq_m byte PQ codes (0: full vectors)."""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        dim = vectors.shape[1]
+        quantizer = faiss.IndexFlatL2(dim)
+        if pq_m:
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, pq_m, 8)
+        else:
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist)
+        index.train(vectors)
+        index.set_direct_map_type(faiss.DirectMap.Hashtable)
+        index.add_with_ids(vectors, np.asarray(ids, dtype=np.int64))
+        # The quantizer is owned by the index from here on
+        index.own_fields = True
+        quantizer.this.disown()
+        return cls(index)
+
+    @property
+    def dim(self):
+        return self.index.d
+
+    @property
+    def ntotal(self):
+        return self.index.ntotal
+
+    @property
+    def kind(self):
+        index = faiss.downcast_index(self.index)
+        if isinstance(index, faiss.IndexIVFPQ):
+            return "ivfpq"
+        if isinstance(index, faiss.IndexIVF):
+            return "ivf"
+        return "flat"
+
+    def describe(self):
+        info = {"kind": self.kind, "vectors": self.ntotal, "dim": self.dim}
+        if info["kind"] != "flat":
+            ivf = faiss.extract_index_ivf(self.index)
+            info.update(nlist=ivf.nlist, nprobe=ivf.nprobe, code_size=ivf.code_size)
+        return info
+
+    def set_search_params(self, nprobe: int = None):
+        """nprobe: inverted lists scanned per query (IVF only); more is slower but more exact."""
+        if nprobe and self.kind != "flat":
+            ivf = faiss.extract_index_ivf(self.index)
+            ivf.nprobe = max(1, min(int(nprobe), ivf.nlist))
+
+    def ids(self):
+        if self.kind == "flat":
+            return faiss.vector_to_array(self.index.id_map).astype(np.int64)
+        ivf = faiss.extract_index_ivf(self.index)
+        parts = []
+        for list_no in range(ivf.nlist):
+            size = ivf.invlists.list_size(list_no)
+            if size:
+                parts.append(faiss.rev_swig_ptr(ivf.invlists.get_ids(list_no), size).copy())
+        return np.sort(np.concatenate(parts)) if parts else np.empty(0, np.int64)
+
+    def reconstruct_many(self, ids):
+        if not len(ids):
+            return np.empty((0, self.dim), np.float32)
+        if self.kind == "flat":
+            return np.vstack([self.index.reconstruct(int(i)) for i in ids])
+        return faiss.extract_index_ivf(self.index).reconstruct_batch(np.asarray(ids, dtype=np.int64))
+
+    def stored_vectors(self):
+        """(ids, vectors) of everything in the index; PQ vectors are approximations."""
+        if self.kind == "flat":
+            ids = self.ids()
+            return ids, self.index.index.reconstruct_n(0, self.ntotal) if len(ids) else np.empty((0, self.dim), np.float32)
+        ids = self.ids()
+        return ids, self.reconstruct_many(ids)
+
+    def _ensure_owned(self):
+        if self.mapped:
+            self.index = faiss.deserialize_index(faiss.serialize_index(self.index))
+            self.mapped = False
+
+    def add(self, ids, vectors):
+        if not len(ids):
+            return
+        self._ensure_owned()
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(ids), self.dim)
+        self.index.add_with_ids(vectors, np.asarray(ids, dtype=np.int64))
+
+    def remove(self, ids):
+        if not len(ids):
+            return 0
+        self._ensure_owned()
+        # An id array (not a batch selector) works for IVF's hash table too
+        return self.index.remove_ids(np.asarray(ids, dtype=np.int64))
+
+    def reconstruct(self, chunk_id):
+        return self.index.reconstruct(int(chunk_id))
+
+    def search(self, vector, k: int = 6):
+        """Return up to k (chunk_id, distance) pairs, nearest first."""
+        if self.ntotal == 0:
+            return []
+        query = np.asarray(vector, dtype=np.float32).reshape(1, self.dim)
+        distances, ids = self.index.search(query, min(k, self.ntotal))
+        return [(int(i), float(d)) for i, d in zip(ids[0], distances[0]) if i != -1]
+
+    def save(self, path: str):
+        tmp = f"{path}.tmp"
+        faiss.write_index(self.index, tmp)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True):
+        if mmap and MMAP_FLAG:
+            try:
+                return cls(faiss.read_index(path, MMAP_FLAG), mapped=True)
+            except RuntimeError:
+                pass  # index type without mmap support
+        return cls(faiss.read_index(path))
+
+    def estimate_size(self):
+        # Mapped codes live in the page cache, only the id map is on the heap
+        if self.mapped:
+            return self.ntotal * 16
+        return self.ntotal * (self.index.code_size if self.kind != "flat" else self.dim * 4) + self.ntotal * 16
@@ -0,0 +1,222 @@
+import os
+import re
+import json
+import time
+import asyncio
+import threading
+from urllib.parse import urljoin, urldefrag, urlparse
+import aiohttp
+from modules.web_loader import parse_html, page_text
+from modules.embedding_cache import text_hash
+
+# =============================================================
+# SITE CRAWLER
+# =============================================================
+# Breadth-first crawl from a seed page (or every page of a sitemap), limited
+# to the seed's host, a link depth and a page budget. Requests run on asyncio
+# with at most CRAWL_PER_HOST in flight per host.
+#
+# Every page's ETag, Last-Modified, text hash and same-host links are kept in
+# data/<tenant>/crawl_state.json. A re-crawl sends conditional GETs; a 304 or
+# an identical text hash marks the page unchanged, and the stored links keep
+# the crawl going through pages that weren't downloaded again.
+
+CRAWL_MAX_PAGES = int(os.getenv("CRAWL_MAX_PAGES", "200"))
+CRAWL_MAX_DEPTH = int(os.getenv("CRAWL_MAX_DEPTH", "2"))
+CRAWL_PER_HOST = int(os.getenv("CRAWL_PER_HOST", "4"))
+CRAWL_TIMEOUT = float(os.getenv("CRAWL_TIMEOUT", "20"))
+CRAWL_USER_AGENT = os.getenv("USER_AGENT", "chatbot-crawler/1.0")
+
+SKIP_EXTENSIONS = (
+    ".pdf", ".jpg", ".jpeg", ".png", ".gif", ".svg", ".webp", ".ico", ".css", ".js",
+    ".zip", ".rar", ".gz", ".mp3", ".mp4", ".avi", ".doc", ".docx", ".xls", ".xlsx", ".ppt", ".pptx",
+)
+
+_LOC = re.compile(r"<loc>\s*(.*?)\s*</loc>", re.IGNORECASE | re.DOTALL)
+_state_lock = threading.Lock()
+
+
+def normalize_url(url: str, base: str = None):
+    """Absolute http(s) URL without fragment, or None."""
+    url = urljoin(base, url.strip()) if base else url.strip()
+    url = urldefrag(url)[0]
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https") or not parsed.netloc:
+        return None
+    return url if parsed.path else url + "/"
+
+
+def is_sitemap(url: str):
+    path = urlparse(url).path.lower()
+    return path.endswith(".xml") or "sitemap" in path
+
+# =============================================================
+# CRAWL STATE
+# =============================================================
+def load_crawl_state(path: str):
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f).get("pages", {})
+
+
+def update_crawl_state(path: str, updates, removed=()):
+    """Merge page entries into the state file (other crawls may have written it too)."""
+    with _state_lock:
+        pages = load_crawl_state(path)
+        pages.update(updates)
+        for url in removed:
+            pages.pop(url, None)
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"pages": pages}, f, indent=1)
+        os.replace(tmp, path)
+    return pages
+
+# =============================================================
+# FETCHING
+# =============================================================
+def _parse_page(body: str, url: str, host: str):
+    soup = parse_html(body)
+    links = []
+    for a in soup.find_all("a", href=True):
+        link = normalize_url(a["href"], base=url)
+        if link and urlparse(link).netloc == host and not urlparse(link).path.lower().endswith(SKIP_EXTENSIONS):
+            links.append(link)
+    return page_text(soup), list(dict.fromkeys(links))
+
+
+class _Crawler:
+    def __init__(self, session, pages_state, host, per_host):
+        self.session = session
+        self.pages_state = pages_state
+        self.host = host
+        self.per_host = per_host
+        self._semaphores = {}
+
+    def _semaphore(self, url):
+        netloc = urlparse(url).netloc
+        if netloc not in self._semaphores:
+            self._semaphores[netloc] = asyncio.Semaphore(self.per_host)
+        return self._semaphores[netloc]
+
+    async def get(self, url, headers=None):
+        async with self._semaphore(url):
+            async with self.session.get(url, headers=headers or {}, allow_redirects=True) as resp:
+                body = await resp.text(errors="replace") if resp.status == 200 else ""
+                return resp.status, resp.headers, body, str(resp.url)
+
+    async def sitemap_urls(self, url, nested: bool = True):
+        status, _, body, _ = await self.get(url)
+        if status != 200:
+            raise RuntimeError(f"Sitemap {url} returned HTTP {status}")
+        locs = [normalize_url(u) for u in _LOC.findall(body)]
+        locs = [u for u in locs if u]
+        if nested and "<sitemapindex" in body.lower():
+            found = []
+            for sub in await asyncio.gather(*(self.sitemap_urls(u, nested=False) for u in locs)):
+                found.extend(sub)
+            return found
+        return locs
+
+    async def visit(self, url):
+        previous = self.pages_state.get(url) or {}
+        headers = {}
+        # Without a hash the page was never indexed; a 304 would skip it again
+        if previous.get("hash") and previous.get("etag"):
+            headers["If-None-Match"] = previous["etag"]
+        if previous.get("hash") and previous.get("last_modified"):
+            headers["If-Modified-Since"] = previous["last_modified"]
+
+        page = {"url": url, "status": None, "text": None, "etag": previous.get("etag"),
+                "last_modified": previous.get("last_modified"), "hash": previous.get("hash"),
+                "links": previous.get("links", []), "error": None}
+        try:
+            status, resp_headers, body, final_url = await self.get(url, headers)
+        except Exception as e:
+            page.update(status="failed", error=str(e) or type(e).__name__)
+            return page
+
+        if status == 304:
+            page["status"] = "unchanged"
+            return page
+        if status in (404, 410):
+            page["status"] = "gone"
+            return page
+        if status != 200:
+            page.update(status="failed", error=f"HTTP {status}")
+            return page
+        if "html" not in resp_headers.get("Content-Type", "text/html").lower():
+            page["status"] = "skipped"
+            return page
+
+        text, links = await asyncio.to_thread(_parse_page, body, final_url, self.host)
+        digest = text_hash(text)
+        page.update(
+            etag=resp_headers.get("ETag"),
+            last_modified=resp_headers.get("Last-Modified"),
+            links=links,
+        )
+        if previous.get("hash") == digest:
+            page["status"] = "unchanged"
+        else:
+            page.update(status="changed" if previous.get("hash") else "new", text=text, hash=digest)
+        return page
+
+
+async def crawl(seed: str, pages_state=None, max_pages: int = CRAWL_MAX_PAGES, max_depth: int = CRAWL_MAX_DEPTH,
+                per_host: int = CRAWL_PER_HOST, sitemap: bool = None, progress=None):
+    """Crawl from seed; returns the visited pages in visiting order.
+
+    pages_state is the previous crawl state ({url: entry}); each page gets a
+    status of new, changed, unchanged, gone, skipped or failed. Only new and
+    changed pages carry their text.
+    """
+    pages_state = pages_state or {}
+    seed = normalize_url(seed)
+    if seed is None:
+        raise ValueError("Seed must be an http(s) URL")
+    if sitemap is None:
+        sitemap = is_sitemap(seed)
+
+    timeout = aiohttp.ClientTimeout(total=CRAWL_TIMEOUT)
+    async with aiohttp.ClientSession(timeout=timeout, headers={"User-Agent": CRAWL_USER_AGENT}) as session:
+        crawler = _Crawler(session, pages_state, urlparse(seed).netloc, per_host)
+
+        if sitemap:
+            # A sitemap already lists the pages; their links aren't followed
+            frontier = list(dict.fromkeys(await crawler.sitemap_urls(seed)))
+            depth = max_depth
+        else:
+            frontier, depth = [seed], 0
+
+        visited = []
+        seen = set(frontier)
+        while frontier and len(visited) < max_pages:
+            level = frontier[:max_pages - len(visited)]
+            for page in await asyncio.gather(*(crawler.visit(u) for u in level)):
+                visited.append(page)
+            if progress:
+                progress(len(visited), max_pages)
+
+            frontier = []
+            if depth < max_depth:
+                for page in visited[-len(level):]:
+                    for link in page["links"]:
+                        if link not in seen:
+                            seen.add(link)
+                            frontier.append(link)
+            depth += 1
+
+    return visited
+
+
+def state_entry(page, source_id=None):
+    return {
+        "source_id": source_id,
+        "etag": page["etag"],
+        "last_modified": page["last_modified"],
+        "hash": page["hash"],
+        "links": page["links"],
+        "fetched_at": time.time(),
+    }
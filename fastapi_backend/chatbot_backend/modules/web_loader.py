@@ -1,8 +1,19 @@
 from dotenv import load_dotenv
+from bs4 import BeautifulSoup
 from langchain_community.document_loaders import WebBaseLoader
 load_dotenv()
 import os
 
+# Same parser and get_text() call WebBaseLoader uses, so crawled pages and
+# single-URL loads produce the same text
+HTML_PARSER = "html.parser"
+
+def parse_html(html: str):
+    return BeautifulSoup(html, HTML_PARSER)
+
+def page_text(soup):
+    return soup.get_text()
+
 def load_website(url):
     try:
         loader = WebBaseLoader(url)
@@ -0,0 +1,173 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+# =============================================================
+# PER-TENANT WRITE COORDINATOR (GROUP COMMIT)
+# =============================================================
+# All writes to a tenant's index go through submit(). Writers queue their
+# operation; the first one to find no commit in progress becomes the leader,
+# waits GROUP_COMMIT_WINDOW_MS for others to arrive and commits everything
+# queued so far with a single save. Operations arriving while a commit is
+# being written are picked up by the same leader in the next round.
+#
+# Readers of the in-memory index take reading(tenant_id); the leader only
+# holds the exclusive side while applying the batch in memory, not while the
+# files are written.
+#
+# Coordination is within this process; the server runs as a single process.
+
+WINDOW_SECONDS = float(os.getenv("GROUP_COMMIT_WINDOW_MS", "20")) / 1000
+MAX_BATCH = int(os.getenv("GROUP_COMMIT_MAX_OPS", "64"))
+
+
+class _ReadWriteLock:
+    """Many readers or one writer; waiting writers block new readers."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+class _Op:
+    def __init__(self, payload):
+        self.payload = payload
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _TenantState:
+    def __init__(self):
+        self.rw = _ReadWriteLock()
+        self.pending = []
+        self.committing = False
+
+
+class WriteCoordinator:
+    def __init__(self, commit_fn, window: float = WINDOW_SECONDS, max_batch: int = MAX_BATCH):
+        # commit_fn(tenant_id, payloads) applies and persists the payloads in
+        # order and returns one result per payload
+        self.commit_fn = commit_fn
+        self.window = window
+        self.max_batch = max_batch
+        self._tenants = {}
+        self._lock = threading.Lock()
+        self.commits = 0
+        self.ops = 0
+        self.fallbacks = 0
+
+    def _state(self, tenant_id: str):
+        with self._lock:
+            state = self._tenants.get(tenant_id)
+            if state is None:
+                state = self._tenants[tenant_id] = _TenantState()
+            return state
+
+    @contextmanager
+    def reading(self, tenant_id: str):
+        with self._state(tenant_id).rw.read():
+            yield
+
+    @contextmanager
+    def writing(self, tenant_id: str):
+        with self._state(tenant_id).rw.write():
+            yield
+
+    def submit(self, tenant_id: str, payload):
+        """Queue one write and block until it is committed; returns its result."""
+        state = self._state(tenant_id)
+        op = _Op(payload)
+        with self._lock:
+            state.pending.append(op)
+            lead = not state.committing
+            if lead:
+                state.committing = True
+
+        if lead:
+            self._lead(tenant_id, state)
+
+        op.done.wait()
+        if op.error is not None:
+            raise op.error
+        return op.result
+
+    def _lead(self, tenant_id: str, state: _TenantState):
+        if self.window > 0:
+            time.sleep(self.window)
+
+        while True:
+            with self._lock:
+                batch = state.pending[:self.max_batch]
+                del state.pending[:self.max_batch]
+                if not batch:
+                    state.committing = False
+                    return
+            self._commit(tenant_id, batch)
+
+    def _commit(self, tenant_id: str, batch):
+        try:
+            results = self.commit_fn(tenant_id, [op.payload for op in batch])
+            for op, result in zip(batch, results):
+                op.result = result
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0].error = e
+            else:
+                # Don't let one bad write fail the others: commit them one by one
+                print(f"⚠️ Group commit for {tenant_id} failed ({e}); retrying {len(batch)} writes individually")
+                self.fallbacks += 1
+                for op in batch:
+                    try:
+                        op.result = self.commit_fn(tenant_id, [op.payload])[0]
+                    except Exception as single_error:
+                        op.error = single_error
+        finally:
+            self.commits += 1
+            self.ops += len(batch)
+            for op in batch:
+                op.done.set()
+
+    def stats(self):
+        with self._lock:
+            pending = sum(len(s.pending) for s in self._tenants.values())
+        return {
+            "commits": self.commits,
+            "ops": self.ops,
+            "ops_per_commit": self.ops / self.commits if self.commits else 0.0,
+            "fallbacks": self.fallbacks,
+            "pending": pending,
+            "window_ms": self.window * 1000,
+        }
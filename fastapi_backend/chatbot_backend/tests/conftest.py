@@ -0,0 +1,37 @@
+import os
+import sys
+import pytest
+
+# The backend imports its modules as top-level packages (modules, benchmarks)
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+os.environ.setdefault("GROUP_COMMIT_WINDOW_MS", "0")
+
+
+@pytest.fixture(scope="session")
+def workdir(tmp_path_factory):
+    """data/, chat_data/ and uploads/ are relative to the working directory,
+    so the backend is imported and run from a temporary one."""
+    path = tmp_path_factory.mktemp("backend")
+    previous = os.getcwd()
+    os.chdir(path)
+    yield path
+    os.chdir(previous)
+
+
+@pytest.fixture(scope="session")
+def fakes(workdir):
+    """The stand-in models of the benchmarks, patched into every module that holds a model."""
+    from benchmarks.fakes import FakeEmbeddings, FakeChatModel
+    from modules import rag, intent_classifier, query_rewriter, ticket_classifier
+
+    embeddings = FakeEmbeddings(dim=64)
+    llm = FakeChatModel(answer="Employees get twenty days of annual leave per year.")
+    patch = pytest.MonkeyPatch()
+    patch.setattr(rag, "embeddings", embeddings)
+    for module in (rag, intent_classifier, query_rewriter, ticket_classifier):
+        patch.setattr(module, "llm", llm)
+    yield embeddings, llm
+    patch.undo()
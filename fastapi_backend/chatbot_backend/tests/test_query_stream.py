@@ -0,0 +1,72 @@
+import os
+import json
+import pytest
+from fastapi.testclient import TestClient
+
+
+@pytest.fixture(scope="module")
+def client(fakes):
+    from main import app
+    return TestClient(app)
+
+
+def read_events(response):
+    events = []
+    for frame in response.text.split("\n\n"):
+        if not frame.strip():
+            continue
+        lines = dict(line.split(": ", 1) for line in frame.split("\n"))
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+def stored_answers(tenant_id, user_id):
+    with open(os.path.join("chat_data", tenant_id, f"{user_id}.jsonl"), encoding="utf-8") as f:
+        return [json.loads(line)["answer"] for line in f if line.strip()]
+
+
+def ask(client, tenant_id, user_id, query):
+    response = client.post("/query/stream", data={"tenant_id": tenant_id, "query": query, "user_id": user_id})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    return read_events(response)
+
+
+def test_query_stream_streams_tokens_and_stores_the_answer_once(client, fakes):
+    from modules import rag
+    _, llm = fakes
+    rag.add_document("stream-tenant", "The annual leave policy gives every employee twenty days of leave.",
+                     "handbook", file_name="handbook.pdf")
+
+    calls = llm.calls
+    events = ask(client, "stream-tenant", "alice", "What is the annual leave policy?")
+    kinds = [kind for kind, _ in events]
+
+    assert kinds[0] == "sources"
+    assert events[0][1] == [{"id": "handbook", "type": "pdf", "name": "handbook.pdf"}]
+    assert kinds[-1] == "done"
+    tokens = [data["text"] for kind, data in events if kind == "token"]
+    assert kinds[1:-1] == ["token"] * len(tokens)
+    assert len(tokens) == len(llm.answer.split(" "))   # streamed word by word, not in one piece
+    assert "".join(tokens) == llm.answer
+    assert events[-1][1]["answer"] == llm.answer
+    assert llm.calls == calls + 1
+
+    assert stored_answers("stream-tenant", "alice") == [llm.answer]
+
+
+def test_query_stream_replays_cached_answer_and_stores_it_once(client, fakes):
+    from modules import rag
+    _, llm = fakes
+    rag.add_document("cached-tenant", "Remote work is allowed two days per week with manager approval.",
+                     "remote", file_name="remote.pdf")
+
+    first = ask(client, "cached-tenant", "bob", "How many remote work days are allowed?")
+    calls = llm.calls
+    second = ask(client, "cached-tenant", "bob", "How many remote work days are allowed?")
+
+    assert llm.calls == calls
+    assert [kind for kind, _ in second] == ["sources", "token", "done"]
+    assert second[0][1] == first[0][1]
+    assert second[1][1]["text"] == llm.answer
+    assert stored_answers("cached-tenant", "bob") == [llm.answer, llm.answer]
@@ -0,0 +1,243 @@
+import os
+import json
+import pickle
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+
+HANDBOOK = "\n\n".join(
+    f"Section {i}. The handbook paragraph number {i} explains rule {i} of the leave policy in plain words, "
+    f"with enough detail about approvals, carry-over and notice periods to fill a chunk of its own."
+    for i in range(6)
+)
+
+
+def reload(tenant_id):
+    """The tenant as a fresh process would load it."""
+    from modules import rag
+    rag.tenant_cache.invalidate(tenant_id)
+    return rag.load_tenant_data(tenant_id)
+
+
+def source_text(data, source_id):
+    chunks = sorted(data.store.chunks_for_source(source_id), key=lambda c: c["position"])
+    return [c["text"] for c in chunks]
+
+
+def committed_generation(tenant_id):
+    from modules.rag import get_paths
+    with open(get_paths(tenant_id)["manifest"], encoding="utf-8") as f:
+        return json.load(f)["generation"]
+
+
+def assert_consistent(data):
+    ids = sorted(c["id"] for c in data.store.iter_chunks())
+    assert len(data.bm25) == len(ids)
+    assert sorted(data.vectors.ids().tolist()) == ids
+    assert sum(entry["chunk_count"] for entry in data.manifest.values()) == len(ids)
+
+
+def test_add_update_delete_survive_a_reload(fakes):
+    from modules import rag
+
+    tenant_id = "store-roundtrip"
+    rag.add_document(tenant_id, HANDBOOK, "handbook", file_name="handbook.pdf")
+    rag.add_document(tenant_id, "The parking garage closes at nine in the evening.", "parking", file_name="parking.pdf")
+    assert committed_generation(tenant_id) == 2
+
+    revised = HANDBOOK.replace("rule 3 of the leave policy", "rule 3 of the sabbatical policy")
+    result = rag.update_document(tenant_id, revised, "handbook", file_name="handbook.pdf")
+    assert result["added"] == result["removed"] >= 1
+    assert result["kept"] >= 4
+    assert rag.delete_document(tenant_id, "parking") is True
+    assert rag.delete_document(tenant_id, "parking") is False
+
+    expected = source_text(rag.load_tenant_data(tenant_id), "handbook")
+    data = reload(tenant_id)
+
+    assert data.generation == committed_generation(tenant_id) == 4
+    assert set(data.manifest) == {"handbook"}
+    assert source_text(data, "handbook") == expected
+    assert any("sabbatical" in text for text in expected)
+    assert_consistent(data)
+    assert data.bm25.search("sabbatical")
+    assert not data.bm25.search("garage")
+    docs = rag.hybrid_retrieve(tenant_id, "sabbatical policy")
+    assert "sabbatical" in docs[0].page_content
+
+
+def test_many_commits_keep_one_generation_of_files(fakes):
+    from modules import rag
+
+    tenant_id = "store-generations"
+    for i in range(5):
+        rag.add_document(tenant_id, f"Notice {i}: the office kitchen is cleaned on day {i}.", f"notice-{i}")
+    rag.delete_document(tenant_id, "notice-0")
+
+    data = reload(tenant_id)
+    files = set(os.listdir(rag.get_paths(tenant_id)["base"]))
+    assert set(data.files.values()) <= files
+    assert not any(name.startswith(("vectors.", "chunks.idx.")) and name not in data.files.values() for name in files)
+    assert sorted(data.manifest) == [f"notice-{i}" for i in range(1, 5)]
+    assert_consistent(data)
+
+
+def test_replace_is_refused_when_the_planned_vectors_are_missing(fakes):
+    from modules import rag
+
+    tenant_id = "store-replace"
+    rag.add_document(tenant_id, HANDBOOK, "handbook")
+    before = source_text(rag.load_tenant_data(tenant_id), "handbook")
+    revised = HANDBOOK.replace("Section 5.", "Final section.")
+    full_chunks = rag.split_document(tenant_id, revised, "handbook")
+
+    # Planned against nothing: the changed chunk has no vector, so nothing is applied
+    assert rag.write_coordinator.submit(tenant_id, ("replace", [("handbook", full_chunks)], {})) == [None]
+    assert source_text(rag.load_tenant_data(tenant_id), "handbook") == before
+
+    # commit_updates embeds what the plan missed and tries again
+    embedded = fakes[0].texts
+    result = rag.commit_updates(tenant_id, [("handbook", rag.split_document(tenant_id, revised, "handbook"))], {})
+    assert result[0]["added"] == fakes[0].texts - embedded == 1
+    data = reload(tenant_id)
+    assert any(text.startswith("Final section.") for text in source_text(data, "handbook"))
+    assert_consistent(data)
+
+
+def test_concurrent_adds_are_group_committed(fakes, monkeypatch):
+    from modules import rag
+
+    tenant_id = "store-concurrent"
+    rag.add_document(tenant_id, "Opening hours are eight to six.", "hours")
+    monkeypatch.setattr(rag.write_coordinator, "window", 0.05)
+    commits, ops = rag.write_coordinator.commits, rag.write_coordinator.ops
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(lambda i: rag.add_document(tenant_id, f"Memo {i} about topic{i} for the whole team.", f"memo-{i}"),
+                      range(16)))
+
+    assert rag.write_coordinator.ops - ops == 16
+    assert rag.write_coordinator.commits - commits < 16
+    data = reload(tenant_id)
+    assert sorted(data.manifest) == sorted(["hours"] + [f"memo-{i}" for i in range(16)])
+    assert len({c["id"] for c in data.store.iter_chunks()}) == len(data.store) == 17
+    assert_consistent(data)
+    assert data.bm25.search("topic7")
+
+
+def test_a_failing_write_does_not_fail_its_group(fakes, monkeypatch):
+    from modules import rag
+
+    tenant_id = "store-fallback"
+    rag.add_document(tenant_id, "Opening hours are eight to six.", "hours")
+    monkeypatch.setattr(rag.write_coordinator, "window", 0.05)
+    fallbacks = rag.write_coordinator.fallbacks
+
+    def add(i):
+        full_chunks = rag.split_document(tenant_id, f"Memo {i} for the team.", f"memo-{i}")
+        vecs = rag.embed_chunks(full_chunks)
+        if i == 2:
+            vecs = [v[:3] for v in vecs]   # wrong dimension for the tenant's index
+        rag.commit_chunks(tenant_id, full_chunks, vecs)
+
+    start = threading.Barrier(4)
+
+    def run(i):
+        start.wait()
+        add(i)
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        futures = [pool.submit(run, i) for i in range(4)]
+    errors = [f.exception() for f in futures]
+
+    assert errors[2] is not None and [e for i, e in enumerate(errors) if i != 2] == [None, None, None]
+    assert rag.write_coordinator.fallbacks > fallbacks
+    data = reload(tenant_id)
+    assert sorted(data.manifest) == ["hours", "memo-0", "memo-1", "memo-3"]
+    assert_consistent(data)
+
+
+@pytest.fixture
+def legacy_tenant(fakes):
+    """A tenant directory as the first versions wrote it: chunks.pkl without
+    ids and a LangChain FAISS vectorstore."""
+    from langchain_community.vectorstores import FAISS
+    from modules.rag import get_paths
+
+    tenant_id = "store-legacy"
+    paths = get_paths(tenant_id)
+    chunks = [
+        {"text": f"Legacy chunk {i} about the expense policy, item {i}.",
+         "metadata": {"source_id": f"doc-{i % 2}", "type": "pdf", "file_name": f"doc-{i % 2}.pdf", "tenant_id": tenant_id}}
+        for i in range(6)
+    ]
+    with open(paths["legacy_chunks"], "wb") as f:
+        pickle.dump(chunks, f)
+    store = FAISS.from_texts([c["text"] for c in chunks], fakes[0], metadatas=[c["metadata"] for c in chunks])
+    store.save_local(paths["legacy_vectorstore"])
+    return tenant_id, chunks
+
+
+def test_legacy_tenant_is_migrated_once_and_keeps_its_vectors(legacy_tenant, fakes):
+    from modules import rag
+
+    tenant_id, chunks = legacy_tenant
+    paths = rag.get_paths(tenant_id)
+    embedded = fakes[0].texts
+
+    # Concurrent first requests share one migration
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        loaded = list(pool.map(lambda _: rag.load_tenant_data(tenant_id), range(4)))
+    data = loaded[0]
+    assert all(d is data for d in loaded)
+
+    assert fakes[0].texts == embedded   # vectors come from the old store, nothing is re-embedded
+    assert sorted(c["text"] for c in data.store.iter_chunks()) == sorted(c["text"] for c in chunks)
+    assert {s: e["chunk_count"] for s, e in data.manifest.items()} == {"doc-0": 3, "doc-1": 3}
+    assert_consistent(data)
+    assert os.path.exists(f"{paths['legacy_chunks']}.migrated")
+    assert not os.path.exists(paths["legacy_chunks"])
+    chunk = next(c for c in data.store.iter_chunks() if c["text"].startswith("Legacy chunk 4"))
+    assert data.vectors.search(fakes[0].embed_query(chunk["text"]), k=1)[0][0] == chunk["id"]
+
+    # Writes after the migration commit generations like any other tenant
+    rag.add_document(tenant_id, "New expense limits apply from next year.", "doc-2")
+    rag.delete_document(tenant_id, "doc-0")
+    data = reload(tenant_id)
+    assert data.generation == committed_generation(tenant_id) == 2
+    assert sorted(data.manifest) == ["doc-1", "doc-2"]
+    assert_consistent(data)
+    assert data.bm25.search("expense limits")
+
+
+def test_bm25_reloads_from_its_base_and_log(tmp_path, monkeypatch):
+    from modules import bm25_index
+    from modules.bm25_index import BM25Index
+
+    index = BM25Index()
+    for i in range(50):
+        index.add(i, f"document {i} word{i % 7} shared")
+    index.save(str(tmp_path / "bm25.1.json"))
+
+    index = BM25Index.load(str(tmp_path / "bm25.1.json"))
+    index.remove(3)
+    index.add(50, "document fifty word3 extra")
+    index.add(10, "document ten rewritten")
+    index.save(str(tmp_path / "bm25.2.json"))
+    assert len(index.file_names & set(os.listdir(tmp_path))) == 2   # the log was appended, no new base
+
+    for name, removed, added in (("bm25.1.json", [], []), ("bm25.2.json", [3], [50])):
+        loaded = BM25Index.load(str(tmp_path / name))
+        ids = {chunk_id for chunk_id, _ in loaded.search("document", k=100)}
+        assert ids == (set(range(50)) - set(removed)) | set(added)
+    loaded = BM25Index.load(str(tmp_path / "bm25.2.json"))
+    assert loaded.search("word3", k=100) == index.search("word3", k=100)
+    assert loaded.search("rewritten") == [(10, pytest.approx(index.search("rewritten")[0][1]))]
+
+    # A large log is folded into a new base
+    monkeypatch.setattr(bm25_index, "LOG_COMPACT_MIN", 0)
+    monkeypatch.setattr(bm25_index, "LOG_COMPACT_RATIO", 0.01)
+    loaded.add(51, "one more document")
+    loaded.save(str(tmp_path / "bm25.3.json"))
+    assert loaded.file_names == {"bm25.base.2.npz", "bm25.log.2.jsonl"}
+    assert len(BM25Index.load(str(tmp_path / "bm25.3.json"))) == 51
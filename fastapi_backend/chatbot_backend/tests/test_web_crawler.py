@@ -0,0 +1,145 @@
+import os
+import time
+import asyncio
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pytest
+
+PAGES = 6
+PER_HOST = 2
+
+
+class Site:
+    """Pages served by a local HTTP server, with ETags and a sitemap index."""
+
+    def __init__(self):
+        self.pages = {f"/p{i}": f"<html><body><h1>Page {i}</h1><p>Policy text number {i} for the crawler test.</p></body></html>"
+                      for i in range(PAGES)}
+        self.listed = sorted(self.pages)   # the sitemap isn't regenerated when a page is removed
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.log = []   # (path, status)
+
+    def sitemap(self, host):
+        locs = "".join(f"<url><loc>http://{host}{path}</loc></url>" for path in self.listed)
+        return f'<?xml version="1.0"?><urlset>{locs}</urlset>'
+
+
+def make_handler(site):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status, body=b"", content_type="text/html", etag=None):
+            with site.lock:
+                site.log.append((self.path, status))
+            self.send_response(status)
+            if status != 304:
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+            if etag:
+                self.send_header("ETag", etag)
+            self.end_headers()
+            if status != 304:
+                self.wfile.write(body)
+
+        def do_GET(self):
+            with site.lock:
+                site.in_flight += 1
+                site.max_in_flight = max(site.max_in_flight, site.in_flight)
+            try:
+                time.sleep(0.05)   # long enough for requests to overlap
+                host = self.headers["Host"]
+                if self.path == "/sitemap_index.xml":
+                    body = f'<?xml version="1.0"?><sitemapindex><sitemap><loc>http://{host}/sitemap.xml</loc></sitemap></sitemapindex>'
+                    return self._send(200, body.encode(), "application/xml")
+                if self.path == "/sitemap.xml":
+                    return self._send(200, site.sitemap(host).encode(), "application/xml")
+                html = site.pages.get(self.path)
+                if html is None:
+                    return self._send(404)
+                etag = '"' + hashlib.sha256(html.encode()).hexdigest()[:16] + '"'
+                if self.headers.get("If-None-Match") == etag:
+                    return self._send(304, etag=etag)
+                return self._send(200, html.encode(), etag=etag)
+            finally:
+                with site.lock:
+                    site.in_flight -= 1
+    return Handler
+
+
+@pytest.fixture
+def site():
+    site = Site()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(site))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    site.base = f"http://127.0.0.1:{server.server_address[1]}"
+    yield site
+    server.shutdown()
+    server.server_close()
+
+
+def test_crawl_discovers_sitemap_pages_within_the_per_host_limit(site):
+    from modules.web_crawler import crawl
+
+    pages = asyncio.run(crawl(f"{site.base}/sitemap_index.xml", per_host=PER_HOST))
+
+    assert sorted(p["url"] for p in pages) == sorted(f"{site.base}/p{i}" for i in range(PAGES))
+    assert {p["status"] for p in pages} == {"new"}
+    assert all("Policy text number" in p["text"] and p["etag"] for p in pages)
+    assert site.max_in_flight == PER_HOST
+
+
+def test_recrawl_skips_unchanged_pages_and_deletes_gone_ones(site, fakes):
+    from modules.jobs import Job
+    from modules.ingestion import ingest_crawl
+    from modules.rag import list_sources, get_tenant_dir
+    from modules.web_crawler import load_crawl_state
+
+    tenant_id = "crawl-tenant"
+    seed = f"{site.base}/sitemap.xml"
+    first = ingest_crawl(Job(tenant_id, "crawl"), tenant_id, seed)
+    print("FIRST", first); assert first["pages"] == {"new": PAGES}
+    sources = {s["name"]: s["id"] for s in list_sources(tenant_id)}
+    assert len(sources) == PAGES
+
+    site.pages["/p1"] = site.pages["/p1"].replace("Policy text", "Revised policy text")
+    del site.pages["/p2"]
+    site.log.clear()
+    second = ingest_crawl(Job(tenant_id, "crawl"), tenant_id, seed)
+
+    assert second["pages"] == {"unchanged": PAGES - 2, "changed": 1, "gone": 1}
+    statuses = dict(site.log)
+    assert statuses["/p1"] == 200 and statuses["/p2"] == 404
+    assert all(statuses[f"/p{i}"] == 304 for i in (0, 3, 4, 5))
+
+    after = {s["name"]: s["id"] for s in list_sources(tenant_id)}
+    assert f"{site.base}/p2" not in after
+    assert after[f"{site.base}/p1"] == sources[f"{site.base}/p1"]   # a page keeps its source id
+    state = load_crawl_state(os.path.join(get_tenant_dir(tenant_id), "crawl_state.json"))
+    assert sorted(state) == sorted(f"{site.base}/p{i}" for i in range(PAGES) if i != 2)
+
+
+
+def test_recrawl_retries_pages_that_failed_to_index(site, fakes):
+    from modules.jobs import Job
+    from modules.ingestion import ingest_crawl
+    from modules.rag import list_sources
+
+    tenant_id = "crawl-retry-tenant"
+    seed = f"{site.base}/sitemap.xml"
+    site.pages["/p3"] = "<html><body></body></html>"   # no text, so it fails to index
+    first = ingest_crawl(Job(tenant_id, "crawl"), tenant_id, seed)
+    assert first["pages"] == {"new": PAGES}
+    assert [item["name"] for item in first["items"] if item["status"] == "failed"] == [f"{site.base}/p3"]
+    assert len(list_sources(tenant_id)) == PAGES - 1
+
+    # Same ETag as before, but the page was never indexed: no conditional request
+    site.log.clear()
+    second = ingest_crawl(Job(tenant_id, "crawl"), tenant_id, seed)
+
+    assert dict(site.log)["/p3"] == 200
+    assert second["pages"] == {"unchanged": PAGES - 1, "new": 1}